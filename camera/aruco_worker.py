@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import heapq
+from itertools import count
+from threading import Condition, Thread
+from typing import Any, Callable, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+from cv2 import imread
+
+from common.logger import Logger
+from common.typen import ArucoMarkerPos, ArucoWorkerStats, Metadata
+
+
+class ArucoJob(NamedTuple):
+    """
+    A frame waiting for the detection.
+    """
+    file: str
+    image: npt.NDArray[np.uint8] | None
+    metadata: dict[str, Any]
+    callback: Callable[[list[ArucoMarkerPos], Metadata], None]
+    session: str
+    reuse: bool
+
+
+class ArucoWorker:
+    """
+    Detects the ArUco markers of the saved frames one after another in a single thread.
+
+    The Pi Zero has one core, concurrent detections only compete with the
+    capture. The frames of the newest session are processed first, the
+    frames of one session in the order they were submitted. At most
+    max_images frames are kept in memory, the image of further frames is
+    read from their file when they are processed.
+
+    Frames submitted with reuse get the result of an earlier frame of the
+    same session and lens position with at least confident markers instead
+    of a new detection. The pixel coordinates depend on the focus, so the
+    frames of a focus stack at other lens positions are detected again.
+    The callback is still called for every frame.
+
+    Attributes:
+        __detect (Callable[[npt.NDArray[np.uint8]], list[ArucoMarkerPos]]): The detection.
+        __load (Callable[[str], npt.NDArray[np.uint8] | None]): Reads the image of a file.
+        __max_images (int): The number of frames kept in memory.
+        __confident (int): The number of markers of a result reused for the session, 0 to disable.
+        __queue (list[tuple[int, int, ArucoJob]]): The heap of the jobs by session and submission.
+        __sessions (dict[str, int]): The order of the sessions with queued jobs, newer sessions have a higher number.
+        __results (dict[tuple[str, float | None], list[ArucoMarkerPos]]): The confident results by session and lens position.
+        __condition (Condition): Signals new jobs.
+        __stats (ArucoWorkerStats): The counters of the worker.
+
+    Methods:
+        start(): None
+        submit(session: str, file: str, metadata: dict[str, Any], callback: Callable, image: npt.NDArray | None = None, reuse: bool = False): None
+        join(): None
+        stop(): None
+        get_stats(): ArucoWorkerStats
+    """
+
+    def __init__(self, detect: Callable[[npt.NDArray[np.uint8]], list[ArucoMarkerPos]],
+                 max_images: int = 2, confident: int = 0,
+                 load: Callable[[str], npt.NDArray[np.uint8] | None] = imread):
+        """
+        Initializes the ArucoWorker object.
+
+        Args:
+            detect: Detects the markers in an image.
+            max_images: The number of frames kept in memory.
+            confident: The number of markers of a result reused for the session, 0 to disable.
+            load: Reads the image of a file.
+        """
+        self.__detect = detect
+        self.__load = load
+        self.__max_images = max_images
+        self.__confident = confident
+        self.__queue: list[tuple[int, int, ArucoJob]] = []
+        self.__submitted = count()
+        self.__sessions: dict[str, int] = {}
+        self.__session_order = count()
+        self.__results: dict[tuple[str, float | None], list[ArucoMarkerPos]] = {}
+        self.__condition = Condition()
+        self.__running = False
+        self.__busy = False
+        self.__thread: Thread | None = None
+        self.__stats: ArucoWorkerStats = {'queued': 0, 'in_memory': 0, 'processed': 0,
+                                          'reused': 0, 'spilled': 0, 'errors': 0}
+
+    def start(self) -> None:
+        """
+        Starts the worker thread.
+        """
+        self.__running = True
+        self.__thread = Thread(target=self.__run, name="Aruco", daemon=True)
+        self.__thread.start()
+
+    def submit(self, session: str, file: str, metadata: dict[str, Any],
+               callback: Callable[[list[ArucoMarkerPos], Metadata], None],
+               image: npt.NDArray[np.uint8] | None = None, reuse: bool = False) -> None:
+        """
+        Queues a frame for the detection.
+
+        Args:
+            session: The ID of the capture.
+            file: The file of the frame.
+            metadata: The metadata of the frame.
+            callback: Called with the markers and the metadata of the frame.
+            image: The frame, it is not copied and must not be changed afterwards.
+                None to read it from the file.
+            reuse: A boolean indicating if a confident result of the session can be used.
+        """
+        with self.__condition:
+            if session not in self.__sessions:
+                self.__sessions[session] = next(self.__session_order)
+            if image is not None and self.__stats['in_memory'] >= self.__max_images:
+                # the frame is read again from the file
+                image = None
+                self.__stats['spilled'] += 1
+            if image is not None:
+                self.__stats['in_memory'] += 1
+            job = ArucoJob(file, image, metadata, callback, session, reuse)
+            heapq.heappush(self.__queue, (-self.__sessions[session],
+                                          next(self.__submitted), job))
+            self.__stats['queued'] = len(self.__queue)
+            self.__condition.notify()
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while self.__running and len(self.__queue) == 0:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                _, _, job = heapq.heappop(self.__queue)
+                self.__stats['queued'] = len(self.__queue)
+                if all(queued.session != job.session for _, _, queued in self.__queue):
+                    # a later frame of the session is queued as a new session
+                    del self.__sessions[job.session]
+                self.__busy = True
+                reused = self.__results.get(self.__key(job)) if job.reuse else None
+            try:
+                self.__process(job, reused)
+            except Exception as e:
+                with self.__condition:
+                    self.__stats['errors'] += 1
+                Logger().error("Aruco detection of %s failed: %s", job.file, e)
+            with self.__condition:
+                if job.image is not None:
+                    self.__stats['in_memory'] -= 1
+                self.__busy = False
+                self.__condition.notify_all()
+
+    @staticmethod
+    def __key(job: ArucoJob) -> tuple[str, float | None]:
+        position = job.metadata.get('LensPosition')
+        # the reported position jitters below the focus tolerance
+        return job.session, None if position is None else round(position, 2)
+
+    def __process(self, job: ArucoJob, reused: list[ArucoMarkerPos] | None) -> None:
+        if reused is not None:
+            with self.__condition:
+                self.__stats['reused'] += 1
+            Logger().info("Aruco of %s reused", job.file)
+            job.callback(reused, job.metadata)  # type: ignore
+            return
+        image = job.image if job.image is not None else self.__load(job.file)
+        if image is None:
+            raise ValueError("image not readable")
+        marker = self.__detect(image)
+        with self.__condition:
+            self.__stats['processed'] += 1
+            if job.reuse and 0 < self.__confident <= len(marker) // 4:
+                self.__results[self.__key(job)] = marker
+                # only the last results are kept
+                while len(self.__results) > 16:
+                    del self.__results[next(iter(self.__results))]
+        job.callback(marker, job.metadata)  # type: ignore
+
+    def join(self) -> None:
+        """
+        Waits until all queued frames have been processed.
+        """
+        with self.__condition:
+            while len(self.__queue) > 0 or self.__busy:
+                self.__condition.wait()
+
+    def stop(self) -> None:
+        """
+        Stops the worker thread, queued frames are discarded.
+        """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def get_stats(self) -> ArucoWorkerStats:
+        """
+        Returns the counters of the worker.
+        """
+        with self.__condition:
+            return ArucoWorkerStats(**self.__stats)
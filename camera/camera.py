@@ -63,11 +63,17 @@ def web_shutdown():
     return render_template('wait.htm', target_url="/", time=3, title="Shutting down...")
 
 
-"""@app.route('/stream.mjpg')
+@app.route('/stream.mjpg')
 def stream():
-    return Response(ks.cam.streaming(),
+    """ live preview, all viewers share the frames of one producer """
+    return Response(cc.stream().mjpeg(),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
-"""
+
+
+@app.route('/streamStats/')
+def stream_stats():
+    """ counters of the live preview stream """
+    return dumps(cc.stream().get_stats(), indent=2)
 
 
 @app.route('/photo/', methods=['GET', 'POST'])
@@ -119,7 +125,11 @@ def focus(focus: float = -1):
 @app.route('/aruco/<id>')
 def aruco(id: str = ""):
     if id != "":
-        return ""
+        # binary result announced by 'arucoUrl'
+        result = cc.aruco_result(id)
+        if result is None:
+            return ""
+        return Response(result, mimetype='application/octet-stream')
     return dumps(cc.aruco(), indent=2)
 
 
@@ -128,6 +138,24 @@ def meta():
     return dumps(cc.meta(), indent=2)
 
 
+@app.route('/stats/')
+def stats():
+    """ queue depth and latency of the commands """
+    return dumps(cc.stats(), indent=2)
+
+
+@app.route('/messagingStats/')
+def messaging_stats():
+    """ sent datagrams, batches and send latency """
+    return dumps(cc.messaging_stats(), indent=2)
+
+
+@app.route('/arucoStats/')
+def aruco_stats():
+    """ timings of the last Aruco detections """
+    return dumps(cc.aruco_stats(), indent=2)
+
+
 def start_web():
     """ start web control """
     Logger().info("Web server is starting...")
@@ -6,45 +6,182 @@
 @version: 2024.03.11
 """
 
+from collections import deque
+from threading import Lock
+from time import perf_counter
+
+import numpy as np
+import numpy.typing as npt
 from cv2.aruco import Dictionary_create, DetectorParameters, CORNER_REFINE_SUBPIX, detectMarkers
-from cv2 import cvtColor, COLOR_BGR2GRAY
+from cv2 import cvtColor, resize, COLOR_BGR2GRAY, INTER_AREA
 
-from common.typen import ArucoMarkerPos
+from common.typen import ArucoMarkerPos, ArucoStats
 from common.logger import Logger
 
+# a detected marker: id and its four corners, shape (4, 2)
+Marker = tuple[int, npt.NDArray[np.float32]]
+
 
 class Aruco:
     '''
     This class is used to detect Aruco markers in images.
 
+    The rig does not move, so the markers are searched in the windows around
+    the markers of the previous detection first. Without previous markers, the
+    markers are searched in a downscaled image and their corners are refined
+    at full resolution in windows around them. If a marker of the windows is
+    missing, the whole image is searched.
+
+    Neither the windows nor the downscaled image find every marker: new
+    markers are outside the windows and small markers vanish when the image
+    is downscaled. So the whole image is searched at full resolution first,
+    every full_every detections and whenever fewer markers than in the last
+    full search are found.
+
     Attributes:
     - __parameter: DetectorParameters
     - __dict: Dictionary
-
+    - __scale: int, the factor the image is downscaled by for the search, 1 to disable
+    - __margin: int, the margin around a marker in pixels of the full image
+    - __use_rois: bool, search the windows of the previous detection first
+    - __full_every: int, the number of detections after which the whole image is searched, 0 to disable
+    - __rois: list[tuple[int, int, int, int, int]], id and window of the markers of the previous detection
+    - __full_count: int | None, the number of markers of the last full search, None before the first
+    - __since_full: int, the number of detections since the last full search
+    - __stats: deque[ArucoStats], the timings of the last detections
+    - __lock: Lock
 
     Methods:
     - detect_from_rgb(image: bytes) -> list[ArucoMarkerPos]
     - detect(image: bytes) -> list[ArucoMarkerPos]
+    - get_stats() -> list[ArucoStats]
     '''
 
-    def __init__(self):
+    def __init__(self, scale: int = 2, margin: int = 32, use_rois: bool = True,
+                 full_every: int = 10):
         self.__parameter = DetectorParameters.create()
         self.__parameter.cornerRefinementMethod = CORNER_REFINE_SUBPIX
         self.__dict = Dictionary_create(32, 3)
+        self.__scale = max(1, scale)
+        self.__margin = margin
+        self.__use_rois = use_rois
+        self.__full_every = full_every
+        self.__rois: list[tuple[int, int, int, int, int]] = []
+        self.__full_count: int | None = None
+        self.__since_full = 0
+        self.__stats: deque[ArucoStats] = deque(maxlen=100)
+        self.__lock = Lock()
 
     def detect_from_rgb(self, image: bytes) -> list[ArucoMarkerPos]:
-        img = cvtColor(image, COLOR_BGR2GRAY)
-        return self.detect(img)
+        # only the searched parts are converted to gray
+        return self.detect(image)
 
     def detect(self, image: bytes) -> list[ArucoMarkerPos]:
+        img: npt.NDArray[np.uint8] = np.asarray(image)
+        start = perf_counter()
+        stats: ArucoStats = {'mode': 'full', 'markers': 0, 'windows': 0,
+                             'search': 0., 'refine': 0., 'full': 0., 'total': 0.}
+        with self.__lock:
+            rois = list(self.__rois) if self.__use_rois else []
+            full_count = self.__full_count
+            if self.__full_every > 0 and self.__since_full >= self.__full_every:
+                # search for new markers from time to time
+                full_count = None
+
+        found: list[Marker] | None = None
+        if full_count is not None and len(rois) > 0:
+            found = self.__refine(img, rois, stats)
+            if found is not None and len(found) >= full_count:
+                stats['mode'] = 'roi'
+            else:
+                found = None
+        if full_count is not None and found is None and self.__scale > 1:
+            t = perf_counter()
+            coarse = self.__detect(self.__gray(resize(
+                img, None, fx=1 / self.__scale, fy=1 / self.__scale, interpolation=INTER_AREA)))
+            stats['search'] = (perf_counter() - t) * 1000
+            # small markers are lost in the downscaled image
+            if len(coarse) > 0 and len(coarse) >= full_count:
+                found = self.__refine(img, [self.__window(img, id, corners * self.__scale)
+                                            for id, corners in coarse], stats)
+                if found is not None:
+                    stats['mode'] = 'scaled'
+        if found is None:
+            t = perf_counter()
+            found = self.__detect(self.__gray(img))
+            stats['full'] = (perf_counter() - t) * 1000
+            stats['mode'] = 'full'
+
+        with self.__lock:
+            self.__rois = [self.__window(img, id, corners) for id, corners in found]
+            if stats['mode'] == 'full':
+                self.__full_count = len(found)
+                self.__since_full = 0
+            else:
+                self.__since_full += 1
+
+        marker: list[ArucoMarkerPos] = [{'id': id,
+                                         'corner': int(eid),
+                                         'x': float(e[0]),
+                                         'y': float(e[1])} for id, ecke in found
+                                        for eid, e in enumerate(ecke)]
+        stats['markers'] = len(found)
+        stats['total'] = (perf_counter() - start) * 1000
+        self.__stats.append(stats)
+        Logger().info("Found Aruco: %d (%s, %.0f ms)",
+                      len(marker), stats['mode'], stats['total'])
+        return marker
+
+    def get_stats(self) -> list[ArucoStats]:
+        '''
+        Returns the timings of the last detections in milliseconds.
+        '''
+        return list(self.__stats)
+
+    @staticmethod
+    def __gray(image: npt.NDArray[np.uint8]) -> npt.NDArray[np.uint8]:
+        if image.ndim == 3:
+            return cvtColor(image, COLOR_BGR2GRAY)
+        return image
+
+    def __detect(self, image: npt.NDArray[np.uint8]) -> list[Marker]:
         corners, ids, _ = detectMarkers(
             image, self.__dict, parameters=self.__parameter)
         if ids is None:
             return []
-        marker: list[ArucoMarkerPos] = [{'id': int(id_[0]),
-                                         'corner': int(eid),
-                                         'x': float(e[0]),
-                                         'y': float(e[1])} for ecke, id_ in zip(corners, ids)
-                                        for eid, e in enumerate(ecke[0])]
-        Logger().info("Found Aruco: %d", len(marker))
-        return marker
+        return [(int(id_[0]), ecke[0]) for ecke, id_ in zip(corners, ids)]
+
+    def __window(self, image: npt.NDArray[np.uint8], id: int,
+                 corners: npt.NDArray[np.float32]) -> tuple[int, int, int, int, int]:
+        '''
+        The window around a marker inside the image: id, x0, y0, x1, y1.
+        '''
+        h, w = image.shape[:2]
+        x0, y0 = np.floor(corners.min(axis=0)).astype(int) - self.__margin
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int) + self.__margin
+        return id, max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+
+    def __refine(self, image: npt.NDArray[np.uint8], windows: list[tuple[int, int, int, int, int]],
+                 stats: ArucoStats) -> list[Marker] | None:
+        '''
+        Detects the markers at full resolution in their windows.
+
+        Returns:
+            The markers or None if a marker is missing in its window.
+        '''
+        t = perf_counter()
+        found: list[Marker] = []
+        for id, x0, y0, x1, y1 in windows:
+            stats['windows'] += 1
+            # a window can contain parts of other markers
+            candidates = [c for i, c in self.__detect(self.__gray(image[y0:y1, x0:x1]))
+                          if i == id]
+            if len(candidates) == 0:
+                stats['refine'] += (perf_counter() - t) * 1000
+                Logger().debug("Aruco %d not found in its window", id)
+                return None
+            center = np.array([(x1 - x0) / 2, (y1 - y0) / 2])
+            corners = min(candidates, key=lambda c: np.linalg.norm(c.mean(axis=0) - center))
+            found.append((id, corners + np.array([x0, y0], dtype=np.float32)))
+        stats['refine'] += (perf_counter() - t) * 1000
+        return found
@@ -12,10 +12,16 @@ from sys import exit
 from typing import Any, Callable
 from common.logger import Logger
 from camera.camera_interface import CameraInterface
+from camera.camera_stacker import CameraStacker
+from camera.stream import FrameStream
+from camera.command_dispatcher import CommandDispatcher
 import socket
-from json import JSONDecodeError, dumps, loads as json_loads
-from common.typen import ArucoMarkerPos, ArucoMetaBroadcast, CamSettings, CamSettingsWithFilename, Metadata
+from json import JSONDecodeError, loads as json_loads
+from common.typen import ArucoMarkerPos, ArucoWorkerStats, CamSettings, CamSettingsWithFilename, CommandStats, MessagingStats, Metadata
 from common.conf import Conf
+from common.messaging import MessageEndpoint
+from common.aruco_codec import encode_aruco, fragment
+from itertools import count
 
 
 class CameraControl:
@@ -23,8 +29,12 @@ class CameraControl:
     This class is used to control the camera and perform various operations such as taking photos, setting camera settings, and broadcasting Aruco information.
 
     Attributes:
-    - __sock: socket.socket
+    - __endpoint: MessageEndpoint
+    - __port: int
     - __cam: CameraInterface
+    - __stacker: CameraStacker
+    - __dispatcher: CommandDispatcher
+    - __aruco_results: dict[str, bytes]
 
     Methods:
     + __init__()
@@ -34,40 +44,64 @@ class CameraControl:
     + set_settings(settings: CamSettings | str): CamSettings
     - __save(settings: CamSettingsWithFilename | str,
             aruco_callback: None | Callable[[list[ArucoMarkerPos],
-            dict[str, Any]], None] = None):
+            dict[str, Any]], None] = None, target_ns: int | None = None):
             tuple[str, dict[str, Any]]
     + preview(settings: CamSettings | str = {}): bytes
+    + stream(): FrameStream
     + focus(focus: float): str
     + aruco():list[ArucoMarkerPos]
     - __aruco_broadcast(addr: tuple[str, int], id: str)
     - __send_aruco_data(addr: tuple[str, int], id: str,
             marker: list[ArucoMarkerPos], meta: dict[str, Any] = {})
+    + aruco_result(key: str): bytes | None
     + meta():None | dict[str, int]
     + pause()
     + resume()
     + shutdown()
     + say_moin()
+    + stats(): CommandStats
+    + messaging_stats(): MessagingStats
+    + aruco_stats(): ArucoWorkerStats
+    - __register_commands()
     - __receive_broadcast()
-    - __take_focusstack(id: str, addr: tuple[str, int])
+    - __take_focusstack(id: str, addr: tuple[str, int], positions: list[float], fused: bool = False)
     - __take_photo(data: str, addr: tuple[str, int])
-    - __answer(addr: str, msg: str)
+    - __trigger_command(arg: str, addr: tuple[str, int])
+    - __answer(addr: str, msg: str | bytes)
     '''
 
-    __sock: socket.socket
+    __endpoint: MessageEndpoint
+    __port: int
     __cam: CameraInterface
+    __stacker: CameraStacker
+    __dispatcher: CommandDispatcher
+    __aruco_results: dict[str, bytes]
 
     def __init__(self):
         """
         Constructor for the CameraControl class.
         """
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.__sock.bind(
-            ("255.255.255.255", int(Conf().get()['both']['BroadCastPort'])))
+        conf = Conf().get()['both']
+        self.__port = int(conf['BroadCastPort'])
+        self.__endpoint = MessageEndpoint(
+            socket.gethostname(), self.__port,
+            lambda addr: (addr[0], self.__port),
+            timeout=conf.getfloat('AckTimeout', 0.5),
+            retries=conf.getint('AckRetries', 5))
+        self.__endpoint.listen("255.255.255.255")
 
         if not path.exists(Conf().get()['kameras']['Folder']):
             makedirs(Conf().get()['kameras']['Folder'])
 
+        # results too large for a few datagrams, fetched by the master via http
+        self.__aruco_results = {}
+        self.__aruco_numbers = count(1)
+        self.__max_fragments = Conf().get()['kameras'].getint(
+            'ArucoMaxFragments', 8)
+
+        self.__dispatcher = CommandDispatcher()
+        self.__register_commands()
+
         t = Thread(target=self.__receive_broadcast)
         t.start()
 
@@ -86,6 +120,9 @@ class CameraControl:
 
     def run(self):
         self.__cam = CameraInterface(Conf().get()['kameras']['Folder'])
+        self.__stacker = CameraStacker(
+            Conf().get()['kameras']['Folder'],
+            tile_rows=Conf().get()['kameras'].getint('StackTileRows', 512))
         Logger().info("Moin")
 
     def __check_settings(self, settings: CamSettings | str) -> CamSettings:
@@ -164,13 +201,14 @@ class CameraControl:
                 settingR = {}
         return self.__cam.set_settings(settingR)
 
-    def __save(self, settings: CamSettingsWithFilename | str, aruco_callback: None | Callable[[list[ArucoMarkerPos], Metadata], None] = None) -> tuple[str, dict[str, Any]]:
+    def __save(self, settings: CamSettingsWithFilename | str, aruco_callback: None | Callable[[list[ArucoMarkerPos], Metadata], None] = None, target_ns: int | None = None) -> tuple[str, dict[str, Any]]:
         """
         Saves a picture using the specified settings.
 
         Args:
             settings (CamSettingsWithFilename | str): The settings for saving the picture. It can be either an instance of `CamSettingsWithFilename` or a JSON string representing the settings.
             aruco_callback (None | Callable[[list[ArucoMarkerPos], dict[str, Any]], None], optional): A callback function to be called after the picture is saved. Defaults to None.
+            target_ns (int | None, optional): The wall clock time of a scheduled trigger in nanoseconds. Defaults to None.
 
         Returns:
             tuple[str, Metadata]: The filename and metadata of the saved picture.
@@ -181,11 +219,25 @@ class CameraControl:
             settingsR = json_loads(settings)
         else:
             settingsR = settings
-        return self.__cam.save_picture(settingsR, aruco_callback=aruco_callback)
+        return self.__cam.save_picture(settingsR, aruco_callback=aruco_callback, target_ns=target_ns)
 
     def preview(self, settings: CamSettings | str = {}):
+        """
+        Returns a small JPEG of the live preview, a photo if the preview has no frame.
+        """
         settings = self.__check_settings(settings)
-        return self.__cam.make_picture(settings, preview=True)
+        if settings:
+            self.__cam.set_settings(settings)
+        frame = self.__cam.get_stream().latest()
+        if frame is not None:
+            return frame
+        return self.__cam.make_picture(preview=True)
+
+    def stream(self) -> FrameStream:
+        """
+        Returns the live preview of the camera.
+        """
+        return self.__cam.get_stream()
 
     def focus(self, focus: float) -> str:
         return self.__cam.focus(focus)
@@ -215,10 +267,31 @@ class CameraControl:
         self.__send_aruco_data(addr, id, marker)
 
     def __send_aruco_data(self, addr: tuple[str, int], id: str, marker: list[ArucoMarkerPos], meta: Metadata = {}):
-        data: ArucoMetaBroadcast = {"aruco": marker, "meta": meta}
-        json_str = dumps(data, indent=None, separators=(",", ":"))
-        self.__answer(addr[0], 'arucoReady:' + id + ':' +
-                      socket.gethostname() + ':' + json_str)
+        """
+        Sends the binary ArUco result of an image to the master.
+
+        Small results are sent in one or more fragments 'arucoBin:<id>:<hostname>:<key>:<index>:<total>:<data>',
+        larger ones are kept for the http endpoint and announced with 'arucoUrl:<id>:<hostname>:<key>'.
+        """
+        data = encode_aruco(marker, meta)
+        hostname = socket.gethostname()
+        key = f"{id}_{next(self.__aruco_numbers)}"
+        fragments = fragment(data)
+        if len(fragments) > self.__max_fragments:
+            if len(self.__aruco_results) >= 100:
+                del self.__aruco_results[next(iter(self.__aruco_results))]
+            self.__aruco_results[key] = data
+            self.__answer(addr[0], f'arucoUrl:{id}:{hostname}:{key}')
+            return
+        for i, f in enumerate(fragments):
+            self.__answer(addr[0], f'arucoBin:{id}:{hostname}:{key}:{i}:{len(fragments)}:'.encode(
+                "utf-8") + f)
+
+    def aruco_result(self, key: str) -> bytes | None:
+        """
+        Returns a binary ArUco result announced with 'arucoUrl'.
+        """
+        return self.__aruco_results.get(key)
 
     def meta(self) -> None | dict[str, int]:
         return self.__cam.meta()
@@ -234,151 +307,207 @@ class CameraControl:
         return self.__cam.is_paused()
 
     def say_moin(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.sendto(('Moin:'+socket.gethostname()).encode("utf-8"), ('255.255.255.255', int(
-                Conf().get()['both']['BroadCastPort'])))
+        # broadcast without acknowledgement
+        self.__endpoint.broadcast(
+            ('Moin:'+socket.gethostname()).encode("utf-8"), set())
 
-    def __receive_broadcast(self):
+    def __register_commands(self):
         """
-        Receives and processes broadcast messages.
+        Registers the commands of the master at the dispatcher.
 
-        This method continuously listens for broadcast messages and performs
-        actions based on the received data. The actions include responding
-        to specific commands, executing camera operations, and controlling
-        the camera settings.
+        Control commands are answered at once, commands using the camera are
+        serialized. Queued focus and preview commands are replaced by newer ones.
+        """
+        d = self.__dispatcher
+        d.register('Moin', lambda arg, addr: None)
+        d.register('search', lambda arg, addr: self.__answer(
+            addr[0], 'Moin:'+socket.gethostname()))
+        d.register('settings', self.__settings_command)
+        d.register('pause', lambda arg, addr: self.pause())
+        d.register('resume', lambda arg, addr: self.resume())
+        d.register('shutdown', lambda arg, addr: self.shutdown())
+        d.register('reboot', self.__reboot_command)
+        d.register('restart', self.__restart_command)
+        d.register('update', self.__update_command)
+        d.register('aruco', lambda arg, addr: self.__aruco_broadcast(
+            addr, arg), hardware=True)
+        d.register('focus', self.__focus_command,
+                   hardware=True, supersede=True)
+        d.register('photo', self.__take_photo, hardware=True)
+        d.register('trigger', self.__trigger_command, hardware=True)
+        d.register('stack', self.__stack_command, hardware=True)
+        d.register('preview', lambda arg, addr: self.preview(
+            {'focus': -2}), hardware=True, supersede=True)
+
+    def __receive_broadcast(self):
+        """
+        Receives broadcast messages and hands them to the dispatcher.
 
+        Acknowledgements and repeated messages are handled by the channel.
         The method runs in an infinite loop until the program is terminated.
 
         Returns:
             None
         """
         while True:
-            data, addr = self.__sock.recvfrom(1024)
-            data = data.decode("utf-8")
-            Logger().info("%s %s", addr, data)
-            if data[:4] == 'Moin':
-                pass
-            elif data == 'search':
-                self.__answer(addr[0], 'Moin:'+socket.gethostname())
-            elif data[0:6] == 'aruco:':
-                # Thread(target=self.aruco_broadcast,
-                #       args=(addr, data[6:])).start()
-                self.__aruco_broadcast(addr, data[6:])
-            elif data[0:5] == 'focus':
-                z = -1
-                try:
-                    z = float(data[6:])
-                except ValueError:
-                    pass
-                Logger().info("Focus: %s", z)
-                self.focus(z)  # Autofokus
-            elif data[:5] == 'photo':
-                Logger().info("Einstellung %s", data[6:])
-                self.__take_photo(data, addr)
-            elif data[:5] == 'stack':
-                Logger().info("Fokusstack: %s", data[6:])
-                filename = data[6:]
-                self.__take_focusstack(filename, addr)
-            elif data[:8] == 'settings':
-                Logger().info("Einstellung %s", data[9:])
-                jsonSettings: CamSettings
-                try:
-                    jsonSettings = json_loads(data[9:])
-                except JSONDecodeError:
-                    jsonSettings = {}
-                self.set_settings(jsonSettings)
-            elif data == 'preview':
-                self.preview({'focus': -2})  # preview
-            elif data == 'shutdown':
-                self.shutdown()
-            elif data == 'pause':
-                self.pause()
-            elif data == 'resume':
-                self.resume()
-            elif data == 'reboot':
-                system("sleep 5s; sudo reboot")
-                Logger().info("Reboot Raspberry...")
-                exit(0)
-            elif data == 'restart':
-                system("systemctl restart PhotoBoxCamera.service")
-                Logger().info("Restart Script...")
-                exit(1)
-            elif data == 'update':
-                Logger().info("Update Script...")
-                system("sudo git -C /home/photo/PhotoBox pull")
-            else:
-                Logger().warning("Unknown command: %s", data)
-
-    def __take_focusstack(self, id: str, addr: tuple[str, int]):
+            for envelope, addr in self.__endpoint.receive():
+                data = envelope.payload.decode("utf-8")
+                Logger().info("%s %s", addr, data)
+                self.__dispatcher.dispatch(data, addr)
+
+    def stats(self) -> CommandStats:
+        return self.__dispatcher.get_stats()
+
+    def messaging_stats(self) -> MessagingStats:
+        return self.__endpoint.get_stats()
+
+    def aruco_stats(self) -> ArucoWorkerStats:
+        return self.__cam.aruco_stats()
+
+    def __focus_command(self, arg: str, addr: tuple[str, int]):
+        z = -1
+        try:
+            z = float(arg)
+        except ValueError:
+            pass
+        Logger().info("Focus: %s", z)
+        self.focus(z)  # Autofokus
+
+    def __stack_command(self, arg: str, addr: tuple[str, int]):
+        """
+        Takes a focus stack, arg is '<id>' or '<id>:<lens positions separated by commas>[:fused]'.
+        """
+        Logger().info("Fokusstack: %s", arg)
+        id, _, focus = arg.partition(':')
+        focus, _, mode = focus.partition(':')
+        if focus == "":
+            focus = Conf().get()['kameras'].get('StackFocus', '1,2,4,5,7')
+        try:
+            positions = [float(f) for f in focus.split(',') if f.strip()]
+        except ValueError:
+            positions = []
+        if len(positions) == 0:
+            Logger().error("Invalid lens positions: %s", focus)
+            return
+        self.__take_focusstack(id, addr, positions, mode == 'fused')
+
+    def __settings_command(self, arg: str, addr: tuple[str, int]):
+        Logger().info("Einstellung %s", arg)
+        jsonSettings: CamSettings
+        try:
+            jsonSettings = json_loads(arg)
+        except JSONDecodeError:
+            jsonSettings = {}
+        self.set_settings(jsonSettings)
+
+    def __reboot_command(self, arg: str, addr: tuple[str, int]):
+        system("sleep 5s; sudo reboot")
+        Logger().info("Reboot Raspberry...")
+        exit(0)
+
+    def __restart_command(self, arg: str, addr: tuple[str, int]):
+        system("systemctl restart PhotoBoxCamera.service")
+        Logger().info("Restart Script...")
+        exit(1)
+
+    def __update_command(self, arg: str, addr: tuple[str, int]):
+        Logger().info("Update Script...")
+        system("sudo git -C /home/photo/PhotoBox pull")
+
+    def __take_focusstack(self, id: str, addr: tuple[str, int], positions: list[float], fused: bool = False):
         """
         Takes a focus stack of photos with different focus levels.
 
+        Each frame is announced as soon as it has been written, while the
+        lens already moves to the next position. A fused stack is stacked on
+        the camera, only the fused image and its sharpness map are announced
+        with the markers of the first frame the fused image is aligned to.
+
         Args:
-            filename (str): The base filename for the photos.
+            id (str): The ID of the stack, the base filename for the photos.
             addr (tuple[str, int]): The address to send the photo completion message.
+            positions (list[float]): The lens positions in dioptre.
+            fused (bool): Whether the stack is stacked on the camera.
 
         Returns:
             None
         """
 
-        metadata: dict[str, dict[str, Any]] = {}
+        def aruco_callback(data: list[ArucoMarkerPos], metadata: Metadata):
+            if fused and metadata.get('Timeline', {}).get('lens_position') != positions[0]:
+                return
+            self.__send_aruco_data(addr, id, data, metadata)
+
+        def frame_saved(filename: str, metadata: dict[str, Any]):
+            if not fused:
+                self.__answer(addr[0], 'photoDone:' + filename + ':' + filename)
 
-        for f in [1, 2, 4, 5, 7]:
-            filename = id + '_' + str(f) + '.jpg'
-            cs: CamSettingsWithFilename = {
-                'focus': f,
-                'filename': filename}
-            _, md = self.__save(cs)
-            metadata[filename] = md
-            self.__answer(addr[0], 'photoDone:' +
-                          filename + ':' + cs['filename'])
+        def stacked(image: str, sharpness: str):
+            self.__answer(addr[0], 'photoDone:' + id + ':' + image)
+            self.__answer(addr[0], 'photoDone:' + id + ':' + sharpness)
 
-        Logger().info("Focusstack: %s", metadata)
-        for f, m in metadata.items():
-            def aruco_callback(data: list[ArucoMarkerPos], metadata: Metadata):
-                self.__send_aruco_data(addr, id, data, metadata)
-            self.__cam.aruco_search_in_background_from_file(
-                f, m, aruco_callback)
+        timeline = self.__cam.save_stack(id, positions, aruco_callback, frame_saved)
+        Logger().info("Focusstack: %s", timeline)
+        if fused:
+            self.__stacker.stack(id, positions, stacked)
 
     def __take_photo(self, data: str, addr: tuple[str, int]):
         """
         Takes a photo with the camera.
 
         Args:
-            data (str): The data received via broadcast (filename, focus).
+            data (str): The data received via broadcast after 'photo:' (filename, focus).
             addr (tuple[str, int]): The address of the client.
 
         Returns:
             None
         """
+        Logger().info("Einstellung %s", data)
         json: CamSettingsWithFilename
         try:
-            json = json_loads(data[6:])
+            json = json_loads(data)
             id = json['filename']
             id = id[:id.rfind('.')]
         except JSONDecodeError:
-            json = {'filename': data[6:] + '.jpg'}
-            id = data[6:]
+            json = {'filename': data + '.jpg'}
+            id = data
 
         def aruco_callback(data: list[ArucoMarkerPos], metadata: Metadata):
             self.__send_aruco_data(addr, id, data, metadata)
         self.__save(json, aruco_callback)
         self.__answer(addr[0], 'photoDone:' + id + ':' + json['filename'])
 
-    def __answer(self, addr: str, msg: str):
+    def __trigger_command(self, arg: str, addr: tuple[str, int]):
+        """
+        Takes the photo of a scheduled trigger.
+
+        Args:
+            arg (str): '<id>:<target time>', the wall clock time of the capture in nanoseconds.
+            addr (tuple[str, int]): The address of the master.
+        """
+        id, _, target = arg.partition(':')
+        Logger().info("Trigger %s at %s", id, target)
+        settings: CamSettingsWithFilename = {'filename': id + '.jpg'}
+
+        def aruco_callback(data: list[ArucoMarkerPos], metadata: Metadata):
+            self.__send_aruco_data(addr, id, data, metadata)
+        self.__save(settings, aruco_callback, int(target))
+        self.__answer(addr[0], 'photoDone:' + id + ':' + settings['filename'])
+
+    def __answer(self, addr: str, msg: str | bytes):
         """
         Sends an answer message to the specified address.
 
+        The message is repeated until the master has acknowledged it.
+
         Args:
             addr (str): The address to send the message to.
-            msg (str): The message to send.
+            msg (str | bytes): The message to send.
 
         Returns:
             None
         """
-        Logger().info("Answer:  %s %s", addr, msg)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.sendto((msg).encode("utf-8"),
-                        (addr, int(Conf().get()['both']['BroadCastPort'])))
+        Logger().info("Answer:  %s %s", addr, msg[:100])
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+        self.__endpoint.send(msg, (addr, self.__port))
@@ -8,22 +8,30 @@
 
 # stream: https://github.com/raspberrypi/picamera2/issues/366#issuecomment-1285888051
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from json import dump
-from threading import Thread
+from threading import Lock
 from typing import Any, overload
-from cv2 import imread
 from camera.camera_aruco import Aruco
+from camera.aruco_worker import ArucoWorker
+from camera.focus_controller import FocusController
+from camera.photo_encoder import encode_jpeg, exif_data, frame_view
+from camera.stream import FrameStream
+from camera.trigger import ScheduledTrigger
 
 from picamera2 import Picamera2
 from picamera2.request import CompletedRequest
 from libcamera import controls  # type: ignore
-from time import sleep
-import piexif
+from time import perf_counter
+import numpy as np
+import numpy.typing as npt
+from cv2 import cvtColor, COLOR_YUV420p2BGR
 from socket import gethostname
-from common.typen import ArucoMarkerPos, CamSettings, CamSettingsOptionalFilename, CamSettingsWithFilename, Metadata
+from common.typen import ArucoMarkerPos, ArucoWorkerStats, CamSettings, CamSettingsOptionalFilename, CamSettingsWithFilename, Metadata, SaveTimings, StackFrameTimeline
 from typing import Callable
 from common.logger import Logger
+from common.conf import Conf
 
 
 class CameraInterface(object):
@@ -36,22 +44,32 @@ class CameraInterface(object):
     - __yuv_config: dict[str, Any]
     - __folder: str
     - __aruco: Aruco
+    - __aruco_worker: ArucoWorker
+    - __focus: FocusController
+    - __stream: FrameStream
+    - __capture_lock: Lock
+    - __trigger: ScheduledTrigger
     - __DEFAULT_CTRL: dict[str, Any]
 
     Methods:
     + __init__(folder: str)
     + make_picture(settings: CamSettings = {}, preview=False): bytes
-    + save_picture(settings: CamSettingsWithFilename, aruco_callback: None | Callable[[list[ArucoMarkerPos], dict[str, Any]], None]): tuple[str, dict[str, Any]]
+    + save_picture(settings: CamSettingsWithFilename, aruco_callback: None | Callable[[list[ArucoMarkerPos], dict[str, Any]], None], target_ns: int | None = None): tuple[str, dict[str, Any]]
+    + save_stack(id: str, positions: list[float], aruco_callback: None | Callable[[list[ArucoMarkerPos], dict[str, Any]], None], frame_saved: Callable[[str, dict[str, Any]], None]): list[StackFrameTimeline]
     + aruco_search_in_background_from_file(filename: str, metadata: dict[str, Any], aruco_callback: Callable[[list[ArucoMarkerPos], dict[str, Any]], None]): None
-    + aruco_search_in_background(img: bytes, file: str, metadata: dict[str, Any], aruco_callback: Callable[[list[ArucoMarkerPos], dict[str, Any]], None]): None
+    + aruco_search_in_background(img: bytes | None, file: str, metadata: dict[str, Any], aruco_callback: Callable[[list[ArucoMarkerPos], dict[str, Any]], None], session: str | None = None, reuse: bool = False): None
     + meta(): None | dict[str, Any]
     + find_aruco(inform_after_picture: None | Callable[[], None] = None): list[ArucoMarkerPos]
     + pause()
     + resume()
     + set_settings(settings: CamSettings): CamSettings
-    + focus(focus: float): str
+    + focus(focus: float, wait: bool = True): str
+    + wait_focus(): float | None
+    + aruco_stats(): ArucoWorkerStats
+    + get_stream(): FrameStream
     - __get_status(): dict[str, Any]
-    - __capture_photo(settings: CamSettings): tuple[CompletedRequest, dict[str, Any], CamSettings]
+    - __encode(buffer: npt.NDArray[np.uint8], config: dict[str, Any], metadata: dict[str, Any], file: str, timings: SaveTimings): None
+    - __capture_photo(settings: CamSettings, target_ns: int | None = None): tuple[CompletedRequest, dict[str, Any], CamSettings]
     - __request_capture_with_meta(): tuple[CompletedRequest, dict[str, Any]
 
     '''
@@ -82,55 +100,70 @@ class CameraInterface(object):
         }
         ctrl = self.__DEFAULT_CTRL.copy()
         ctrl["AnalogueGain"] = 1.0
+        conf = Conf().get()['kameras']
+        # the small stream of the live preview
         self.__rgb_config = self.__cam.create_still_configuration(
+            lores={"size": (conf.getint('StreamWidth', 640), conf.getint('StreamHeight', 360)),
+                   "format": "YUV420"},
             controls=ctrl)
         self.yuv_config = self.__cam.create_still_configuration(
             main={"format": "YUV420"}, controls=ctrl)
         self.__cam.configure(self.__rgb_config)  # type: ignore
         self.__cam.start()
         self.__folder = folder
-        self.__aruco = Aruco()
+        self.__aruco = Aruco(scale=conf.getint('ArucoScale', 2),
+                             use_rois=conf.getint('ArucoRoi', 1) == 1,
+                             full_every=conf.getint('ArucoFullEvery', 10))
+        self.__aruco_worker = ArucoWorker(self.__aruco.detect_from_rgb,
+                                          max_images=conf.getint('ArucoQueue', 2),
+                                          confident=conf.getint('ArucoConfident', 0))
+        self.__aruco_worker.start()
+        self.__focus = FocusController(
+            lambda position: self.__cam.set_controls(
+                {"AfMode": controls.AfModeEnum.Manual, "LensPosition": position}),
+            file=conf.get('FocusModel', folder + 'focus_model.json'),
+            tolerance=conf.getfloat('FocusTolerance', 0.01),
+            timeout=conf.getfloat('FocusTimeout', 1.0))
+        # the lens position of every frame is reported to the focus controller
+        self.__cam.pre_callback = lambda req: self.__focus.frame(req.get_metadata())
+        self.__capture_lock = Lock()
+        self.__stream = FrameStream(self.__capture_preview,
+                                    fps=conf.getfloat('StreamFps', 5),
+                                    quality=conf.getint('StreamQuality', 70))
+        self.__trigger = ScheduledTrigger(
+            lambda: self.__cam.capture_request(wait=True))  # type: ignore
 
     def make_picture(self, settings: CamSettings = {}, preview=False) -> bytes:
         data = BytesIO()
         Logger().info("Kamera aktiviert!")
-        req, metadata, settings = self.__capture_photo(settings)
-        req.save("main", data, format="jpeg")
+        with self.__capture_lock:
+            req, metadata, settings = self.__capture_photo(settings)
+            req.save("main", data, format="jpeg")
+            req.release()
         Logger().info("Fokus (real):  %s", metadata["LensPosition"])
-        req.release()
-        """
-        if metadata["LensPosition"] != 0:
-            focus = 1./metadata["LensPosition"]
-        else:
-            focus = 0
-        focus = int(focus*100)
-
-
-        exif_dict = piexif.load(data)
-        exif_dict["Exif"][piexif.ExifIFD.FocalLength] = (474, 100)
-        exif_dict["Exif"][piexif.ExifIFD.SubjectDistance] = (focus, 100)
-        exif_dict["Exif"][piexif.ExifIFD.BodySerialNumber] = gethostname()
-        exif_bytes = piexif.dump(exif_dict)
-        piexif.insert(exif_bytes, data)
-        """
-
         Logger().info("Bild gemacht!")
         data.seek(0)
         return data.read()
 
     @overload
     def __capture_photo(
-        self, settings: CamSettingsWithFilename) -> tuple[CompletedRequest, dict[str, Any], CamSettingsWithFilename]: ...
+        self, settings: CamSettingsWithFilename, target_ns: int | None = None) -> tuple[CompletedRequest, dict[str, Any], CamSettingsWithFilename]: ...
 
     @overload
     def __capture_photo(
-        self, settings: CamSettingsOptionalFilename) -> tuple[CompletedRequest, dict[str, Any], CamSettingsOptionalFilename]: ...
+        self, settings: CamSettingsOptionalFilename, target_ns: int | None = None) -> tuple[CompletedRequest, dict[str, Any], CamSettingsOptionalFilename]: ...
 
-    def __capture_photo(self, settings: CamSettings) -> tuple[CompletedRequest, dict[str, Any], CamSettings]:
+    def __capture_photo(self, settings: CamSettings, target_ns: int | None = None) -> tuple[CompletedRequest, dict[str, Any], CamSettings]:
+        # arm the camera before the trigger time
         self.resume()
         if settings:
             settings = self.set_settings(settings)
-        req, metadata = self.__request_capture_with_meta()
+        if target_ns is None:
+            req, metadata = self.__request_capture_with_meta()
+        else:
+            req, metadata, skew = self.__trigger.capture(target_ns)
+            metadata['TriggerSkew'] = skew
+            Logger().info("Trigger skew: %.2f ms", skew / 1e6)
         return req, metadata, settings
 
     def __request_capture_with_meta(self):
@@ -139,77 +172,172 @@ class CameraInterface(object):
         metadata: dict[str, Any] = req.get_metadata()
         return req, metadata
 
-    def save_picture(self, settings: CamSettingsWithFilename, aruco_callback: None | Callable[[list[ArucoMarkerPos], Metadata], None]) -> tuple[str, dict[str, Any]]:
+    def save_picture(self, settings: CamSettingsWithFilename, aruco_callback: None | Callable[[list[ArucoMarkerPos], Metadata], None], target_ns: int | None = None) -> tuple[str, dict[str, Any]]:
         """
         Capture a photo and save it to the given filename.
 
         Args:
             settings: The settings for the camera.
             aruco_callback: A callback function that is called with the Aruco markers found in the image.
+            target_ns: The wall clock time of a scheduled trigger in nanoseconds, None to capture at once.
 
         Returns:
-            The filename and the metadata of the saved image.
+            The filename and the metadata of the saved image, including the timings of the stages.
         """
         Logger().info("Kamera aktiviert!")
-        req, metadata, set = self.__capture_photo(settings)
+        t = perf_counter()
+        timings: SaveTimings = {'capture': 0., 'copy': 0., 'exif': 0.,
+                                'encode': 0., 'write': 0., 'total': 0.}
+        with self.__capture_lock:
+            req, metadata, set = self.__capture_photo(settings, target_ns)
+            timings['capture'] = (perf_counter() - t) * 1000
+
+            # the only copy of the frame, used for the JPEG and the Aruco search,
+            # the buffer is returned to the camera at once
+            s = perf_counter()
+            buffer, config = req.make_buffer("main"), req.config["main"]
+            req.release()
+            timings['copy'] = (perf_counter() - s) * 1000
 
         file = self.__folder + settings['filename']
         Logger().info("Fokus (real):  %s", metadata["LensPosition"])
-        req.save("main", file)
+
+        self.__encode(buffer, config, metadata, file, timings)
+        timings['total'] = (perf_counter() - t) * 1000
+        metadata['Timings'] = timings
+        Logger().info("Timings %s: %s", file, timings)
 
         if aruco_callback:
-            img = req.make_array("main")
             self.aruco_search_in_background(
-                img, file, metadata, aruco_callback)
+                frame_view(buffer, config), file, metadata, aruco_callback)
 
-        req.release()
+        Logger().info("Bild %s gemacht!", file)
+        return file, metadata
 
-        if metadata["LensPosition"] != 0:
-            focus = 1./metadata["LensPosition"]
-        else:
-            focus = 0
-        focus = int(focus*100)
+    def __encode(self, buffer: npt.NDArray[np.uint8], config: dict[str, Any], metadata: dict[str, Any], file: str, timings: SaveTimings) -> None:
+        """
+        Encodes a frame as JPEG with its EXIF data and writes it with a single write.
+
+        Args:
+            buffer: The frame buffer copied out of the request.
+            config: The configuration of the main stream with format, size and stride.
+            metadata: The metadata of the frame.
+            file: The file the JPEG is written to.
+            timings: Receives the durations of the exif, encode and write stages.
+        """
+        s = perf_counter()
+        exif = exif_data(metadata, self.__cam.camera.id, gethostname())
+        timings['exif'] = (perf_counter() - s) * 1000
 
-        # Add focal length to EXIF data
-        exif_dict = piexif.load(file)
-        exif_dict["Exif"][piexif.ExifIFD.FocalLength] = (474, 100)
-        exif_dict["Exif"][piexif.ExifIFD.SubjectDistance] = (focus, 100)
-        exif_dict["Exif"][piexif.ExifIFD.BodySerialNumber] = gethostname()
-        exif_bytes = piexif.dump(exif_dict)
-        piexif.insert(exif_bytes, file)
+        s = perf_counter()
+        data = encode_jpeg(buffer, config, exif, self.__cam.options.get("quality", 90))
+        timings['encode'] = (perf_counter() - s) * 1000
 
-        Logger().info("Bild %s gemacht!", file)
-        return file, metadata
+        s = perf_counter()
+        with open(file, "wb") as f:
+            f.write(data)
+        timings['write'] = (perf_counter() - s) * 1000
+
+    def save_stack(self, id: str, positions: list[float], aruco_callback: None | Callable[[list[ArucoMarkerPos], Metadata], None], frame_saved: Callable[[str, dict[str, Any]], None]) -> list[StackFrameTimeline]:
+        """
+        Captures a focus stack, a frame is encoded while the lens moves to the next position.
+
+        The lens is sent to the next position as soon as a frame has been
+        copied out of its request. At most two frames wait for the encoder,
+        so the capture does not run out of memory when encoding is slower.
+
+        Args:
+            id: The ID of the stack, the frames are saved as <id>_<lens position>.jpg.
+            positions: The lens positions in dioptre.
+            aruco_callback: A callback function that is called with the Aruco markers found in a frame.
+            frame_saved: Called with the filename and the metadata of each frame after it has been written.
+
+        Returns:
+            The timeline of the frames, it is also written to <id>.stack.json.
+        """
+        self.resume()
+        start = perf_counter()
+
+        def ms() -> float:
+            return (perf_counter() - start) * 1000
+
+        def encode(buffer: npt.NDArray[np.uint8], config: dict[str, Any], metadata: dict[str, Any],
+                   filename: str, timeline: StackFrameTimeline) -> None:
+            file = self.__folder + filename
+            timings: SaveTimings = {'capture': timeline['captured'] - timeline['moved'],
+                                    'copy': 0., 'exif': 0., 'encode': 0., 'write': 0., 'total': 0.}
+            timeline['encoding'] = ms()
+            self.__encode(buffer, config, metadata, file, timings)
+            timeline['written'] = ms()
+            timings['total'] = timeline['written'] - timeline['moved']
+            metadata['Timings'] = timings
+            metadata['Timeline'] = timeline
+            frame_saved(filename, metadata)
+            if aruco_callback:
+                self.aruco_search_in_background(
+                    frame_view(buffer, config), file, metadata, aruco_callback, id, reuse=True)
+
+        timelines: list[StackFrameTimeline] = []
+        pending: list[Future] = []
+        with self.__capture_lock, ThreadPoolExecutor(max_workers=1, thread_name_prefix="Encoder") as encoder:
+            self.__focus.move(positions[0])
+            moved = ms()
+            for i, position in enumerate(positions):
+                settle = self.__focus.wait()
+                timeline: StackFrameTimeline = {
+                    'lens_position': position, 'moved': moved, 'settled': ms(),
+                    'reached': settle is not None, 'captured': 0., 'encoding': 0., 'written': 0.}
+                while len(pending) >= 2:
+                    pending.pop(0).result()
+                req, metadata = self.__request_capture_with_meta()
+                buffer, config = req.make_buffer("main"), req.config["main"]
+                req.release()
+                timeline['captured'] = ms()
+                if i + 1 < len(positions):
+                    self.__focus.move(positions[i + 1])
+                    moved = ms()
+                Logger().info("Fokus (real):  %s", metadata["LensPosition"])
+                pending.append(encoder.submit(
+                    encode, buffer, config, metadata, f"{id}_{position:g}.jpg", timeline))
+                timelines.append(timeline)
+            for future in pending:
+                future.result()
+
+        with open(self.__folder + id + ".stack.json", "w") as f:
+            dump(timelines, f, indent=2)
+        Logger().info("Fokusstack %s in %.0f ms", id, ms())
+        return timelines
 
     def aruco_search_in_background_from_file(self, filename: str, metadata: dict[str, Any], aruco_callback: Callable[[list[ArucoMarkerPos], Metadata], None]) -> None:
         """
-        Start a background thread that searches for Aruco markers in the given image file.
+        Queue the given image file for the search for Aruco markers, it is read when it is searched.
 
         Args:
             file: The filename of the image to search for Aruco markers.
             metadata: The metadata of the image.
             aruco_callback: A callback function that is called with the Aruco markers found in the image.
         """
-        img = imread(self.__folder + filename)
-        return self.aruco_search_in_background(img, filename, metadata, aruco_callback)
+        return self.aruco_search_in_background(None, self.__folder + filename, metadata, aruco_callback)
 
-    def aruco_search_in_background(self, img: bytes, file: str, metadata: dict[str, Any], aruco_callback: Callable[[list[ArucoMarkerPos], Metadata], None]) -> None:
+    def aruco_search_in_background(self, img: bytes | None, file: str, metadata: dict[str, Any], aruco_callback: Callable[[list[ArucoMarkerPos], Metadata], None], session: str | None = None, reuse: bool = False) -> None:
         """
-        Start a background thread that searches for Aruco markers in the given image.
+        Queue the given image for the search for Aruco markers in the background.
 
         Args:
-            img: The image to search for Aruco markers.
+            img: The image to search for Aruco markers, None to read the file.
             file: The filename of the image.
             metadata: The metadata of the image.
             aruco_callback: A callback function that is called with the Aruco markers found in the image.
+            session: The ID of the capture, the newest one is searched first. Defaults to the filename.
+            reuse: A boolean indicating if the Aruco markers of another frame of the session at the same lens position can be used.
         """
 
-        def aruco_search(self, img, aruco_callback: Callable[[list[ArucoMarkerPos], dict[str, Any]], None]):
-            aruco_marker = self.__aruco.detect_from_rgb(img)
-            dump(aruco_marker, open(file + ".aruco", "w"), indent=2)
+        def aruco_found(aruco_marker: list[ArucoMarkerPos], metadata: Metadata):
+            with open(file + ".aruco", "w") as f:
+                dump(aruco_marker, f, indent=2)
             aruco_callback(aruco_marker, metadata)
-        Thread(target=aruco_search, args=(self,
-                                          img, aruco_callback), name="Aruco").start()
+        self.__aruco_worker.submit(session or file, file, metadata, aruco_found,
+                                   image=img, reuse=reuse)  # type: ignore
 
     def meta(self) -> dict[str, Any]:
         self.resume()
@@ -252,7 +380,15 @@ class CameraInterface(object):
 
         return settings
 
-    def focus(self, focus: float) -> str:
+    def focus(self, focus: float, wait: bool = True) -> str:
+        """
+        Sets the focus of the camera.
+
+        Args:
+            focus: The lens position in dioptre, -1 for the autofocus, -2 to keep the focus.
+            wait: A boolean indicating if it waits until a frame has reached a lens position.
+                Otherwise wait_focus() has to be called before the capture.
+        """
         if (focus == -2):
             Logger().info("Fokus nicht verändern")
             pass
@@ -262,16 +398,20 @@ class CameraInterface(object):
             # self.cam.autofocus_cycle()
         else:
             Logger().info("Fokus (soll): %s", focus)
-            self.__cam.set_controls(
-                {"AfMode": controls.AfModeEnum.Manual, "LensPosition": focus})
-            for i in range(10):
-                m = self.__cam.capture_metadata()
-                if abs(m["LensPosition"] - focus) < 0.01:  # type: ignore
-                    Logger().info("Fokus erreicht nach  %s s", i*0.1)
-                    break
-                sleep(0.1)
+            self.__focus.move(focus)
+            if wait:
+                self.__focus.wait()
         return "Fokus"
 
+    def wait_focus(self) -> float | None:
+        """
+        Waits until a frame has reached the lens position of the last focus.
+
+        Returns:
+            The settle time in s or None if the position has not been reached.
+        """
+        return self.__focus.wait()
+
     def __get_status(self) -> dict[str, Any]:
         return self.__cam.camera_properties
 
@@ -281,20 +421,49 @@ class CameraInterface(object):
 
         _, _, w, h = self.__cam.camera_properties['ScalerCropMaximum']
 
-        if not self.__cam.started:
-            self.__cam.start(self.yuv_config)
-            req, meta = self.__request_capture_with_meta()
-            image = req.make_array('main')[:h, :w]
-            req.release()
-        else:
-            image = self.__cam.switch_mode_and_capture_array(  # type: ignore
-                self.yuv_config, 'main', wait=True)[:h, :w]
+        with self.__capture_lock:
+            if not self.__cam.started:
+                self.__cam.start(self.yuv_config)
+                req, meta = self.__request_capture_with_meta()
+                image = req.make_array('main')[:h, :w]
+                req.release()
+            else:
+                image = self.__cam.switch_mode_and_capture_array(  # type: ignore
+                    self.yuv_config, 'main', wait=True)[:h, :w]
 
         Logger().info("Aruco Bild gemacht!")
         if inform_after_picture is not None:
             inform_after_picture()
         return self.__aruco.detect(image)
 
+    def __capture_preview(self) -> npt.NDArray[np.uint8] | None:
+        """
+        Captures a frame of the small stream for the live preview.
+
+        Returns:
+            The BGR frame or None if a photo is being taken or the camera is paused.
+        """
+        if not self.__capture_lock.acquire(blocking=False):
+            return None
+        try:
+            if not self.__cam.started:
+                return None
+            yuv = self.__cam.capture_array("lores")
+        finally:
+            self.__capture_lock.release()
+        return cvtColor(yuv, COLOR_YUV420p2BGR)
+
+    def get_stream(self) -> FrameStream:
+        """
+        Returns the live preview of the camera.
+        """
+        return self.__stream
+
+    def aruco_stats(self) -> ArucoWorkerStats:
+        stats = self.__aruco_worker.get_stats()
+        stats['detections'] = self.__aruco.get_stats()
+        return stats
+
     def pause(self):
         if self.__cam.started:
             self.__cam.stop()
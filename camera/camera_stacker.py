@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from shutil import copyfile
+from socket import gethostname
+from typing import Callable
+
+import numpy as np
+import piexif
+from cv2 import IMWRITE_JPEG_QUALITY, INTER_NEAREST, imread, imwrite, resize
+
+from common.focus_stack import HomographyCache, focus_stack_index
+from common.logger import Logger
+
+
+class CameraStacker:
+    '''
+    Stacks the focus stacks on the camera, so only the fused image is sent to the master.
+
+    The stacks are processed one after another in a background thread, the
+    frames are read from their files one at a time. Besides the fused image
+    <id>.jpg with the EXIF data of the first frame, a small gray sharpness
+    map <id>_sharpness.png is written: the frame each pixel is taken from,
+    0 for the first and 255 for the last frame. The frames stay on the
+    camera and can still be downloaded.
+
+    Attributes:
+    - __folder: str, the folder of the frames
+    - __hostname: str, the key of the cached homographies
+    - __tile_rows: int, the height of the tiles of the merge, 0 for the whole image
+    - __map_width: int, the width of the sharpness map
+    - __homographies: HomographyCache
+    - __executor: ThreadPoolExecutor
+
+    Methods:
+    - stack(id: str, positions: list[float], done: Callable[[str, str], None]) -> Future
+    - shutdown() -> None
+    '''
+
+    def __init__(self, folder: str, tile_rows: int = 0, map_width: int = 640,
+                 hostname: str = gethostname()):
+        self.__folder = folder
+        self.__hostname = hostname
+        self.__tile_rows = tile_rows
+        self.__map_width = map_width
+        self.__homographies = HomographyCache(folder + "homographies.json")
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Stacker")
+
+    def stack(self, id: str, positions: list[float], done: Callable[[str, str], None]) -> Future:
+        '''
+        Queues a focus stack whose frames <id>_<lens position>.jpg have been written.
+
+        Args:
+            id: The ID of the stack.
+            positions: The lens positions of the frames, the first frame is the base.
+            done: Called with the filenames of the fused image and the sharpness map.
+                If the stacking fails, the fused image is a copy of the first frame.
+        '''
+        return self.__executor.submit(self.__stack, id, positions, done)
+
+    def __stack(self, id: str, positions: list[float], done: Callable[[str, str], None]) -> None:
+        files = [self.__folder + f"{id}_{p:g}.jpg" for p in positions]
+        fused = id + ".jpg"
+        sharpness = id + "_sharpness.png"
+        try:
+            homographies = self.__homographies.get(self.__hostname)
+            merged, index = focus_stack_index(
+                (imread(f) for f in files), self.__tile_rows, positions, homographies)
+            self.__homographies.update(self.__hostname, homographies)
+            imwrite(self.__folder + fused, merged, [IMWRITE_JPEG_QUALITY, 95])
+            try:
+                piexif.transplant(files[0], self.__folder + fused)
+            except ValueError:
+                Logger().warning("No EXIF data in %s", files[0])
+            del merged
+            scale = 255 / max(1, len(positions) - 1)
+            small = resize(index, (self.__map_width, index.shape[0] * self.__map_width // index.shape[1]),
+                           interpolation=INTER_NEAREST)
+            imwrite(self.__folder + sharpness, np.round(small * scale).astype(np.uint8))
+            Logger().info("Fokusstack %s gestackt", id)
+        except Exception as e:
+            Logger().error("Error stacking %s: %s", id, e)
+            copyfile(files[0], self.__folder + fused)
+            imwrite(self.__folder + sharpness, np.zeros((1, 1), dtype=np.uint8))
+        done(fused, sharpness)
+
+    def shutdown(self) -> None:
+        '''
+        Waits for the queued stacks.
+        '''
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, NamedTuple
+
+from common.logger import Logger
+from common.typen import CommandLatency, CommandStats
+
+Handler = Callable[[str, tuple[str, int]], None]
+
+
+class Command(NamedTuple):
+    """
+    Represents a command received from the master.
+
+    Attributes:
+        name (str): The name of the command, e.g. 'photo'.
+        arg (str): The data after the name.
+        addr (tuple[str, int]): The address of the sender.
+        received (float): The monotonic time the command has been received.
+    """
+    name: str
+    arg: str
+    addr: tuple[str, int]
+    received: float
+
+
+class CommandDispatcher:
+    """
+    Dispatches the commands of the master.
+
+    Control commands are executed directly in the receiving thread, so they
+    are not blocked by a running capture. Commands using the camera hardware
+    are executed one after another by a worker thread. A queued command that
+    has not been started yet is dropped if a newer command of the same kind
+    supersedes it.
+
+    Attributes:
+        __handlers (dict[str, Handler]): The handlers by command name.
+        __hardware (set[str]): The commands executed by the worker thread.
+        __supersede (set[str]): The commands replaced by newer ones of the same kind.
+        __queue (deque[Command]): The queued hardware commands.
+
+    Methods:
+        register(name: str, handler: Handler, hardware: bool = False, supersede: bool = False): None
+        dispatch(data: str, addr: tuple[str, int]): None
+        get_stats(): CommandStats
+    """
+
+    def __init__(self):
+        """
+        Initializes the CommandDispatcher object and starts the worker thread.
+        """
+        self.__handlers: dict[str, Handler] = {}
+        self.__hardware: set[str] = set()
+        self.__supersede: set[str] = set()
+        self.__queue: deque[Command] = deque()
+        self.__condition = Condition()
+        self.__running: Command | None = None
+
+        self.__count: dict[str, int] = {}
+        self.__cancelled: dict[str, int] = {}
+        self.__wait_time: dict[str, float] = {}
+        self.__run_time: dict[str, float] = {}
+        self.__max_latency: dict[str, float] = {}
+
+        Thread(target=self.__work, name="CameraHardware", daemon=True).start()
+
+    def register(self, name: str, handler: Handler, hardware: bool = False,
+                 supersede: bool = False) -> None:
+        """
+        Registers the handler of a command.
+
+        Args:
+            name: The name of the command.
+            handler: Called with the argument and the address of the sender.
+            hardware: True if the command uses the camera and has to be serialized.
+            supersede: True if a queued command is dropped when a newer one arrives.
+        """
+        self.__handlers[name] = handler
+        if hardware:
+            self.__hardware.add(name)
+        if supersede:
+            self.__supersede.add(name)
+
+    def dispatch(self, data: str, addr: tuple[str, int]) -> None:
+        """
+        Executes a control command or queues a hardware command.
+
+        Args:
+            data: The received message, '<name>:<argument>' or '<name>'.
+            addr: The address of the sender.
+        """
+        name, _, arg = data.partition(':')
+        if name not in self.__handlers:
+            Logger().warning("Unknown command: %s", data)
+            return
+        command = Command(name, arg, addr, monotonic())
+        if name not in self.__hardware:
+            self.__execute(command)
+            return
+        with self.__condition:
+            if name in self.__supersede:
+                for old in [c for c in self.__queue if c.name == name]:
+                    Logger().info("Command superseded: %s %s",
+                                  old.name, old.arg)
+                    self.__queue.remove(old)
+                    self.__cancelled[name] = self.__cancelled.get(name, 0) + 1
+            self.__queue.append(command)
+            self.__condition.notify()
+
+    def __work(self) -> None:
+        """
+        Main loop of the worker thread executing the hardware commands.
+        """
+        while True:
+            with self.__condition:
+                while len(self.__queue) == 0:
+                    self.__condition.wait()
+                self.__running = self.__queue.popleft()
+            self.__execute(self.__running)
+            with self.__condition:
+                self.__running = None
+
+    def __execute(self, command: Command) -> None:
+        """
+        Executes a command and records its timing.
+        """
+        started = monotonic()
+        try:
+            self.__handlers[command.name](command.arg, command.addr)
+        except Exception as e:
+            Logger().error("Error executing %s: %s", command.name, e)
+        finished = monotonic()
+        with self.__condition:
+            name = command.name
+            self.__count[name] = self.__count.get(name, 0) + 1
+            self.__wait_time[name] = self.__wait_time.get(name, 0) + \
+                started - command.received
+            self.__run_time[name] = self.__run_time.get(name, 0) + \
+                finished - started
+            self.__max_latency[name] = max(self.__max_latency.get(name, 0),
+                                           finished - command.received)
+
+    def get_stats(self) -> CommandStats:
+        """
+        Returns the queue depth and the latencies of the commands.
+
+        Returns:
+            The statistics of the dispatcher.
+        """
+        with self.__condition:
+            commands: dict[str, CommandLatency] = {}
+            for name in set(self.__count) | set(self.__cancelled):
+                count = self.__count.get(name, 0)
+                commands[name] = {
+                    'count': count,
+                    'cancelled': self.__cancelled.get(name, 0),
+                    'avg_wait': self.__wait_time.get(name, 0) / max(count, 1),
+                    'avg_run': self.__run_time.get(name, 0) / max(count, 1),
+                    'max_latency': self.__max_latency.get(name, 0)}
+            return {'queue_depth': len(self.__queue),
+                    'running': self.__running.name if self.__running else None,
+                    'commands': commands}
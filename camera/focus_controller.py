@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from json import dump, load
+from threading import Condition
+from time import perf_counter
+from typing import Any, Callable
+
+from common.logger import Logger
+from common.typen import FocusModel
+
+# weight of the previous moves in the model, older moves are forgotten
+DECAY = 0.95
+# settle time of a move without learned moves: offset in s and s per dioptre
+DEFAULT_OFFSET = 0.1
+DEFAULT_SLOPE = 0.05
+
+
+class FocusController:
+    """
+    Moves the lens to manual positions and waits until a frame reports the position.
+
+    The camera reports the LensPosition of every frame to frame(). A move
+    only sends the new position to the camera, so the next position can be
+    set while the previous frame is still being encoded; wait() returns as
+    soon as a frame has reached it. The settle time of the lens is learned
+    as offset + slope * distance and limits the wait, a lens that does not
+    reach its position in time is reported instead of blocking the capture.
+
+    Attributes:
+        __set_lens (Callable[[float], None]): Sends a manual lens position to the camera.
+        __file (str | None): The JSON file the model is kept in.
+        __tolerance (float): The distance in dioptre a position counts as reached.
+        __timeout (float): The maximum wait in s.
+        __clock (Callable[[], float]): The clock of the settle times in s.
+        __condition (Condition): Signals the frames.
+        __position (float | None): The lens position of the last frame.
+        __target (float | None): The position of the last move.
+        __start (float): The time of the last move.
+        __distance (float | None): The distance of the last move, None if unknown.
+        __reached (float | None): The time the last move was reached.
+        __model (FocusModel): The sums of the learned moves.
+
+    Methods:
+        frame(metadata: dict[str, Any]): None
+        move(position: float): float
+        wait(): float | None
+        focus(position: float): float | None
+        predict(distance: float): float
+        get_model(): FocusModel
+    """
+
+    def __init__(self, set_lens: Callable[[float], None], file: str | None = None,
+                 tolerance: float = 0.01, timeout: float = 1.,
+                 clock: Callable[[], float] = perf_counter):
+        """
+        Initializes the FocusController object, a saved model is loaded.
+
+        Args:
+            set_lens: Sends a manual lens position to the camera.
+            file: The JSON file the model is kept in, None to not keep it.
+            tolerance: The distance in dioptre a position counts as reached.
+            timeout: The maximum wait in s.
+            clock: The clock of the settle times in s.
+        """
+        self.__set_lens = set_lens
+        self.__file = file
+        self.__tolerance = tolerance
+        self.__timeout = timeout
+        self.__clock = clock
+        self.__condition = Condition()
+        self.__position: float | None = None
+        self.__target: float | None = None
+        self.__start = 0.
+        self.__distance: float | None = None
+        self.__reached: float | None = None
+        self.__model: FocusModel = {'n': 0., 'x': 0., 'y': 0., 'xx': 0., 'xy': 0.}
+        if file is not None:
+            try:
+                with open(file) as f:
+                    self.__model = FocusModel(**load(f))
+            except (OSError, ValueError, TypeError) as e:
+                Logger().info("No focus model loaded: %s", e)
+
+    def frame(self, metadata: dict[str, Any]) -> None:
+        """
+        Reports the metadata of a frame, called by the camera for every frame.
+        """
+        if 'LensPosition' not in metadata:
+            return
+        with self.__condition:
+            self.__position = metadata['LensPosition']
+            if self.__target is not None and self.__reached is None and \
+                    abs(self.__position - self.__target) < self.__tolerance:  # type: ignore
+                self.__reached = self.__clock()
+                self.__condition.notify_all()
+
+    def move(self, position: float) -> float:
+        """
+        Sends a lens position to the camera without waiting.
+
+        Args:
+            position: The lens position in dioptre.
+
+        Returns:
+            The predicted settle time in s.
+        """
+        with self.__condition:
+            self.__start = self.__clock()
+            self.__target = position
+            self.__distance = None if self.__position is None else abs(position - self.__position)
+            self.__reached = self.__start if self.__distance is not None and \
+                self.__distance < self.__tolerance else None
+        self.__set_lens(position)
+        return self.predict(self.__distance or 0.)
+
+    def wait(self) -> float | None:
+        """
+        Waits until a frame has reached the position of the last move.
+
+        Returns:
+            The settle time in s or None if the position has not been reached.
+        """
+        with self.__condition:
+            if self.__target is None:
+                return 0.
+            predicted = self.predict(self.__distance or 0.)
+            # a slow move is not cut off by a wrong prediction
+            timeout = self.__timeout if self.__distance is None else \
+                min(self.__timeout, 3 * predicted + 0.2)
+            remaining = self.__start + timeout - self.__clock()
+            if not self.__condition.wait_for(lambda: self.__reached is not None, max(0., remaining)):
+                Logger().warning("Lens position %s not reached after %.2f s, at %s",
+                                 self.__target, timeout, self.__position)
+                return None
+            settle = self.__reached - self.__start  # type: ignore
+            distance = self.__distance
+            self.__distance = None
+        if distance is not None and distance >= self.__tolerance:
+            self.__learn(distance, settle)
+        Logger().info("Fokus erreicht nach %.3f s (erwartet %.3f s)", settle, predicted)
+        return settle
+
+    def focus(self, position: float) -> float | None:
+        """
+        Moves the lens to a position and waits until it has been reached.
+
+        Args:
+            position: The lens position in dioptre.
+
+        Returns:
+            The settle time in s or None if the position has not been reached.
+        """
+        self.move(position)
+        return self.wait()
+
+    def predict(self, distance: float) -> float:
+        """
+        The expected settle time of a move.
+
+        Args:
+            distance: The distance of the move in dioptre.
+
+        Returns:
+            The settle time in s.
+        """
+        if distance < self.__tolerance:
+            return 0.
+        offset, slope = self.__fit()
+        return max(0., offset + slope * distance)
+
+    def __fit(self) -> tuple[float, float]:
+        """
+        The offset and slope of the settle time, least squares of the learned moves.
+        """
+        m = self.__model
+        if m['n'] < 1:
+            return DEFAULT_OFFSET, DEFAULT_SLOPE
+        var = m['n'] * m['xx'] - m['x'] ** 2
+        if m['n'] < 2 or var < 1e-6 * m['n'] ** 2:
+            # all moves had the same distance
+            return m['y'] / m['n'] - DEFAULT_SLOPE * m['x'] / m['n'], DEFAULT_SLOPE
+        slope = (m['n'] * m['xy'] - m['x'] * m['y']) / var
+        return (m['y'] - slope * m['x']) / m['n'], slope
+
+    def __learn(self, distance: float, settle: float) -> None:
+        with self.__condition:
+            m = self.__model
+            for key, value in [('n', 1.), ('x', distance), ('y', settle),
+                               ('xx', distance * distance), ('xy', distance * settle)]:
+                m[key] = m[key] * DECAY + value  # type: ignore
+            model = FocusModel(**m)
+        if self.__file is not None:
+            try:
+                with open(self.__file, 'w') as f:
+                    dump(model, f)
+            except OSError as e:
+                Logger().warning("Focus model not saved: %s", e)
+
+    def get_model(self) -> FocusModel:
+        """
+        Returns the sums of the learned moves.
+        """
+        with self.__condition:
+            return FocusModel(**self.__model)
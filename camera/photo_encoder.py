@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from datetime import datetime
+from io import BytesIO
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+import piexif
+from PIL import Image
+
+# raw modes of PIL for the RGB formats of the camera, as in the Picamera2 helpers
+RAW_MODES = {"RGB888": "BGR", "BGR888": "RGB"}
+
+
+def frame_view(buffer: npt.NDArray[np.uint8], config: dict[str, Any]) -> npt.NDArray[np.uint8]:
+    '''
+    The image of a frame buffer as a (height, width, 3) array without copying it.
+
+    The rows keep the padding of the camera buffer, the array is a view with
+    the stride of the stream, OpenCV reads it without a copy as well.
+
+    Args:
+        buffer: The flat frame buffer of the stream, e.g. of CompletedRequest.make_buffer.
+        config: The configuration of the stream with format, size and stride.
+
+    Returns:
+        The image, it shares the memory of the buffer.
+    '''
+    if config["format"] not in RAW_MODES:
+        raise ValueError("Format " + config["format"] + " not supported")
+    w, h = config["size"]
+    return np.ndarray((h, w, 3), dtype=np.uint8, buffer=buffer, strides=(config["stride"], 3, 1))
+
+
+def exif_data(metadata: dict[str, Any], model: str, hostname: str,
+              now: datetime | None = None) -> dict[str, dict[int, Any]]:
+    '''
+    The EXIF data of a photo: the tags Picamera2 writes, completed by the tags of the PhotoBox.
+
+    Args:
+        metadata: The metadata of the frame.
+        model: The camera model, the id of the camera as used by Picamera2.
+        hostname: The hostname of the camera, stored as serial number.
+        now: The time of the photo, defaults to now.
+
+    Returns:
+        The EXIF data in the format of piexif.
+    '''
+    timestamp = (now or datetime.now()).strftime("%Y:%m:%d %H:%M:%S")
+    if metadata.get("LensPosition", 0) != 0:
+        focus = int(100. / metadata["LensPosition"])
+    else:
+        focus = 0
+    gain = metadata.get("AnalogueGain", 1.) * metadata.get("DigitalGain", 1.)
+    return {
+        "0th": {piexif.ImageIFD.Make: "Raspberry Pi",
+                piexif.ImageIFD.Model: model,
+                piexif.ImageIFD.Software: "Picamera2",
+                piexif.ImageIFD.DateTime: timestamp},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: timestamp,
+                 piexif.ExifIFD.ExposureTime: (metadata.get("ExposureTime", 0), 1000000),
+                 piexif.ExifIFD.ISOSpeedRatings: int(gain * 100),
+                 piexif.ExifIFD.FocalLength: (474, 100),
+                 piexif.ExifIFD.SubjectDistance: (focus, 100),
+                 piexif.ExifIFD.BodySerialNumber: hostname}}
+
+
+def encode_jpeg(buffer: npt.NDArray[np.uint8], config: dict[str, Any],
+                exif: dict[str, dict[int, Any]], quality: int = 90) -> bytes:
+    '''
+    Encodes a frame buffer as JPEG with its EXIF data.
+
+    PIL reads the rows directly from the buffer with the stride of the
+    stream, the padding is not copied away first.
+
+    Args:
+        buffer: The flat frame buffer of the stream.
+        config: The configuration of the stream with format, size and stride.
+        exif: The EXIF data in the format of piexif.
+        quality: The JPEG quality.
+
+    Returns:
+        The JPEG.
+    '''
+    if config["format"] not in RAW_MODES:
+        raise ValueError("Format " + config["format"] + " not supported")
+    img = Image.frombuffer("RGB", tuple(config["size"]), buffer, "raw",
+                           RAW_MODES[config["format"]], config["stride"], 1)
+    data = BytesIO()
+    img.save(data, format="jpeg", quality=quality, exif=piexif.dump(exif))
+    return data.getvalue()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+
+class SimulatedRequest:
+    """
+    A completed request of the simulated camera.
+
+    Methods:
+        get_metadata(): dict[str, Any]
+        make_array(name: str): npt.NDArray[np.uint8]
+        release(): None
+        is_released(): bool
+    """
+
+    def __init__(self, metadata: dict[str, Any], shape: tuple[int, int, int]):
+        self.__metadata = metadata
+        self.__shape = shape
+        self.__released = False
+
+    def get_metadata(self) -> dict[str, Any]:
+        return dict(self.__metadata)
+
+    def make_array(self, name: str) -> npt.NDArray[np.uint8]:
+        return np.zeros(self.__shape, dtype=np.uint8)
+
+    def release(self) -> None:
+        self.__released = True
+
+    def is_released(self) -> bool:
+        return self.__released
+
+
+class SimulatedCamera:
+    """
+    A camera without hardware delivering frames at a fixed rate on a virtual clock.
+
+    Frame k is exposed at phase + k * frame duration of the sensor clock.
+    Waiting for a frame advances the virtual clock to the end of that frame,
+    so the trigger logic can be tested without a Raspberry Pi and without sleeping.
+
+    Attributes:
+        __frame_duration (int): The time between two frames in nanoseconds.
+        __phase (int): The sensor time of the first frame in nanoseconds.
+        __wall_offset (int): The difference between wall clock and sensor clock in nanoseconds.
+        __now (int): The virtual sensor clock in nanoseconds.
+
+    Methods:
+        capture_request(): SimulatedRequest
+        clock_ns(): int
+        wall_ns(): int
+        advance(ns: int): None
+        get_requests(): list[SimulatedRequest]
+    """
+
+    def __init__(self, frame_duration_us: int = 33333, phase_ns: int = 0,
+                 wall_offset_ns: int = 1_700_000_000_000_000_000,
+                 shape: tuple[int, int, int] = (48, 64, 3)):
+        """
+        Initializes the SimulatedCamera object.
+
+        Args:
+            frame_duration_us: The time between two frames in microseconds.
+            phase_ns: The sensor time of the first frame in nanoseconds.
+            wall_offset_ns: The difference between wall clock and sensor clock in nanoseconds.
+            shape: The shape of the simulated images.
+        """
+        self.__frame_duration = frame_duration_us * 1000
+        self.__frame_duration_us = frame_duration_us
+        self.__phase = phase_ns
+        self.__wall_offset = wall_offset_ns
+        self.__shape = shape
+        self.__now = 0
+        self.__requests: list[SimulatedRequest] = []
+
+    def capture_request(self) -> SimulatedRequest:
+        """
+        Waits for the next frame exposed after the current virtual time.
+        """
+        k = max(0, -(-(self.__now - self.__phase) // self.__frame_duration))
+        ts = self.__phase + k * self.__frame_duration
+        # the frame is read out one frame duration after its timestamp
+        self.__now = ts + self.__frame_duration
+        req = SimulatedRequest({'SensorTimestamp': ts,
+                                'FrameDuration': self.__frame_duration_us,
+                                'LensPosition': 0.},
+                               self.__shape)
+        self.__requests.append(req)
+        return req
+
+    def clock_ns(self) -> int:
+        return self.__now
+
+    def wall_ns(self) -> int:
+        return self.__now + self.__wall_offset
+
+    def advance(self, ns: int) -> None:
+        """
+        Lets the virtual time pass, e.g. to simulate the delay of a message.
+        """
+        self.__now += ns
+
+    def get_requests(self) -> list[SimulatedRequest]:
+        return self.__requests
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic, sleep
+from typing import Callable, Iterator
+
+import numpy as np
+import numpy.typing as npt
+from cv2 import IMWRITE_JPEG_QUALITY, imencode
+
+from common.logger import Logger
+from common.typen import StreamStats
+
+BOUNDARY = b"frame"
+
+
+class FrameStream:
+    '''
+    A live preview shared by all viewers: one producer encodes the frames into a ring buffer.
+
+    The producer only runs while there are viewers and stops after the
+    idle timeout. If the camera is busy with a photo, capture returns None
+    and the frame is skipped, so the preview never delays a capture. A
+    viewer always gets the newest frame of the ring buffer, a slow viewer
+    skips frames instead of slowing down the others.
+
+    Attributes:
+    - __capture: Callable[[], npt.NDArray[np.uint8] | None], a small BGR frame or None if the camera is busy
+    - __interval: float, the time between two frames in s
+    - __quality: int, the JPEG quality
+    - __idle_timeout: float, the time the producer runs without viewers in s
+    - __frames: deque[tuple[int, bytes]], the ring buffer of the numbered JPEG frames
+    - __viewers: int, the number of connected viewers
+    - __last_viewer: float, the time the last viewer has requested a frame
+    - __condition: Condition, signals new frames
+    - __thread: Thread | None, the producer
+    - __stats: StreamStats
+
+    Methods:
+    - mjpeg() -> Iterator[bytes]
+    - latest(timeout: float = 2.) -> bytes | None
+    - get_stats() -> StreamStats
+    - stop() -> None
+    '''
+
+    def __init__(self, capture: Callable[[], npt.NDArray[np.uint8] | None], fps: float = 5.,
+                 quality: int = 70, ring: int = 4, idle_timeout: float = 5.):
+        self.__capture = capture
+        self.__interval = 1. / max(fps, 0.1)
+        self.__quality = quality
+        self.__idle_timeout = idle_timeout
+        self.__frames: deque[tuple[int, bytes]] = deque(maxlen=max(1, ring))
+        self.__viewers = 0
+        self.__last_viewer = 0.
+        self.__running = False
+        self.__closed = False
+        self.__condition = Condition()
+        self.__thread: Thread | None = None
+        self.__stats: StreamStats = {'viewers': 0, 'frames': 0, 'skipped': 0,
+                                     'encode': 0., 'size': 0}
+
+    def __start(self) -> None:
+        # called with the condition held
+        self.__last_viewer = monotonic()
+        if self.__running or self.__closed:
+            return
+        self.__running = True
+        self.__thread = Thread(target=self.__produce, name="Stream", daemon=True)
+        self.__thread.start()
+
+    def __produce(self) -> None:
+        Logger().info("Stream gestartet")
+        next_frame = monotonic()
+        while True:
+            with self.__condition:
+                if not self.__running or (self.__viewers == 0 and
+                                          monotonic() - self.__last_viewer > self.__idle_timeout):
+                    self.__running = False
+                    self.__frames.clear()
+                    self.__condition.notify_all()
+                    break
+            try:
+                frame = self.__capture()
+            except Exception as e:
+                Logger().error("Stream capture failed: %s", e)
+                frame = None
+            if frame is None:
+                self.__stats['skipped'] += 1
+            else:
+                start = monotonic()
+                ok, jpeg = imencode(".jpg", frame, [IMWRITE_JPEG_QUALITY, self.__quality])
+                if ok:
+                    data = jpeg.tobytes()
+                    self.__stats['frames'] += 1
+                    self.__stats['encode'] = (monotonic() - start) * 1000
+                    self.__stats['size'] = len(data)
+                    with self.__condition:
+                        # the numbers go on after a restart, the viewers wait for newer ones
+                        self.__frames.append((self.__stats['frames'], data))
+                        self.__condition.notify_all()
+            next_frame = max(next_frame + self.__interval, monotonic())
+            sleep(max(0., next_frame - monotonic()))
+        Logger().info("Stream gestoppt")
+
+    def __next(self, after: int, timeout: float) -> tuple[int, bytes] | None:
+        '''
+        Waits for a frame newer than after, returns the newest frame.
+        '''
+        with self.__condition:
+            self.__start()
+            if not self.__condition.wait_for(
+                    lambda: not self.__running or (len(self.__frames) > 0 and self.__frames[-1][0] > after),
+                    timeout) or len(self.__frames) == 0:
+                return None
+            return self.__frames[-1]
+
+    def mjpeg(self) -> Iterator[bytes]:
+        '''
+        The frames of a viewer as multipart/x-mixed-replace parts with the boundary 'frame'.
+        '''
+        with self.__condition:
+            self.__viewers += 1
+            self.__stats['viewers'] = self.__viewers
+        try:
+            number = 0
+            while not self.__closed:
+                frame = self.__next(number, 5 * self.__interval + 2.)
+                if frame is None:
+                    continue
+                number, data = frame
+                yield (b"--" + BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+                       str(len(data)).encode() + b"\r\n\r\n" + data + b"\r\n")
+        finally:
+            with self.__condition:
+                self.__viewers -= 1
+                self.__stats['viewers'] = self.__viewers
+                self.__last_viewer = monotonic()
+
+    def latest(self, timeout: float = 2.) -> bytes | None:
+        '''
+        The newest frame of the stream, the producer is started if necessary.
+
+        Returns:
+            The JPEG or None if no frame has been captured in time.
+        '''
+        with self.__condition:
+            if len(self.__frames) > 0 and self.__running:
+                self.__last_viewer = monotonic()
+                return self.__frames[-1][1]
+        frame = self.__next(0, timeout)
+        return None if frame is None else frame[1]
+
+    def get_stats(self) -> StreamStats:
+        '''
+        Returns the counters of the stream, the duration of the last encoding in ms
+        and the size of the last frame in bytes.
+        '''
+        return StreamStats(**self.__stats)
+
+    def stop(self) -> None:
+        '''
+        Stops the producer, the viewers are disconnected.
+        '''
+        with self.__condition:
+            self.__closed = True
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
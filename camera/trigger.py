@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from time import CLOCK_BOOTTIME, clock_gettime_ns, time_ns
+from typing import Any, Callable, Protocol
+
+from common.logger import Logger
+
+
+class Request(Protocol):
+    """
+    The part of a completed request of picamera2 used by the trigger.
+    """
+
+    def get_metadata(self) -> dict[str, Any]: ...
+
+    def release(self) -> None: ...
+
+
+def sensor_clock_ns() -> int:
+    """
+    Returns the clock of the SensorTimestamp of libcamera in nanoseconds.
+    """
+    return clock_gettime_ns(CLOCK_BOOTTIME)
+
+
+class ScheduledTrigger:
+    """
+    Selects the frame of the running camera that has been exposed closest to a given time.
+
+    The wall clocks of master and cameras have to be synchronized (NTP). The
+    target time is converted to the sensor clock, frames are taken from the
+    running pipeline and released until the next frame would be farther away
+    from the target than the current one.
+
+    Attributes:
+        __capture_request (Callable[[], Request]): Waits for the next frame.
+        __clock_ns (Callable[[], int]): The clock of the SensorTimestamp.
+        __wall_ns (Callable[[], int]): The synchronized wall clock.
+
+    Methods:
+        to_sensor_time(wall_ns: int): int
+        capture(target_ns: int, timeout: float = 5.): tuple[Request, dict[str, Any], int]
+    """
+
+    def __init__(self, capture_request: Callable[[], Request],
+                 clock_ns: Callable[[], int] = sensor_clock_ns,
+                 wall_ns: Callable[[], int] = time_ns):
+        """
+        Initializes the ScheduledTrigger object.
+
+        Args:
+            capture_request: Waits for the next frame of the running camera and returns it.
+            clock_ns: The clock of the SensorTimestamp in nanoseconds.
+            wall_ns: The synchronized wall clock in nanoseconds.
+        """
+        self.__capture_request = capture_request
+        self.__clock_ns = clock_ns
+        self.__wall_ns = wall_ns
+
+    def to_sensor_time(self, wall_ns: int) -> int:
+        """
+        Converts a wall clock time to the clock of the SensorTimestamp.
+        """
+        return wall_ns - self.__wall_ns() + self.__clock_ns()
+
+    def capture(self, target_ns: int, timeout: float = 5.) -> tuple[Request, dict[str, Any], int]:
+        """
+        Waits for the frame closest to the target time.
+
+        Args:
+            target_ns: The wall clock time of the capture in nanoseconds.
+            timeout: The time in seconds after the target the last frame is taken.
+
+        Returns:
+            The request of the frame, its metadata and the skew of its
+            SensorTimestamp to the target in nanoseconds.
+        """
+        target = self.to_sensor_time(target_ns)
+        deadline = target + int(timeout * 1e9)
+        last: int | None = None
+        while True:
+            req = self.__capture_request()
+            metadata = req.get_metadata()
+            ts: int = metadata['SensorTimestamp']
+            period = metadata.get('FrameDuration', 0) * 1000
+            if period <= 0 and last is not None:
+                period = ts - last
+            last = ts
+            # the next frame is exposed about one period later
+            if ts + period // 2 >= target or self.__clock_ns() > deadline:
+                break
+            req.release()
+        skew = ts - target
+        if abs(skew) > period:
+            Logger().warning("Trigger missed by %.1f ms", skew / 1e6)
+        return req, metadata, skew
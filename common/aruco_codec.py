@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module contains the binary encoding of the ArUco results sent from the cameras to the master.
+
+A result consists of a header, one record of 11 bytes per marker corner and
+the zlib compressed JSON of the metadata. Results larger than one datagram
+are split into fragments, which are reassembled by the master.
+
+Author: Florian Timm
+Version: 2024.06.20
+"""
+
+import zlib
+from json import dumps, loads
+from struct import Struct
+from time import monotonic
+
+import numpy as np
+
+from common.typen import ArucoMarkerPos, ArucoMetaBroadcast, Metadata
+
+MAGIC = b"PBA1"
+# magic, number of corners, length of the compressed metadata
+HEADER = Struct("<4sHI")
+CORNER = np.dtype([("id", "<u2"), ("corner", "u1"),
+                   ("x", "<f4"), ("y", "<f4")])
+# payload bytes of one fragment, small enough for a single ethernet frame
+FRAGMENT_SIZE = 1200
+
+
+def encode_aruco(marker: list[ArucoMarkerPos], meta: Metadata) -> bytes:
+    """
+    Encodes the detected corners and the metadata of an image.
+
+    Args:
+        marker: The detected corners.
+        meta: The metadata of the image.
+
+    Returns:
+        The binary result.
+    """
+    corners = np.empty(len(marker), dtype=CORNER)
+    if len(marker) > 0:
+        corners["id"] = [m["id"] for m in marker]
+        corners["corner"] = [m["corner"] for m in marker]
+        corners["x"] = [m["x"] for m in marker]
+        corners["y"] = [m["y"] for m in marker]
+    meta_bytes = zlib.compress(
+        dumps(meta, separators=(",", ":")).encode("utf-8"))
+    return HEADER.pack(MAGIC, len(marker), len(meta_bytes)) + \
+        corners.tobytes() + meta_bytes
+
+
+def decode_aruco(data: bytes) -> ArucoMetaBroadcast:
+    """
+    Decodes a binary result.
+
+    Args:
+        data: The binary result.
+
+    Returns:
+        The detected corners and the metadata.
+
+    Raises:
+        ValueError: If the data is no valid result.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("ArUco result too short")
+    magic, count, meta_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("No ArUco result")
+    end = HEADER.size + count * CORNER.itemsize
+    if len(data) != end + meta_length:
+        raise ValueError("ArUco result has wrong length")
+    corners = np.frombuffer(data, dtype=CORNER, count=count,
+                            offset=HEADER.size)
+    marker: list[ArucoMarkerPos] = [
+        {"id": int(i), "corner": int(c), "x": float(x), "y": float(y)}
+        for i, c, x, y in zip(corners["id"].tolist(), corners["corner"].tolist(),
+                              corners["x"].tolist(), corners["y"].tolist())]
+    meta: Metadata = loads(zlib.decompress(data[end:]))
+    return {"aruco": marker, "meta": meta}
+
+
+def fragment(data: bytes, size: int = FRAGMENT_SIZE) -> list[bytes]:
+    """
+    Splits a result into fragments.
+
+    Args:
+        data: The binary result.
+        size: The maximum size of a fragment.
+
+    Returns:
+        The fragments, at least one.
+    """
+    return [data[i:i + size] for i in range(0, max(len(data), 1), size)]
+
+
+class FragmentBuffer:
+    """
+    Reassembles fragmented results.
+
+    Incomplete results are dropped after a timeout.
+
+    Attributes:
+        __fragments (dict[str, dict[int, bytes]]): The received fragments by key and index.
+        __started (dict[str, float]): The monotonic time the first fragment of a key was received.
+
+    Methods:
+        add(key: str, index: int, total: int, data: bytes): bytes | None
+    """
+
+    def __init__(self, timeout: float = 60):
+        """
+        Initializes the FragmentBuffer object.
+
+        Args:
+            timeout: The time in seconds after which incomplete results are dropped.
+        """
+        self.__timeout = timeout
+        self.__fragments: dict[str, dict[int, bytes]] = {}
+        self.__started: dict[str, float] = {}
+
+    def add(self, key: str, index: int, total: int, data: bytes) -> bytes | None:
+        """
+        Adds a fragment.
+
+        Args:
+            key: Identifies the result, e.g. '<id>:<hostname>:<number>'.
+            index: The index of the fragment.
+            total: The number of fragments of the result.
+            data: The fragment.
+
+        Returns:
+            The reassembled result if it is complete, else None.
+        """
+        now = monotonic()
+        for old in [k for k, t in self.__started.items()
+                    if now - t > self.__timeout]:
+            del self.__started[old]
+            del self.__fragments[old]
+        fragments = self.__fragments.setdefault(key, {})
+        self.__started.setdefault(key, now)
+        fragments[index] = data
+        if len(fragments) < total:
+            return None
+        del self.__fragments[key]
+        del self.__started[key]
+        return b"".join(fragments[i] for i in range(total))
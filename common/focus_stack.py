@@ -0,0 +1,368 @@
+"""
+
+Simple Focus Stacker
+
+    Author:     Charles McGuinness (charles@mcguinness.us)
+    Copyright:  Copyright 2015 Charles McGuinness
+    License:    Apache License 2.0
+
+
+This code will take a series of images and merge them so that each
+pixel is taken from the image with the sharpest focus at that location.
+
+The logic is roughly the following:
+
+1.  Align the images.  Changing the focus on a lens, even
+    if the camera remains fixed, causes a mild zooming on the images.
+    We need to correct the images so they line up perfectly on top
+    of each other.
+
+2.  Perform a gaussian blur on all images
+
+3.  Compute the laplacian on the blurred image to generate a gradient map
+
+4.  Create a blank output image with the same size as the original input
+    images
+
+4.  For each pixel [x,y] in the output image, copy the pixel [x,y] from
+    the input image which has the largest gradient [x,y]
+
+
+This algorithm was inspired by the high-level description given at
+
+http://stackoverflow.com/questions/15911783/what-are-some-common-focus-stacking-algorithms
+
+"""
+
+from json import dump as json_dump, load as json_load
+from threading import Lock
+from typing import Iterable, Iterator, Sequence
+import numpy as np
+import numpy.typing as npt
+import cv2
+from common.logger import Logger
+
+
+# the features are detected on a downscaled image of this width
+ALIGN_WIDTH = 1152
+# median error (pixels of the downscaled image) up to which a cached homography is reused
+RESIDUAL_THRESHOLD = 1.0
+
+
+def matchedPoints(image_1_kp, image_2_kp, matches) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.float32]]:
+    image_1_points = np.zeros((len(matches), 1, 2), dtype=np.float32)
+    image_2_points = np.zeros((len(matches), 1, 2), dtype=np.float32)
+
+    for i in range(0, len(matches)):
+        image_1_points[i] = image_1_kp[matches[i].queryIdx].pt
+        image_2_points[i] = image_2_kp[matches[i].trainIdx].pt
+    return image_1_points, image_2_points
+
+
+def findHomography(image_1_kp, image_2_kp, matches) -> npt.NDArray[np.float32]:
+    image_1_points, image_2_points = matchedPoints(
+        image_1_kp, image_2_kp, matches)
+
+    if len(image_1_points) < 4 or len(image_2_points) < 4:
+        raise ValueError("Not enough points to compute homography")
+
+    homography, mask = cv2.findHomography(
+        image_1_points, image_2_points, cv2.RANSAC, ransacReprojThreshold=2.0)
+
+    if homography is None:
+        raise ValueError("Could not compute homography")
+    return homography
+
+
+def homographyResidual(homography, image_1_kp, image_2_kp, matches) -> float:
+    """
+    Median distance between the matched points of image 2 and the points of
+    image 1 transformed with the homography.
+    """
+    if len(matches) < 4:
+        return float('inf')
+    image_1_points, image_2_points = matchedPoints(
+        image_1_kp, image_2_kp, matches)
+    projected = cv2.perspectiveTransform(image_1_points, homography)
+    return float(np.median(np.linalg.norm(projected - image_2_points, axis=2)))
+
+
+def scaleHomography(homography, scale: float) -> npt.NDArray[np.float64]:
+    """
+    Converts a homography of a scaled image to the original image.
+    """
+    s = np.diag([scale, scale, 1.])
+    return np.linalg.inv(s) @ np.asarray(homography, dtype=np.float64) @ s
+
+
+class HomographyCache:
+    """
+    Persistent homographies between the frames of a focus stack.
+
+    The focus steps of a camera are fixed, so the homography between two lens
+    positions hardly changes between sessions. The homographies are stored
+    per hostname, keyed by the lens positions of the base and the aligned frame.
+
+    Attributes:
+        __file (str): The json file the homographies are stored in.
+        __homographies (dict[str, dict[str, list[list[float]]]]): The homographies by hostname.
+
+    Methods:
+        key(base_lens: float, lens: float): str
+        get(hostname: str): dict[str, list[list[float]]]
+        update(hostname: str, homographies: dict[str, list[list[float]]]): None
+    """
+
+    def __init__(self, file: str):
+        self.__file = file
+        self.__lock = Lock()
+        self.__homographies: dict[str, dict[str, list[list[float]]]] = {}
+        try:
+            with open(file) as f:
+                self.__homographies = json_load(f)
+        except (OSError, ValueError):
+            Logger().info("No homographies loaded from %s", file)
+
+    @staticmethod
+    def key(base_lens: float, lens: float) -> str:
+        return f"{base_lens:g}:{lens:g}"
+
+    def get(self, hostname: str) -> dict[str, list[list[float]]]:
+        with self.__lock:
+            return dict(self.__homographies.get(hostname, {}))
+
+    def update(self, hostname: str, homographies: dict[str, list[list[float]]]) -> None:
+        with self.__lock:
+            if self.__homographies.get(hostname) == homographies:
+                return
+            self.__homographies[hostname] = homographies
+            try:
+                with open(self.__file, "w") as f:
+                    json_dump(self.__homographies, f, indent=2)
+            except OSError as e:
+                Logger().error("Error saving homographies: %s", e)
+
+
+#
+#   Align the images so they overlap properly...
+#
+#
+def iter_aligned(images: Iterable[npt.NDArray[np.uint8]],
+                 lens_positions: Sequence[float] | None = None,
+                 homographies: dict[str, list[list[float]]] | None = None) -> Iterator[npt.NDArray[np.uint8]]:
+    """
+    Aligns the images to the first one and yields them one at a time, so
+    only the current image has to be held in memory.
+
+    The features are detected on a downscaled gray image. If homographies and
+    the lens positions of the images are given, a cached homography is reused
+    as long as the matched features agree with it, new homographies are
+    written back into the dictionary.
+
+    Args:
+        images: The images, the first one is the base.
+        lens_positions: The lens positions of the images.
+        homographies: Cached homographies by HomographyCache.key.
+    """
+
+    #   SIFT generally produces better results, but it is not FOSS, so chose the feature detector
+    #   that suits the needs of your project.  ORB does OK
+    use_sift = False
+
+    if use_sift:
+        detector = cv2.xfeatures2d.SIFT_create()
+    else:
+        detector = cv2.ORB_create(1000)
+
+    scale = 1.
+    image_1_kp = image_1_desc = None
+    for i, image in enumerate(images):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if i == 0:
+            scale = min(1., ALIGN_WIDTH / gray.shape[1])
+        if scale < 1:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale,
+                              interpolation=cv2.INTER_AREA)
+
+        if i == 0:
+            #   We assume that image 0 is the "base" image and align everything to it
+            Logger().info("Detecting features of base image")
+            image_1_kp, image_1_desc = detector.detectAndCompute(gray, None)
+            yield image
+            continue
+
+        Logger().info("Aligning image {}".format(i))
+        image_i_kp, image_i_desc = detector.detectAndCompute(gray, None)
+
+        rawMatches = []
+        if image_i_desc is not None and image_1_desc is not None:
+            if use_sift:
+                bf = cv2.BFMatcher()
+                # This returns the top two matches for each feature point (list of list)
+                pairMatches = bf.knnMatch(image_i_desc, image_1_desc, k=2)
+                for m, n in pairMatches:
+                    if m.distance < 0.7*n.distance:
+                        rawMatches.append(m)
+            else:
+                bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+                rawMatches = bf.match(image_i_desc, image_1_desc)
+
+        sortMatches = sorted(rawMatches, key=lambda x: x.distance)
+        matches = sortMatches[0:128]
+
+        key = None
+        cached = None
+        if lens_positions is not None and homographies is not None:
+            key = HomographyCache.key(lens_positions[0], lens_positions[i])
+            cached = homographies.get(key)
+
+        hom = None
+        if cached is not None:
+            residual = homographyResidual(scaleHomography(
+                cached, 1 / scale), image_i_kp, image_1_kp, matches)
+            if residual < RESIDUAL_THRESHOLD:
+                hom = np.asarray(cached)
+            else:
+                Logger().info("Cached homography of image {} failed, residual {:.2f}".format(
+                    i, residual))
+        if hom is None:
+            try:
+                hom = scaleHomography(findHomography(
+                    image_i_kp, image_1_kp, matches), scale)
+                if key is not None and homographies is not None:
+                    homographies[key] = hom.tolist()
+            except ValueError:
+                if cached is None:
+                    Logger().info("Could not align image {}".format(i))
+                    continue
+                hom = np.asarray(cached)
+
+        yield cv2.warpPerspective(
+            image, hom, (image.shape[1], image.shape[0]), flags=cv2.INTER_LINEAR)
+        # If you find that there's a large amount of ghosting, it may be because one or more of the input
+        # images gets misaligned.  Outputting the aligned images may help diagnose that.
+        # cv2.imwrite("aligned{}.png".format(i), newimage)
+
+
+def align_images(images: list[npt.NDArray[np.uint8]]) -> list[npt.NDArray[np.uint8]]:
+    return list(iter_aligned(images))
+
+#
+#   Compute the gradient map of the image
+
+
+# YOU SHOULD TUNE THESE VALUES TO SUIT YOUR NEEDS
+KERNEL_SIZE = 5         # Size of the laplacian window
+BLUR_SIZE = 5           # How big of a kernal to use for the gaussian blur
+# Generally, keeping these two values the same or very close works well
+# Also, odd numbers, please...
+
+# rows at the border of a tile that are influenced by the blur and the laplacian
+MIN_OVERLAP = BLUR_SIZE // 2 + KERNEL_SIZE // 2
+
+
+def doLap(image: npt.NDArray[np.uint8], ddepth: int = cv2.CV_64F) -> npt.NDArray[np.floating]:
+    blurred = cv2.GaussianBlur(image, (BLUR_SIZE, BLUR_SIZE), 0)
+    return cv2.Laplacian(blurred, ddepth, ksize=KERNEL_SIZE)
+
+#
+#   This routine finds the points of best focus in all images and produces a merged result...
+#
+
+
+def stack_aligned(images: Iterable[npt.NDArray[np.uint8]], tile_rows: int = 0,
+                  overlap: int = 8) -> npt.NDArray[np.uint8]:
+    """
+    Merges aligned images one at a time, keeping only the running sharpness
+    map and the composed output. The laplacian of a blurred 8 bit image is
+    integral, so float32 holds it exactly and the result is identical to the
+    comparison of all float64 laplacians at once. Of equally sharp images the
+    last one wins.
+
+    Args:
+        images: The aligned images.
+        tile_rows: The height of the horizontal tiles the laplacian is computed in, 0 for the whole image.
+        overlap: The rows added above and below each tile, at least MIN_OVERLAP.
+
+    Returns:
+        The merged image.
+    """
+    return merge(images, tile_rows, overlap, False)[0]
+
+
+def stack_aligned_index(images: Iterable[npt.NDArray[np.uint8]], tile_rows: int = 0,
+                        overlap: int = 8) -> tuple[npt.NDArray[np.uint8], npt.NDArray[np.uint8]]:
+    """
+    Merges aligned images like stack_aligned and records the image each pixel is taken from.
+
+    Returns:
+        The merged image and the index of the sharpest image per pixel.
+    """
+    output, index = merge(images, tile_rows, overlap, True)
+    return output, index  # type: ignore
+
+
+def merge(images: Iterable[npt.NDArray[np.uint8]], tile_rows: int, overlap: int,
+          with_index: bool) -> tuple[npt.NDArray[np.uint8], npt.NDArray[np.uint8] | None]:
+    output: npt.NDArray[np.uint8] | None = None
+    sharpness: npt.NDArray[np.float32] | None = None
+    index: npt.NDArray[np.uint8] | None = None
+    overlap = max(overlap, MIN_OVERLAP)
+
+    for i, image in enumerate(images):
+        Logger().info("Lap {}".format(i))
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        height = gray.shape[0]
+        if output is None or sharpness is None:
+            output = np.empty_like(image)
+            sharpness = np.full(gray.shape, -1, dtype=np.float32)
+            if with_index:
+                index = np.zeros(gray.shape, dtype=np.uint8)
+        rows = tile_rows if tile_rows > 0 else height
+        for y0 in range(0, height, rows):
+            y1 = min(y0 + rows, height)
+            a0 = max(y0 - overlap, 0)
+            a1 = min(y1 + overlap, height)
+            lap = doLap(gray[a0:a1], cv2.CV_32F)[y0 - a0:y1 - a0]
+            np.absolute(lap, out=lap)
+            mask = lap >= sharpness[y0:y1]
+            sharpness[y0:y1][mask] = lap[mask]
+            output[y0:y1][mask] = image[y0:y1][mask]
+            if index is not None:
+                index[y0:y1][mask] = i
+
+    if output is None:
+        raise ValueError("No images to stack")
+    return output, index
+
+
+def focus_stack(unimages: Iterable[npt.NDArray[np.uint8]], tile_rows: int = 0,
+                lens_positions: Sequence[float] | None = None,
+                homographies: dict[str, list[list[float]]] | None = None) -> npt.NDArray[np.uint8]:
+    """
+    Aligns and merges the images. Images are consumed one at a time, so a
+    generator keeps the peak memory independent of the number of images.
+
+    Args:
+        unimages: The unaligned images, the first one is the base.
+        tile_rows: The height of the horizontal tiles, 0 for the whole image.
+        lens_positions: The lens positions of the images, used for the homography cache.
+        homographies: Cached homographies, updated in place.
+
+    Returns:
+        The merged image.
+    """
+    Logger().info("Computing the laplacian of the blurred images")
+    return stack_aligned(iter_aligned(unimages, lens_positions, homographies), tile_rows)
+
+
+def focus_stack_index(unimages: Iterable[npt.NDArray[np.uint8]], tile_rows: int = 0,
+                      lens_positions: Sequence[float] | None = None,
+                      homographies: dict[str, list[list[float]]] | None = None) -> tuple[npt.NDArray[np.uint8], npt.NDArray[np.uint8]]:
+    """
+    Aligns and merges the images like focus_stack.
+
+    Returns:
+        The merged image and the index of the sharpest image per pixel.
+    """
+    return stack_aligned_index(iter_aligned(unimages, lens_positions, homographies), tile_rows)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module contains the UDP endpoint shared by all senders of the master or a camera.
+
+The endpoint owns one long-lived send and one receive socket. Outgoing
+datagrams are queued and sent by a single thread. Datagrams queued for the
+same address while the thread is busy are sent together in one packet
+'PBB' + (length + datagram)*.
+
+Author: Florian Timm
+Version: 2024.06.20
+"""
+
+import socket
+from collections import deque
+from struct import Struct
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable
+
+from common.logger import Logger
+from common.protocol import Address, Envelope, ReliableChannel
+from common.typen import MessagingStats
+
+BATCH_MAGIC = b"PBB"
+LENGTH = Struct(">H")
+# stay below the ethernet MTU
+MAX_PACKET = 1400
+
+
+def split_batch(data: bytes) -> list[bytes]:
+    """
+    Splits a received packet into its datagrams.
+
+    Args:
+        data: The received packet.
+
+    Returns:
+        The datagrams, the packet itself if it is no batch.
+    """
+    if not data.startswith(BATCH_MAGIC):
+        return [data]
+    datagrams: list[bytes] = []
+    pos = len(BATCH_MAGIC)
+    while pos + LENGTH.size <= len(data):
+        length = LENGTH.unpack_from(data, pos)[0]
+        pos += LENGTH.size
+        datagrams.append(data[pos:pos + length])
+        pos += length
+    return datagrams
+
+
+class MessageEndpoint:
+    """
+    Sends and receives the acknowledged messages of one side.
+
+    Attributes:
+        __port (int): The broadcast port.
+        __send_sock (socket.socket): The socket used for all outgoing datagrams.
+        __recv_sock (socket.socket): The socket bound to the broadcast port.
+        __channel (ReliableChannel): Handles sequence numbers, acknowledgements and retransmissions.
+        __queue (deque[tuple[bytes, Address, float]]): The datagrams waiting for the sender thread.
+
+    Methods:
+        listen(host: str, search_free_port: bool = False): int
+        send(payload: bytes, addr: Address, receivers: set[str] | None = None): int
+        broadcast(payload: bytes, receivers: set[str] | None = None): int
+        receive(): list[tuple[Envelope, Address]]
+        get_stats(): MessagingStats
+        close(): None
+    """
+
+    def __init__(self, name: str, port: int,
+                 ack_addr: Callable[[Address], Address],
+                 timeout: float = 0.5, retries: int = 5):
+        """
+        Initializes the MessageEndpoint object and starts the sender thread.
+
+        Args:
+            name: The name of this side, used as sender of the messages.
+            port: The broadcast port.
+            ack_addr: Returns the address acknowledgements for a sender address are sent to.
+            timeout: The time in seconds before a message is retransmitted.
+            retries: The number of retransmissions before a message is given up.
+        """
+        self.__port = port
+        self.__send_sock = socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.__send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.__recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__recv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        self.__queue: deque[tuple[bytes, Address, float]] = deque()
+        self.__condition = Condition()
+        self.__closed = False
+        self.__messages = 0
+        self.__batches = 0
+        self.__bytes = 0
+        self.__errors = 0
+        self.__latency = 0.
+        self.__max_latency = 0.
+
+        self.__channel = ReliableChannel(
+            name, self.__enqueue, ack_addr, timeout, retries)
+        Thread(target=self.__send_loop, name="MessageSender",
+               daemon=True).start()
+
+    def listen(self, host: str, search_free_port: bool = False) -> int:
+        """
+        Binds the receive socket.
+
+        Args:
+            host: The address to bind to, e.g. '0.0.0.0' or '255.255.255.255'.
+            search_free_port: True to try the following ports if the port is in use.
+
+        Returns:
+            The bound port.
+        """
+        port = self.__port
+        while True:
+            try:
+                self.__recv_sock.bind((host, port))
+                return port
+            except OSError:
+                if not search_free_port:
+                    raise
+                Logger().error("Port %s already in use", port)
+                port += 1
+
+    def send(self, payload: bytes, addr: Address,
+             receivers: set[str] | None = None) -> int:
+        """
+        Sends a message, see ReliableChannel.send().
+
+        Returns:
+            The sequence number of the message, 0 if it is not acknowledged.
+        """
+        return self.__channel.send(payload, addr, receivers)
+
+    def broadcast(self, payload: bytes, receivers: set[str] | None = None) -> int:
+        """
+        Broadcasts a message to the port of the endpoint, see ReliableChannel.send().
+
+        Returns:
+            The sequence number of the message, 0 if it is not acknowledged.
+        """
+        return self.__channel.send(
+            payload, ("255.255.255.255", self.__port), receivers)
+
+    def receive(self) -> list[tuple[Envelope, Address]]:
+        """
+        Waits for the next packet.
+
+        Returns:
+            The new messages of the packet with the address of the sender,
+            empty for acknowledgements and duplicates.
+        """
+        data, addr = self.__recv_sock.recvfrom(10000)
+        messages: list[tuple[Envelope, Address]] = []
+        for datagram in split_batch(data):
+            envelope = self.__channel.receive(datagram, addr)
+            if envelope is not None:
+                messages.append((envelope, addr))
+        return messages
+
+    def get_stats(self) -> MessagingStats:
+        """
+        Returns the counters of the sender.
+
+        Returns:
+            The statistics of the endpoint.
+        """
+        with self.__condition:
+            return {
+                'messages': self.__messages,
+                'batches': self.__batches,
+                'bytes_total': self.__bytes,
+                'queue_depth': len(self.__queue),
+                'unacknowledged': self.__channel.pending(),
+                'avg_latency': self.__latency / max(self.__messages, 1),
+                'max_latency': self.__max_latency,
+                'errors': self.__errors}
+
+    def close(self) -> None:
+        """
+        Stops the sender thread and closes the sockets.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__recv_sock.close()
+
+    def __enqueue(self, datagram: bytes, addr: Address) -> None:
+        with self.__condition:
+            self.__queue.append((datagram, addr, monotonic()))
+            self.__condition.notify()
+
+    def __send_loop(self) -> None:
+        """
+        Main loop of the sender thread, sends everything queued in as few packets as possible.
+        """
+        while True:
+            with self.__condition:
+                while len(self.__queue) == 0 and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    self.__send_sock.close()
+                    return
+                queued = list(self.__queue)
+                self.__queue.clear()
+
+            packets: dict[Address, list[list[tuple[bytes, float]]]] = {}
+            for datagram, addr, queued_at in queued:
+                batches = packets.setdefault(addr, [[]])
+                size = sum(LENGTH.size + len(d) for d, _ in batches[-1])
+                if batches[-1] and len(BATCH_MAGIC) + size + \
+                        LENGTH.size + len(datagram) > MAX_PACKET:
+                    batches.append([])
+                batches[-1].append((datagram, queued_at))
+
+            for addr, batches in packets.items():
+                for batch in batches:
+                    self.__send_packet(batch, addr)
+
+    def __send_packet(self, batch: list[tuple[bytes, float]], addr: Address) -> None:
+        if len(batch) == 1:
+            packet = batch[0][0]
+        else:
+            packet = BATCH_MAGIC + b"".join(
+                LENGTH.pack(len(d)) + d for d, _ in batch)
+        try:
+            self.__send_sock.sendto(packet, addr)
+        except OSError as e:
+            Logger().error("Error sending to %s: %s", addr, e)
+            with self.__condition:
+                self.__errors += 1
+            return
+        now = monotonic()
+        with self.__condition:
+            self.__batches += 1
+            self.__bytes += len(packet)
+            for _, queued_at in batch:
+                self.__messages += 1
+                self.__latency += now - queued_at
+                self.__max_latency = max(self.__max_latency, now - queued_at)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module contains the acknowledged UDP message layer between the master and the cameras.
+
+Every message is wrapped into an envelope 'PB1|<sender>|<seq>|<payload>'.
+Messages with a sequence number greater than 0 are acknowledged by the
+receivers with 'ack:<sender>:<seq>' and retransmitted until all expected
+receivers have answered. Received duplicates are acknowledged again, but not
+handed to the application.
+
+Datagrams without an envelope are still accepted and handed to the
+application unacknowledged. This only works in one direction: a camera
+without this layer does not understand 'PB1|...' messages or the 'PBB'
+batches of the messaging module, so the master and all cameras have to be
+updated together.
+
+Author: Florian Timm
+Version: 2024.06.20
+"""
+
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic, time
+from typing import Callable, NamedTuple
+
+from common.logger import Logger
+
+PROTOCOL_VERSION = b"PB1"
+
+Address = tuple[str, int]
+
+
+class Envelope(NamedTuple):
+    """
+    Represents a received message.
+
+    Attributes:
+        sender (str): The name of the sender, empty for messages without envelope.
+        seq (int): The sequence number, 0 for unacknowledged messages.
+        payload (bytes): The message itself.
+    """
+    sender: str
+    seq: int
+    payload: bytes
+
+
+def encode(sender: str, seq: int, payload: bytes) -> bytes:
+    """
+    Wraps a message into an envelope.
+
+    Args:
+        sender: The name of the sender.
+        seq: The sequence number, 0 if no acknowledgement is expected.
+        payload: The message.
+
+    Returns:
+        The datagram.
+    """
+    return PROTOCOL_VERSION + f"|{sender}|{seq}|".encode("utf-8") + payload
+
+
+def decode(data: bytes) -> Envelope:
+    """
+    Unwraps a received datagram.
+
+    Args:
+        data: The datagram.
+
+    Returns:
+        The envelope, a message without envelope is returned with sender '' and seq 0.
+    """
+    if not data.startswith(PROTOCOL_VERSION + b"|"):
+        return Envelope("", 0, data)
+    parts = data.split(b"|", 3)
+    if len(parts) < 4 or not parts[2].isdigit():
+        return Envelope("", 0, data)
+    return Envelope(parts[1].decode("utf-8"), int(parts[2]), parts[3])
+
+
+class DuplicateFilter:
+    """
+    Remembers the last received sequence numbers of each sender.
+
+    Methods:
+        seen(sender: str, seq: int): bool
+    """
+
+    def __init__(self, size: int = 256):
+        self.__size = size
+        self.__seen: dict[str, tuple[set[int], deque[int]]] = {}
+
+    def seen(self, sender: str, seq: int) -> bool:
+        """
+        Checks if a message has been received before and remembers it.
+
+        Args:
+            sender: The name of the sender.
+            seq: The sequence number.
+
+        Returns:
+            True if the message is a duplicate.
+        """
+        known, order = self.__seen.setdefault(sender, (set(), deque()))
+        if seq in known:
+            return True
+        known.add(seq)
+        order.append(seq)
+        if len(order) > self.__size:
+            known.discard(order.popleft())
+        return False
+
+
+class PendingMessage(NamedTuple):
+    """
+    Represents a sent message waiting for acknowledgements.
+
+    Attributes:
+        datagram (bytes): The encoded message.
+        addr (Address): The destination.
+        receivers (set[str] | None): The receivers that have not acknowledged yet, None for any receiver.
+        retries (int): The number of retransmissions left.
+        deadline (float): The monotonic time of the next retransmission.
+    """
+    datagram: bytes
+    addr: Address
+    receivers: set[str] | None
+    retries: int
+    deadline: float
+
+
+class ReliableChannel:
+    """
+    Sends acknowledged messages and unwraps received ones.
+
+    The sockets are not owned by the channel, datagrams are sent with the
+    given transmit function. Received datagrams have to be passed to receive().
+
+    Attributes:
+        __name (str): The name of this side, used as sender.
+        __transmit (Callable[[bytes, Address], None]): Sends a datagram.
+        __ack_addr (Callable[[Address], Address]): The address acknowledgements are sent to.
+        __pending (dict[int, PendingMessage]): The unacknowledged messages by sequence number.
+
+    Methods:
+        send(payload: bytes, addr: Address, receivers: set[str] | None = None): int
+        receive(data: bytes, addr: Address): Envelope | None
+        pending(): int
+    """
+
+    def __init__(self, name: str, transmit: Callable[[bytes, Address], None],
+                 ack_addr: Callable[[Address], Address],
+                 timeout: float = 0.5, retries: int = 5):
+        """
+        Initializes the ReliableChannel object and starts the retransmission thread.
+
+        Args:
+            name: The name of this side, used as sender.
+            transmit: Sends a datagram to an address.
+            ack_addr: Returns the address acknowledgements for a sender address are sent to.
+            timeout: The time in seconds before a message is retransmitted.
+            retries: The number of retransmissions before a message is given up.
+        """
+        self.__name = name
+        self.__transmit = transmit
+        self.__ack_addr = ack_addr
+        self.__timeout = timeout
+        self.__retries = retries
+        # a restarted sender must not reuse the numbers of its last run
+        self.__seq = int(time() * 1000) % 1_000_000_000
+        self.__pending: dict[int, PendingMessage] = {}
+        self.__duplicates = DuplicateFilter()
+        self.__condition = Condition()
+        Thread(target=self.__retransmit, name="Retransmit", daemon=True).start()
+
+    def send(self, payload: bytes, addr: Address,
+             receivers: set[str] | None = None) -> int:
+        """
+        Sends a message and retransmits it until it has been acknowledged.
+
+        Args:
+            payload: The message.
+            addr: The destination, may be a broadcast address.
+            receivers: The names that have to acknowledge the message, None
+                for the first acknowledgement of any receiver, an empty set to
+                send the message only once without acknowledgement.
+
+        Returns:
+            The sequence number of the message, 0 if it is not acknowledged.
+        """
+        seq = 0
+        with self.__condition:
+            if receivers is None or len(receivers) > 0:
+                self.__seq += 1
+                seq = self.__seq
+            datagram = encode(self.__name, seq, payload)
+            if seq > 0:
+                self.__pending[seq] = PendingMessage(
+                    datagram, addr, None if receivers is None else set(receivers),
+                    self.__retries, monotonic() + self.__timeout)
+                self.__condition.notify()
+        self.__send(datagram, addr)
+        return seq
+
+    def receive(self, data: bytes, addr: Address) -> Envelope | None:
+        """
+        Unwraps a received datagram, handles acknowledgements and duplicates.
+
+        Args:
+            data: The datagram.
+            addr: The address of the sender.
+
+        Returns:
+            The envelope of a new message, None for acknowledgements, duplicates and own messages.
+        """
+        envelope = decode(data)
+        if envelope.sender == self.__name:
+            return None
+        if envelope.payload.startswith(b"ack:"):
+            self.__acknowledged(envelope)
+            return None
+        if envelope.seq > 0:
+            self.__send(encode(self.__name, 0, b"ack:" + envelope.sender.encode("utf-8") +
+                               b":" + str(envelope.seq).encode("utf-8")),
+                        self.__ack_addr(addr))
+            with self.__condition:
+                if self.__duplicates.seen(envelope.sender, envelope.seq):
+                    Logger().debug("Duplicate %d from %s",
+                                   envelope.seq, envelope.sender)
+                    return None
+        return envelope
+
+    def pending(self) -> int:
+        """
+        Returns the number of messages waiting for acknowledgements.
+        """
+        with self.__condition:
+            return len(self.__pending)
+
+    def __acknowledged(self, envelope: Envelope) -> None:
+        try:
+            _, target, seq = envelope.payload.decode("utf-8").split(":")
+            seq = int(seq)
+        except ValueError:
+            return
+        if target != self.__name:
+            return
+        with self.__condition:
+            message = self.__pending.get(seq)
+            if message is None:
+                return
+            if message.receivers is None:
+                del self.__pending[seq]
+                return
+            message.receivers.discard(envelope.sender)
+            if len(message.receivers) == 0:
+                del self.__pending[seq]
+
+    def __send(self, datagram: bytes, addr: Address) -> None:
+        try:
+            self.__transmit(datagram, addr)
+        except OSError as e:
+            Logger().error("Error sending to %s: %s", addr, e)
+
+    def __retransmit(self) -> None:
+        """
+        Main loop of the retransmission thread.
+        """
+        while True:
+            resend: list[PendingMessage] = []
+            with self.__condition:
+                now = monotonic()
+                for seq, message in list(self.__pending.items()):
+                    if message.deadline > now:
+                        continue
+                    if message.retries == 0:
+                        Logger().warning("No acknowledgement for %s from %s",
+                                         message.datagram[:60], message.receivers)
+                        del self.__pending[seq]
+                        continue
+                    self.__pending[seq] = message._replace(
+                        retries=message.retries - 1, deadline=now + self.__timeout)
+                    resend.append(message)
+                if not resend:
+                    wait = min((m.deadline for m in self.__pending.values()),
+                               default=now + 60) - now
+                    self.__condition.wait(max(wait, 0.01))
+            for message in resend:
+                self.__send(message.datagram, message.addr)
@@ -8,7 +8,7 @@ Author: Florian Timm
 Version: 2024.06.20
 """
 
-from typing import Required, TypedDict, NotRequired, Union,  TypeAlias, NamedTuple
+from typing import Literal, Required, TypedDict, NotRequired, Union,  TypeAlias, NamedTuple
 
 
 class CommonCamSettings(TypedDict):
@@ -133,6 +133,20 @@ class ArucoMarkerPos(TypedDict):
     y: float
 
 
+class ArucoMarkerResidual(TypedDict):
+    """
+    Represents the reprojection residual of a detected Aruco marker corner.
+
+    Attributes:
+        id (int): The ID of the Aruco marker.
+        corner (int): The corner of the Aruco marker.
+        residual (float): The distance between detection and reprojection in pixels.
+    """
+    id: int
+    corner: int
+    residual: float
+
+
 class Point2D(NamedTuple):
     x: float
     y: float
@@ -292,6 +306,9 @@ class Metadata(TypedDict):
         ColourGains (list[float]): The colour gains.
         ColourTemperature (int): The colour temperature.
         ColourCorrectionMatrix (list[float]): The colour correction matrix.
+        TriggerSkew (int): The difference between SensorTimestamp and scheduled trigger time in nanoseconds.
+        Timings (SaveTimings): The durations of the stages of saving the image.
+        Timeline (StackFrameTimeline): The stages of a frame of a focus stack.
     """
 
     SensorTimestamp: NotRequired[int]
@@ -311,6 +328,51 @@ class Metadata(TypedDict):
     ColourGains: NotRequired[list[float]]
     ColourTemperature: NotRequired[int]
     ColourCorrectionMatrix: NotRequired[list[float]]
+    TriggerSkew: NotRequired[int]
+    Timings: NotRequired['SaveTimings']
+    Timeline: NotRequired['StackFrameTimeline']
+
+
+class SaveTimings(TypedDict):
+    """
+    Represents the durations of the stages of saving an image in milliseconds.
+
+    Attributes:
+        capture (float): Setting the camera and capturing the request.
+        copy (float): Copying the frame out of the request buffer.
+        exif (float): Building the EXIF data.
+        encode (float): Encoding the JPEG with the EXIF data in memory.
+        write (float): Writing the JPEG to the file.
+        total (float): All stages.
+    """
+    capture: float
+    copy: float
+    exif: float
+    encode: float
+    write: float
+    total: float
+
+
+class StackFrameTimeline(TypedDict):
+    """
+    Represents the stages of a frame of a focus stack in milliseconds since the start of the stack.
+
+    Attributes:
+        lens_position (float): The lens position of the frame in dioptre.
+        moved (float): The lens has been sent to the position.
+        settled (float): A frame has reached the position or the wait has timed out.
+        reached (bool): Indicates whether the position has been reached.
+        captured (float): The frame has been captured and copied.
+        encoding (float): The encoder has started with the frame.
+        written (float): The JPEG has been written.
+    """
+    lens_position: float
+    moved: float
+    settled: float
+    reached: bool
+    captured: float
+    encoding: float
+    written: float
 
 
 class ArucoMetaBroadcast(TypedDict):
@@ -343,3 +405,213 @@ class CameraExterior (TypedDict):
     roll: float
     pitch: float
     yaw: float
+
+
+class DownloadStats(TypedDict):
+    """
+    Represents the statistics of the photo download pipeline.
+
+    Attributes:
+        queue_depth (int): The number of downloads waiting for a worker.
+        active (int): The number of downloads currently running.
+        done (int): The number of finished downloads.
+        failed (int): The number of downloads that failed after all retries.
+        retries (int): The number of retried download attempts.
+        bytes_total (int): The number of bytes downloaded.
+        bytes_per_second (float): The download rate over the last seconds.
+    """
+    queue_depth: int
+    active: int
+    done: int
+    failed: int
+    retries: int
+    bytes_total: int
+    bytes_per_second: float
+
+
+class SessionInfo(TypedDict):
+    """
+    Represents a capture session in the session catalog.
+
+    Attributes:
+        id (str): The ID of the session.
+        type (str): 'photo', 'stack', 'trigger', 'aruco' or 'unknown' for imported archives.
+        started (float): The start of the session as Unix time.
+        cameras (int): The number of cameras the session was sent to.
+        photos (int): The number of downloaded photos.
+        bytes (int): The size of the downloaded photos in bytes.
+        completed (float | None): The time all photos had arrived and were stacked.
+        zipped (float | None): The time the zip archive was finished.
+        zip_size (int | None): The size of the zip archive in bytes.
+        usb (float | None): The time the archive was copied to USB.
+        duration (float | None): The time from the start until the archive was finished in seconds.
+    """
+    id: str
+    type: str
+    started: float
+    cameras: int
+    photos: int
+    bytes: int
+    completed: float | None
+    zipped: float | None
+    zip_size: int | None
+    usb: float | None
+    duration: float | None
+
+
+class ProxyStats(TypedDict):
+    """
+    Represents the statistics of the reverse proxy to the cameras.
+
+    Attributes:
+        requests (int): The number of proxied requests.
+        active (int): The number of responses currently streamed.
+        cached (int): The number of requests answered from the cache.
+        coalesced (int): The number of requests that waited for an identical running request.
+        errors (int): The number of requests the camera did not answer.
+        bytes_total (int): The number of bytes passed through.
+    """
+    requests: int
+    active: int
+    cached: int
+    coalesced: int
+    errors: int
+    bytes_total: int
+
+
+class CommandLatency(TypedDict):
+    """
+    Represents the statistics of one command type of a camera.
+
+    Attributes:
+        count (int): The number of executed commands.
+        cancelled (int): The number of commands dropped because a newer one superseded them.
+        avg_wait (float): The average time in the queue in seconds.
+        avg_run (float): The average execution time in seconds.
+        max_latency (float): The maximum time from receiving to finishing in seconds.
+    """
+    count: int
+    cancelled: int
+    avg_wait: float
+    avg_run: float
+    max_latency: float
+
+
+class CommandStats(TypedDict):
+    """
+    Represents the statistics of the command dispatcher of a camera.
+
+    Attributes:
+        queue_depth (int): The number of queued hardware commands.
+        running (str | None): The hardware command currently executed.
+        commands (dict[str, CommandLatency]): The statistics by command name.
+    """
+    queue_depth: int
+    running: str | None
+    commands: dict[str, CommandLatency]
+
+
+class MessagingStats(TypedDict):
+    """
+    Represents the statistics of the UDP messaging endpoint.
+
+    Attributes:
+        messages (int): The number of sent datagrams including retransmissions.
+        batches (int): The number of packets the datagrams were sent in.
+        bytes_total (int): The number of bytes sent.
+        queue_depth (int): The number of datagrams waiting for the sender.
+        unacknowledged (int): The number of messages waiting for acknowledgements.
+        avg_latency (float): The mean time in seconds between queueing and sending.
+        max_latency (float): The maximum time in seconds between queueing and sending.
+        errors (int): The number of failed send calls.
+    """
+    messages: int
+    batches: int
+    bytes_total: int
+    queue_depth: int
+    unacknowledged: int
+    avg_latency: float
+    max_latency: float
+    errors: int
+
+
+class ArucoStats(TypedDict):
+    """
+    Represents the timing of one Aruco detection.
+
+    Attributes:
+        mode (Literal['roi', 'scaled', 'full']): The pass the markers have been found in.
+        markers (int): The number of markers found.
+        windows (int): The number of windows searched at full resolution.
+        search (float): The time of the search in the downscaled image in ms.
+        refine (float): The time of the search in the windows in ms.
+        full (float): The time of the search in the full image in ms.
+        total (float): The time of the detection in ms.
+    """
+    mode: Literal['roi', 'scaled', 'full']
+    markers: int
+    windows: int
+    search: float
+    refine: float
+    full: float
+    total: float
+
+
+class ArucoWorkerStats(TypedDict):
+    """
+    Represents the counters of the Aruco worker of a camera.
+
+    Attributes:
+        queued (int): The number of frames waiting for the detection.
+        in_memory (int): The number of waiting frames kept in memory.
+        processed (int): The number of detections.
+        reused (int): The number of frames that got the result of another frame of the stack.
+        spilled (int): The number of frames read again from their file.
+        errors (int): The number of failed detections.
+        detections (list[ArucoStats]): The timings of the last detections.
+    """
+    queued: int
+    in_memory: int
+    processed: int
+    reused: int
+    spilled: int
+    errors: int
+    detections: NotRequired[list[ArucoStats]]
+
+
+class FocusModel(TypedDict):
+    """
+    Represents the learned settle times of the lens of a camera.
+
+    The sums are weighted, older moves have less weight.
+
+    Attributes:
+        n (float): The number of moves.
+        x (float): The sum of the distances in dioptre.
+        y (float): The sum of the settle times in s.
+        xx (float): The sum of the squared distances.
+        xy (float): The sum of the products of distance and settle time.
+    """
+    n: float
+    x: float
+    y: float
+    xx: float
+    xy: float
+
+
+class StreamStats(TypedDict):
+    """
+    Represents the counters of the live preview stream of a camera.
+
+    Attributes:
+        viewers (int): The number of connected viewers.
+        frames (int): The number of encoded frames.
+        skipped (int): The number of frames skipped while the camera was busy.
+        encode (float): The duration of the last encoding in ms.
+        size (int): The size of the last frame in bytes.
+    """
+    viewers: int
+    frames: int
+    skipped: int
+    encode: float
+    size: int
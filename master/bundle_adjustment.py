@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import numpy as np
+import numpy.typing as npt
+from scipy.optimize import least_squares
+from scipy.sparse import coo_matrix
+
+from common.logger import Logger
+from common.typen import ArucoMarkerCorners, ArucoMarkerPos, CameraExterior, Metadata, Point3D
+from master.marker_check import MarkerChecker, camera_matrix
+
+# parameters of a camera: rotation vector and translation vector
+CAMERA_PARAMS = 6
+# parameters of the intrinsics of a lens position: f, cx, cy, k1, k2, p1, p2, k3
+INTRINSIC_PARAMS = 8
+
+
+def rotation_matrices(rvecs: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Converts rotation vectors to rotation matrices (Rodrigues' formula).
+
+    Args:
+        rvecs: The rotation vectors, shape (n, 3).
+
+    Returns:
+        The rotation matrices, shape (n, 3, 3).
+    """
+    theta = np.linalg.norm(rvecs, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        k = np.where(theta[:, None] > 0, rvecs / theta[:, None], 0)
+    cross = np.zeros((len(rvecs), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -k[:, 2], k[:, 1], -k[:, 0]
+    cross -= cross.transpose(0, 2, 1)
+    sin = np.sin(theta)[:, None, None]
+    cos = np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * cross + (1 - cos) * cross @ cross
+
+
+def project(rotations: npt.NDArray[np.float64], tvecs: npt.NDArray[np.float64],
+            intrinsics: npt.NDArray[np.float64], points: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    Projects each point with its camera like cv2.projectPoints.
+
+    Args:
+        rotations: The rotation matrices, shape (n, 3, 3).
+        tvecs: The translation vectors, shape (n, 3).
+        intrinsics: f, cx, cy, k1, k2, p1, p2, k3 of each point, shape (n, 8).
+        points: The points, shape (n, 3).
+
+    Returns:
+        The image points, shape (n, 2).
+    """
+    p = np.einsum('nij,nj->ni', rotations, points) + tvecs
+    x = p[:, 0] / p[:, 2]
+    y = p[:, 1] / p[:, 2]
+    f, cx, cy, k1, k2, p1, p2, k3 = intrinsics.T
+    r2 = x * x + y * y
+    radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+    return np.stack([f * xd + cx, f * yd + cy], axis=1)
+
+
+class BundleAdjustment:
+    """
+    Refines all camera poses and marker coordinates together.
+
+    The reprojection errors of all observations are minimized with a robust
+    loss. The known marker coordinates are soft constraints with the standard
+    deviation coordinate_sigma, this fixes the datum of the network. The
+    intrinsics of each lens position can be refined, too.
+
+    The Jacobian is only evaluated for its non-zero entries: each observation
+    depends on one camera, one lens position and one point.
+
+    Attributes:
+        __hosts (list[str]): The cameras with pose, the index is used in the arrays.
+        __lenses (list[float]): The lens positions, the index is used in the arrays.
+        __keys (npt.NDArray[np.int64]): The keys (id * 4 + corner) of the points.
+        __camera (npt.NDArray[np.intp]): The camera of each observation.
+        __point (npt.NDArray[np.intp]): The point of each observation.
+        __image (npt.NDArray[np.float64]): The image coordinates of each observation.
+        __host_lens (npt.NDArray[np.intp]): The lens position of each camera.
+        __camera_params (npt.NDArray[np.float64]): rvecs and tvecs of each camera.
+        __intrinsics (npt.NDArray[np.float64]): The intrinsics of each lens position.
+        __prior (npt.NDArray[np.float64]): The given coordinates of the points.
+        __coords (npt.NDArray[np.float64]): The adjusted coordinates of the points.
+        __refine_intrinsics (bool): A boolean indicating if the intrinsics are refined.
+        __pixel_sigma (float): The standard deviation of an image coordinate in pixels.
+        __coordinate_sigma (float): The standard deviation of a given coordinate in meters.
+        __loss (str): The loss function of least_squares.
+        __f_scale (float): The residual in sigmas the robust loss starts at.
+        __is_adjusted (bool): A boolean indicating if the adjustment has been run.
+
+    Methods:
+        adjust(max_nfev: int = 100): None
+        get_poses(): dict[str, dict[str, np.ndarray]]
+        get_cameras(): dict[str, CameraExterior]
+        get_corrected_coordinates(): dict[int, ArucoMarkerCorners]
+        get_rms(): dict[str, float]
+    """
+
+    def __init__(self, marker_coords: dict[int, ArucoMarkerCorners], marker_pos: dict[str, list[ArucoMarkerPos]],
+                 metadata: dict[str, Metadata], poses: dict[str, dict[str, np.ndarray]],
+                 refine_intrinsics: bool = False, pixel_sigma: float = 1.0,
+                 coordinate_sigma: float = 0.001, loss: str = 'huber', f_scale: float = 3.0):
+        """
+        Initializes the BundleAdjustment object.
+
+        Args:
+            marker_coords: The known marker coordinates.
+            marker_pos: The detected markers per camera, e.g. the filtered positions of the MarkerChecker.
+            metadata: The metadata per camera containing the lens position.
+            poses: rvecs and tvecs per camera, e.g. MarkerChecker.get_poses().
+            refine_intrinsics: A boolean indicating if the intrinsics of each lens position are refined.
+            pixel_sigma: The standard deviation of an image coordinate in pixels.
+            coordinate_sigma: The standard deviation of a given coordinate in meters.
+            loss: The loss function of scipy.optimize.least_squares.
+            f_scale: The residual in sigmas the robust loss starts at.
+        """
+        self.__hosts = sorted(h for h in poses if h in marker_pos and
+                              'LensPosition' in metadata.get(h, {}))
+        self.__lenses = sorted({float(metadata[h]['LensPosition'])  # type: ignore
+                                for h in self.__hosts})
+        self.__host_lens = np.array([self.__lenses.index(float(metadata[h]['LensPosition']))  # type: ignore
+                                     for h in self.__hosts], dtype=np.intp)
+        self.__camera_params = np.array(
+            [np.r_[np.ravel(poses[h]['rvecs']), np.ravel(poses[h]['tvecs'])]
+             for h in self.__hosts], dtype=np.float64).reshape(-1, CAMERA_PARAMS)
+        self.__intrinsics = np.array([self.__intrinsic_vector(lens) for lens in self.__lenses],
+                                     dtype=np.float64).reshape(-1, INTRINSIC_PARAMS)
+
+        keys: list[int] = []
+        coords: list[tuple[float, float, float]] = []
+        for id, corners in marker_coords.items():
+            if corners is None:
+                continue
+            for corner, coord in enumerate(corners):
+                if coord is not None:
+                    keys.append(id * 4 + corner)
+                    coords.append((coord.x, coord.y, coord.z))
+        all_keys = np.asarray(keys, dtype=np.int64)
+        all_coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+        camera, key, image = [], [], []
+        for c, hostname in enumerate(self.__hosts):
+            for pos in marker_pos[hostname]:
+                camera.append(c)
+                key.append(pos['id'] * 4 + pos['corner'])
+                image.append((pos['x'], pos['y']))
+        key_a = np.asarray(key, dtype=np.int64)
+        # only observations of known points are adjusted
+        known = np.isin(key_a, all_keys)
+        self.__keys, self.__point = np.unique(key_a[known], return_inverse=True)
+        self.__camera = np.asarray(camera, dtype=np.intp)[known]
+        self.__image = np.asarray(image, dtype=np.float64).reshape(-1, 2)[known]
+        order = np.argsort(all_keys)
+        self.__prior = all_coords[order][np.searchsorted(all_keys[order], self.__keys)]
+        self.__coords = self.__prior.copy()
+        self.__marker_coords = marker_coords
+
+        self.__refine_intrinsics = refine_intrinsics
+        self.__pixel_sigma = pixel_sigma
+        self.__coordinate_sigma = coordinate_sigma
+        self.__loss = loss
+        self.__f_scale = f_scale
+        self.__is_adjusted = False
+
+    @staticmethod
+    def __intrinsic_vector(lens_position: float) -> npt.NDArray[np.float64]:
+        """
+        The intrinsics of the calibration of a lens position as parameter vector.
+        """
+        cameraMatrix, distCoeffs = camera_matrix(lens_position)
+        return np.r_[cameraMatrix[0, 0], cameraMatrix[0, 2], cameraMatrix[1, 2],
+                     distCoeffs[0], distCoeffs[1], distCoeffs[2], distCoeffs[3], distCoeffs[4]]
+
+    def __split(self, x: npt.NDArray[np.float64]) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+        """
+        Splits the parameter vector into cameras, intrinsics and points.
+        """
+        n = len(self.__hosts) * CAMERA_PARAMS
+        cameras = x[:n].reshape(-1, CAMERA_PARAMS)
+        intrinsics = self.__intrinsics
+        if self.__refine_intrinsics:
+            m = n + len(self.__lenses) * INTRINSIC_PARAMS
+            intrinsics = x[n:m].reshape(-1, INTRINSIC_PARAMS)
+            n = m
+        return cameras, intrinsics, x[n:].reshape(-1, 3)
+
+    def __project(self, cameras: npt.NDArray[np.float64], intrinsics: npt.NDArray[np.float64],
+                  points: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        """
+        Projects the point of each observation into its camera.
+        """
+        rotations = rotation_matrices(cameras[:, :3])
+        return project(rotations[self.__camera], cameras[self.__camera, 3:],
+                       intrinsics[self.__host_lens[self.__camera]], points[self.__point])
+
+    def __residuals(self, x: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        """
+        The reprojection errors and the differences to the given coordinates in sigmas.
+        """
+        cameras, intrinsics, points = self.__split(x)
+        image = self.__project(cameras, intrinsics, points)
+        return np.r_[((image - self.__image) / self.__pixel_sigma).ravel(),
+                     ((points - self.__prior) / self.__coordinate_sigma).ravel()]
+
+    def __sparsity(self) -> coo_matrix:
+        """
+        The non-zero entries of the Jacobian.
+        """
+        n_obs = len(self.__camera)
+        n_cam = len(self.__hosts) * CAMERA_PARAMS
+        n_int = len(self.__lenses) * INTRINSIC_PARAMS if self.__refine_intrinsics else 0
+        obs_rows = np.arange(2 * n_obs)[:, None]
+
+        blocks = [(self.__camera * CAMERA_PARAMS, CAMERA_PARAMS),
+                  (n_cam + n_int + self.__point * 3, 3)]
+        if self.__refine_intrinsics:
+            blocks.append((n_cam + self.__host_lens[self.__camera] * INTRINSIC_PARAMS,
+                           INTRINSIC_PARAMS))
+        rows, cols = [], []
+        for first, size in blocks:
+            # both image coordinates of an observation depend on the block
+            col = np.repeat(first, 2)[:, None] + np.arange(size)
+            rows.append(np.broadcast_to(obs_rows, col.shape).ravel())
+            cols.append(col.ravel())
+        # the prior of a coordinate depends only on the coordinate
+        prior = np.arange(len(self.__keys) * 3)
+        rows.append(2 * n_obs + prior)
+        cols.append(n_cam + n_int + prior)
+        rows_a, cols_a = np.concatenate(rows), np.concatenate(cols)
+        return coo_matrix((np.ones(len(rows_a), dtype=np.int8), (rows_a, cols_a)),
+                          shape=(2 * n_obs + len(prior), n_cam + n_int + len(prior)))
+
+    def adjust(self, max_nfev: int = 100) -> None:
+        """
+        Runs the adjustment.
+
+        A least squares pass brings the parameters close to the solution, the
+        robust loss is applied starting from there. The robust loss alone
+        converges slowly if most residuals start in its flat part.
+
+        Args:
+            max_nfev: The maximum number of function evaluations of each pass.
+        """
+        self.__is_adjusted = True
+        if len(self.__camera) == 0:
+            Logger().warning("No observations to adjust")
+            return
+        x = [self.__camera_params.ravel()]
+        if self.__refine_intrinsics:
+            x.append(self.__intrinsics.ravel())
+        x.append(self.__coords.ravel())
+        before = self.__total_rms()
+        sparsity = self.__sparsity()
+        evaluations = 0
+        result = None
+        for loss in dict.fromkeys(['linear', self.__loss]):
+            result = least_squares(self.__residuals, np.concatenate(x) if result is None else result.x,
+                                   jac_sparsity=sparsity, x_scale='jac', method='trf',
+                                   tr_solver='lsmr', loss=loss, f_scale=self.__f_scale,
+                                   max_nfev=max_nfev)
+            evaluations += result.nfev
+        assert result is not None
+        cameras, intrinsics, points = self.__split(result.x)
+        self.__camera_params = cameras.copy()
+        self.__intrinsics = intrinsics.copy()
+        self.__coords = points.copy()
+        Logger().info("Bundle adjustment of %d cameras and %d points: RMS %.2f px -> %.2f px (%d evaluations)",
+                      len(self.__hosts), len(self.__keys), before, self.__total_rms(), evaluations)
+
+    def __total_rms(self) -> float:
+        """
+        The RMS of the reprojection errors of all observations in pixels.
+        """
+        return float(np.sqrt(np.mean(self.__errors() ** 2)))
+
+    def __errors(self) -> npt.NDArray[np.float64]:
+        """
+        The reprojection error of each observation in pixels.
+        """
+        image = self.__project(self.__camera_params, self.__intrinsics, self.__coords)
+        return np.linalg.norm(image - self.__image, axis=1)
+
+    def get_rms(self) -> dict[str, float]:
+        """
+        Get the RMS of the reprojection errors of each camera.
+
+        Returns:
+            A dictionary containing the RMS in pixels per camera.
+        """
+        errors = self.__errors()
+        counts = np.bincount(self.__camera, minlength=len(self.__hosts))
+        squares = np.bincount(self.__camera, weights=errors ** 2, minlength=len(self.__hosts))
+        return {h: float(np.sqrt(squares[i] / counts[i]))
+                for i, h in enumerate(self.__hosts) if counts[i] > 0}
+
+    def get_poses(self) -> dict[str, dict[str, np.ndarray]]:
+        """
+        Get the adjusted intrinsics, rotation and translation vectors of the cameras.
+
+        Returns:
+            A dictionary containing cameraMatrix, distCoeffs, rvecs and tvecs per camera.
+        """
+        if not self.__is_adjusted:
+            self.adjust()
+        poses = {}
+        for i, hostname in enumerate(self.__hosts):
+            f, cx, cy, k1, k2, p1, p2, k3 = self.__intrinsics[self.__host_lens[i]]
+            poses[hostname] = {
+                'cameraMatrix': np.array([[f, 0, cx], [0, f, cy], [0, 0, 1]]),
+                'distCoeffs': np.array([k1, k2, p1, p2, k3]),
+                'rvecs': self.__camera_params[i, :3].reshape(3, 1).copy(),
+                'tvecs': self.__camera_params[i, 3:].reshape(3, 1).copy()}
+        return poses
+
+    def get_cameras(self) -> dict[str, CameraExterior]:
+        """
+        Get the adjusted exterior orientations of the cameras.
+
+        Returns:
+            A dictionary containing the cameras.
+        """
+        return {hostname: MarkerChecker.camera_exterior(pose['rvecs'], pose['tvecs'])
+                for hostname, pose in self.get_poses().items()}
+
+    def get_corrected_coordinates(self) -> dict[int, ArucoMarkerCorners]:
+        """
+        Get the marker coordinates with the adjusted points.
+
+        Returns:
+            A dictionary containing the marker coordinates.
+        """
+        if not self.__is_adjusted:
+            self.adjust()
+        d: dict[int, ArucoMarkerCorners] = {}
+        for id, corners in self.__marker_coords.items():
+            if corners is None:
+                continue
+            d[id] = ArucoMarkerCorners({corner: coord for corner, coord in enumerate(corners)
+                                        if coord is not None})
+        for key, coord in zip(self.__keys.tolist(), self.__coords.tolist()):
+            id, corner = divmod(key, 4)
+            d[id][corner] = Point3D(*coord)
+        return d
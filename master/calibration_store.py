@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import sqlite3
+from json import dumps, loads
+from threading import Lock
+from time import time
+
+import numpy as np
+
+from common.typen import ArucoMarkerCorners, ArucoMarkerPos, Metadata, Point3D
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    session TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS markers (
+    id INTEGER NOT NULL,
+    corner INTEGER NOT NULL,
+    version INTEGER NOT NULL REFERENCES versions(version),
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    z REAL NOT NULL,
+    PRIMARY KEY (id, corner, version)
+);
+CREATE TABLE IF NOT EXISTS cameras (
+    hostname TEXT NOT NULL,
+    version INTEGER NOT NULL REFERENCES versions(version),
+    lens_position REAL,
+    camera_matrix TEXT NOT NULL,
+    dist_coeffs TEXT NOT NULL,
+    rvecs TEXT NOT NULL,
+    tvecs TEXT NOT NULL,
+    PRIMARY KEY (hostname, version)
+);
+CREATE TABLE IF NOT EXISTS observations (
+    version INTEGER NOT NULL REFERENCES versions(version),
+    hostname TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    corner INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS observations_host ON observations (hostname, version);
+"""
+
+
+class CalibrationStore:
+    """
+    Versioned database of marker coordinates, camera orientations and observations.
+
+    Every calibration creates a new version. Only marker corners whose
+    coordinate has changed are stored again, the current marker map is the
+    latest version of each corner. The orientation of each solved camera and
+    the observations it was solved from are stored with the version, so a
+    camera whose observations have not moved can reuse its last pose.
+
+    Attributes:
+        __db (sqlite3.Connection): The connection to the database.
+        __lock (Lock): Lock for the access to the connection.
+
+    Methods:
+        begin_version(session: str): int
+        get_markers(): dict[int, ArucoMarkerCorners]
+        set_markers(version: int, markers: dict[int, ArucoMarkerCorners]): int
+        add_observations(version: int, marker_pos: dict[str, list[ArucoMarkerPos]]): None
+        set_cameras(version: int, poses: dict[str, dict[str, np.ndarray]], metadata: dict[str, Metadata], changed: set[str] | None = None): None
+        get_last_pose(hostname: str): dict[str, np.ndarray] | None
+        get_last_poses(): dict[str, dict[str, np.ndarray]]
+        changed_cameras(marker_pos: dict[str, list[ArucoMarkerPos]], metadata: dict[str, Metadata], tolerance: float = 0.5): set[str]
+        close(): None
+    """
+
+    def __init__(self, file: str):
+        """
+        Initializes the CalibrationStore object, the tables are created if necessary.
+
+        Args:
+            file: The SQLite database file.
+        """
+        self.__db = sqlite3.connect(file, check_same_thread=False)
+        self.__lock = Lock()
+        with self.__lock, self.__db:
+            self.__db.executescript(SCHEMA)
+
+    def begin_version(self, session: str) -> int:
+        """
+        Creates a new version.
+
+        Args:
+            session: The ID of the session the version is calculated from.
+
+        Returns:
+            The number of the version.
+        """
+        with self.__lock, self.__db:
+            cursor = self.__db.execute(
+                "INSERT INTO versions (session, created) VALUES (?, ?)", (session, time()))
+            return int(cursor.lastrowid or 0)
+
+    def get_markers(self) -> dict[int, ArucoMarkerCorners]:
+        """
+        Get the latest coordinate of each marker corner.
+
+        Returns:
+            A dictionary containing the marker coordinates.
+        """
+        with self.__lock:
+            rows = self.__db.execute(
+                """SELECT m.id, m.corner, m.x, m.y, m.z FROM markers m
+                   JOIN (SELECT id, corner, MAX(version) AS version FROM markers
+                         GROUP BY id, corner) latest USING (id, corner, version)""").fetchall()
+        markers: dict[int, ArucoMarkerCorners] = {}
+        for id, corner, x, y, z in rows:
+            markers.setdefault(id, ArucoMarkerCorners())[corner] = Point3D(x, y, z)
+        return markers
+
+    def set_markers(self, version: int, markers: dict[int, ArucoMarkerCorners]) -> int:
+        """
+        Stores the marker corners whose coordinate differs from the latest version.
+
+        Args:
+            version: The version the coordinates belong to.
+            markers: The marker coordinates.
+
+        Returns:
+            The number of corners stored.
+        """
+        current = self.get_markers()
+        rows = []
+        for id, corners in markers.items():
+            if corners is None:
+                continue
+            for corner, coord in enumerate(corners):
+                if coord is None:
+                    continue
+                old = current[id][corner] if id in current else None
+                if old is not None and np.allclose(old, coord, rtol=0, atol=1e-9):
+                    continue
+                rows.append((id, corner, version, coord.x, coord.y, coord.z))
+        with self.__lock, self.__db:
+            self.__db.executemany(
+                "INSERT OR REPLACE INTO markers VALUES (?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def add_observations(self, version: int, marker_pos: dict[str, list[ArucoMarkerPos]]) -> None:
+        """
+        Stores the detected markers of a version.
+
+        Args:
+            version: The version the observations belong to.
+            marker_pos: The detected markers per camera.
+        """
+        with self.__lock, self.__db:
+            self.__db.executemany(
+                "INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?)",
+                ((version, hostname, pos['id'], pos['corner'], pos['x'], pos['y'])
+                 for hostname, positions in marker_pos.items() for pos in positions))
+
+    def set_cameras(self, version: int, poses: dict[str, dict[str, np.ndarray]],
+                    metadata: dict[str, Metadata], changed: set[str] | None = None) -> None:
+        """
+        Stores the orientation of the cameras solved in a version.
+
+        Args:
+            version: The version the orientations belong to.
+            poses: cameraMatrix, distCoeffs, rvecs and tvecs per camera.
+            metadata: The metadata per camera containing the lens position.
+            changed: The cameras with changed observations. The other cameras
+                are only stored if their pose differs from the latest one, so
+                their observations are still compared to the ones they have
+                been solved from. None stores all cameras.
+        """
+        if changed is not None:
+            last = self.get_last_poses()
+            poses = {hostname: pose for hostname, pose in poses.items()
+                     if hostname in changed or hostname not in last or not all(
+                         np.allclose(np.ravel(pose[k]), np.ravel(last[hostname][k]), rtol=0, atol=1e-9)
+                         for k in ['rvecs', 'tvecs'])}
+        with self.__lock, self.__db:
+            self.__db.executemany(
+                "INSERT OR REPLACE INTO cameras VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((hostname, version, metadata.get(hostname, {}).get('LensPosition'),
+                  dumps(np.asarray(pose['cameraMatrix']).tolist()),
+                  dumps(np.asarray(pose['distCoeffs']).ravel().tolist()),
+                  dumps(np.asarray(pose['rvecs']).ravel().tolist()),
+                  dumps(np.asarray(pose['tvecs']).ravel().tolist()))
+                 for hostname, pose in poses.items()))
+
+    def __last_cameras(self, hostname: str | None = None) -> list[tuple]:
+        """
+        The latest row of the cameras table of each camera or of one camera.
+        """
+        query = """SELECT c.hostname, c.version, c.lens_position, c.camera_matrix,
+                          c.dist_coeffs, c.rvecs, c.tvecs FROM cameras c
+                   JOIN (SELECT hostname, MAX(version) AS version FROM cameras
+                         {} GROUP BY hostname) latest USING (hostname, version)"""
+        with self.__lock:
+            if hostname is None:
+                return self.__db.execute(query.format("")).fetchall()
+            return self.__db.execute(query.format("WHERE hostname = ?"), (hostname,)).fetchall()
+
+    @staticmethod
+    def __pose(row: tuple) -> dict[str, np.ndarray]:
+        return {'cameraMatrix': np.array(loads(row[3])),
+                'distCoeffs': np.array(loads(row[4])),
+                'rvecs': np.array(loads(row[5])).reshape(3, 1),
+                'tvecs': np.array(loads(row[6])).reshape(3, 1)}
+
+    def get_last_pose(self, hostname: str) -> dict[str, np.ndarray] | None:
+        """
+        Get the latest orientation of a camera.
+
+        Args:
+            hostname: The hostname of the camera.
+
+        Returns:
+            cameraMatrix, distCoeffs, rvecs and tvecs or None if the camera has never been solved.
+        """
+        rows = self.__last_cameras(hostname)
+        return self.__pose(rows[0]) if rows else None
+
+    def get_last_poses(self) -> dict[str, dict[str, np.ndarray]]:
+        """
+        Get the latest orientation of each camera.
+
+        Returns:
+            A dictionary containing cameraMatrix, distCoeffs, rvecs and tvecs per camera.
+        """
+        return {row[0]: self.__pose(row) for row in self.__last_cameras()}
+
+    def changed_cameras(self, marker_pos: dict[str, list[ArucoMarkerPos]],
+                        metadata: dict[str, Metadata], tolerance: float = 0.5) -> set[str]:
+        """
+        Finds the cameras whose observations differ from the ones of their last orientation.
+
+        A camera has changed if it has never been solved, its lens position
+        is different, it detected other marker corners or one of them moved
+        more than the tolerance.
+
+        Args:
+            marker_pos: The detected markers per camera.
+            metadata: The metadata per camera containing the lens position.
+            tolerance: The maximum movement of a corner in pixels.
+
+        Returns:
+            The hostnames of the changed cameras.
+        """
+        last = {row[0]: (row[1], row[2]) for row in self.__last_cameras()}
+        changed = set()
+        for hostname, positions in marker_pos.items():
+            if hostname not in last or last[hostname][1] != metadata.get(hostname, {}).get('LensPosition'):
+                changed.add(hostname)
+                continue
+            with self.__lock:
+                rows = self.__db.execute(
+                    "SELECT id, corner, x, y FROM observations WHERE hostname = ? AND version = ?",
+                    (hostname, last[hostname][0])).fetchall()
+            old = {(id, corner): (x, y) for id, corner, x, y in rows}
+            new = {(pos['id'], pos['corner']): (pos['x'], pos['y']) for pos in positions}
+            if old.keys() != new.keys():
+                changed.add(hostname)
+                continue
+            keys = list(new)
+            moved = np.hypot(*(np.array([new[k] for k in keys]) -
+                               np.array([old[k] for k in keys])).T).reshape(-1)
+            if len(moved) and moved.max() > tolerance:
+                changed.add(hostname)
+        return changed
+
+    def close(self) -> None:
+        """
+        Closes the database.
+        """
+        with self.__lock:
+            self.__db.close()
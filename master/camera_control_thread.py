@@ -6,7 +6,6 @@
 @version: 2024.03.11
 """
 
-import socket
 from threading import Thread
 from common.logger import Logger
 from master.stoppable_thread import StoppableThread
@@ -38,41 +37,40 @@ class CameraControlThread(StoppableThread):
             None
         """
 
-        socket_rec = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        socket_rec.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        port = int(self.__conf['both']['BroadCastPort'])
-        free_port_found = False
-        while free_port_found is False:
-            try:
-                socket_rec.bind(("0.0.0.0", port))
-                free_port_found = True
-                if port == int(self.__conf['both']['BroadCastPort']):
-                    Logger().info(
-                        "CameraControlThread is listening on port %s", port)
-                else:
-                    Logger().info("CameraControlThread is listening on ",
-                                  "port %s", port, "because port",
-                                  self.__conf['both']['BroadCastPort'],
-                                  "was already in use")
-            except OSError:
-                Logger().error("Port %s already in use", port)
-                port += 1
+        endpoint = self.__control.get_endpoint()
+        port = endpoint.listen("0.0.0.0", search_free_port=True)
+        if port == int(self.__conf['both']['BroadCastPort']):
+            Logger().info(
+                "CameraControlThread is listening on port %s", port)
+        else:
+            Logger().info("CameraControlThread is listening on port %s because port %s was already in use",
+                          port, self.__conf['both']['BroadCastPort'])
         while self.__control.is_system_stopping() is False:
-            # sock.sendto(bytes("hello", "utf-8"), ip_co)
-            data, addr = socket_rec.recvfrom(10000)
-            Logger().info("received message: %s", data)
-            Logger().info(addr)
-            data = data.decode("utf-8")
-            Logger().info("%s: %s", addr[0], data)
-            if data[:4] == 'Moin':
-                Thread(target=self.__control.found_camera,
-                       args=(data[5:], addr[0])).start()
-            elif data[:10] == 'photoDone:':
-                data = data[10:].split(":", 2)
-                self.__control.receive_photo(addr[0], data[0], data[1])
-            elif data[:11] == 'arucoReady:':
-                Logger().info(data)
-                self.__control.receive_aruco(data[11:])
-            elif data[:5] == 'light':
-                self.__control.get_leds().photo_light()
-        socket_rec.close()
+            for envelope, addr in endpoint.receive():
+                self.__handle(envelope.payload, addr)
+        endpoint.close()
+
+    def __handle(self, payload: bytes, addr: tuple[str, int]) -> None:
+        """
+        Executes the action of a received message.
+        """
+        Logger().info("received message: %s", payload[:100])
+        Logger().info(addr)
+        if payload[:9] == b'arucoBin:':
+            self.__control.receive_aruco_fragment(payload[9:])
+            return
+        data = payload.decode("utf-8")
+        Logger().info("%s: %s", addr[0], data)
+        if data[:4] == 'Moin':
+            Thread(target=self.__control.found_camera,
+                   args=(data[5:], addr[0])).start()
+        elif data[:10] == 'photoDone:':
+            data = data[10:].split(":", 2)
+            self.__control.receive_photo(addr[0], data[0], data[1])
+        elif data[:11] == 'arucoReady:':
+            Logger().info(data)
+            self.__control.receive_aruco(data[11:])
+        elif data[:9] == 'arucoUrl:':
+            self.__control.fetch_aruco(addr[0], data[9:])
+        elif data[:5] == 'light':
+            self.__control.get_leds().photo_light()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from collections import OrderedDict
+from threading import Event, Lock
+from time import monotonic
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from requests import RequestException, Response, Timeout
+from urllib3.exceptions import HTTPError
+
+from common.logger import Logger
+from common.typen import ProxyStats
+from master.session_pool import SessionPool
+
+# headers of a single connection, they are not forwarded
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                        'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'])
+
+
+class ProxyResponse(NamedTuple):
+    """
+    Represents the answer of a camera passed through the proxy.
+
+    Attributes:
+        status (int): The HTTP status code.
+        headers (list[tuple[str, str]]): The end-to-end headers of the answer.
+        body (Iterator[bytes]): The body in chunks, the connection is released after the last chunk.
+    """
+    status: int
+    headers: list[tuple[str, str]]
+    body: Iterator[bytes]
+
+
+class CameraProxy:
+    """
+    Passes requests of the web interface through to the cameras.
+
+    Every camera gets a keep-alive session, the answers are streamed in
+    chunks without being decoded or buffered, so multipart streams like
+    the live preview pass through as well. If a cache time is set, small
+    complete answers to GET requests are kept for that time and identical
+    requests arriving while the first one is running wait for its answer
+    instead of asking the camera again.
+
+    Attributes:
+        __sessions (SessionPool): The keep-alive sessions per camera.
+        __timeout (tuple[float, float]): The connect and read timeout in seconds.
+        __cache_ttl (float): The time an answer is kept in seconds, 0 disables the cache.
+        __cache (OrderedDict[str, tuple[float, int, list[tuple[str, str]], bytes]]): The cached answers by url.
+        __running (dict[str, Event]): The cacheable requests currently running by url.
+
+    Methods:
+        request(method: str, host: str, path: str, query: str, headers: Iterable[tuple[str, str]],
+                body: bytes | None): ProxyResponse
+        get_stats(): ProxyStats
+        close(): None
+    """
+
+    def __init__(self, pool_size: int = 4, connect_timeout: float = 2., read_timeout: float = 10.,
+                 cache_ttl: float = 0., cache_entries: int = 64, cache_max_bytes: int = 4 << 20,
+                 chunk_size: int = 65536, clock: Callable[[], float] = monotonic):
+        """
+        Initializes the CameraProxy object.
+
+        Args:
+            pool_size: The number of connections kept open per camera.
+            connect_timeout: The timeout for connecting to a camera in seconds.
+            read_timeout: The maximum time between two chunks of an answer in seconds.
+            cache_ttl: The time an answer is kept in seconds, 0 disables the cache.
+            cache_entries: The maximum number of cached answers.
+            cache_max_bytes: The maximum size of a cached answer.
+            chunk_size: The size of the chunks passed through.
+            clock: The time source of the cache.
+        """
+        self.__sessions = SessionPool(pool_size)
+        self.__timeout = (connect_timeout, read_timeout)
+        self.__cache_ttl = cache_ttl
+        self.__cache_entries = cache_entries
+        self.__cache_max_bytes = cache_max_bytes
+        self.__chunk_size = chunk_size
+        self.__clock = clock
+
+        self.__lock = Lock()
+        self.__cache: OrderedDict[str, tuple[float, int, list[tuple[str, str]], bytes]] = OrderedDict()
+        self.__running: dict[str, Event] = {}
+        self.__stats: ProxyStats = {'requests': 0, 'active': 0, 'cached': 0,
+                                    'coalesced': 0, 'errors': 0, 'bytes_total': 0}
+
+    def request(self, method: str, host: str, path: str, query: str = "",
+                headers: Iterable[tuple[str, str]] = (), body: bytes | None = None) -> ProxyResponse:
+        """
+        Forwards a request to a camera.
+
+        Args:
+            method: The HTTP method.
+            host: The host (ip or ip:port) of the camera.
+            path: The path on the camera without the leading slash.
+            query: The query string without the question mark.
+            headers: The headers of the request, hop-by-hop headers are dropped.
+            body: The body of the request.
+
+        Returns:
+            The answer of the camera, 502 if the camera cannot be reached
+            and 504 if it does not answer in time.
+        """
+        url = f"http://{host}/{path}" + ("?" + query if query else "")
+        with self.__lock:
+            self.__stats['requests'] += 1
+        key = url if method == "GET" and self.__cache_ttl > 0 else None
+        if key is not None:
+            cached = self.__from_cache(key)
+            if cached is None and not self.__start(key):
+                # an identical request was running, if its answer could not be cached
+                # this one is sent without the cache
+                cached = self.__from_cache(key)
+                key = None
+            if cached is not None:
+                return cached
+
+        forward = [(k, v) for k, v in headers
+                   if k.lower() not in HOP_BY_HOP and k.lower() not in ('host', 'content-length')]
+        try:
+            r = self.__sessions.get(host).request(
+                method, url, headers=dict(forward), data=body or None, stream=True,
+                timeout=self.__timeout, allow_redirects=False)
+        except RequestException as e:
+            Logger().warning("Proxy request to %s failed: %s", url, e)
+            with self.__lock:
+                self.__stats['errors'] += 1
+            if key is not None:
+                self.__finish(key)
+            status = 504 if isinstance(e, Timeout) else 502
+            return ProxyResponse(status, [('Content-Type', 'text/plain')], iter([str(e).encode()]))
+
+        response_headers = [(k, v) for k, v in r.headers.items() if k.lower() not in HOP_BY_HOP]
+        if key is not None and not self.__cacheable(r):
+            self.__finish(key)
+            key = None
+        with self.__lock:
+            self.__stats['active'] += 1
+        return ProxyResponse(r.status_code, response_headers,
+                             self.__stream(r, key, response_headers))
+
+    def __cacheable(self, r: Response) -> bool:
+        content_type = r.headers.get('Content-Type', '')
+        length = r.headers.get('Content-Length')
+        return (r.status_code == 200 and not content_type.startswith('multipart/')
+                and 'no-store' not in r.headers.get('Cache-Control', '')
+                and (length is None or int(length) <= self.__cache_max_bytes))
+
+    def __stream(self, r: Response, key: str | None,
+                 headers: list[tuple[str, str]]) -> Iterator[bytes]:
+        """
+        Passes the body through in chunks and keeps a copy for the cache.
+        """
+        chunks: list[bytes] | None = [] if key is not None else None
+        size = 0
+        complete = False
+        try:
+            # raw bytes, a compressed answer stays compressed and matches its headers
+            for chunk in r.raw.stream(self.__chunk_size, decode_content=False):
+                with self.__lock:
+                    self.__stats['bytes_total'] += len(chunk)
+                if chunks is not None:
+                    size += len(chunk)
+                    if size > self.__cache_max_bytes:
+                        chunks = None
+                    else:
+                        chunks.append(chunk)
+                yield chunk
+            complete = True
+        except (HTTPError, OSError) as e:
+            Logger().warning("Proxy answer from %s interrupted: %s", r.url, e)
+            with self.__lock:
+                self.__stats['errors'] += 1
+        finally:
+            r.close()
+            with self.__lock:
+                self.__stats['active'] -= 1
+            if key is not None:
+                if complete and chunks is not None:
+                    self.__store(key, r.status_code, headers, b"".join(chunks))
+                self.__finish(key)
+
+    def __from_cache(self, key: str) -> ProxyResponse | None:
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is None or entry[0] < self.__clock():
+                return None
+            self.__stats['cached'] += 1
+        _, status, headers, data = entry
+        return ProxyResponse(status, headers, iter([data]))
+
+    def __store(self, key: str, status: int, headers: list[tuple[str, str]], data: bytes) -> None:
+        with self.__lock:
+            now = self.__clock()
+            for k in [k for k, entry in self.__cache.items() if entry[0] < now]:
+                del self.__cache[k]
+            self.__cache[key] = (now + self.__cache_ttl, status, headers, data)
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.__cache_entries:
+                self.__cache.popitem(last=False)
+
+    def __start(self, key: str) -> bool:
+        """
+        Registers a cacheable request or waits for an identical running one.
+
+        Returns:
+            True if the request has been registered, False after waiting for the running one.
+        """
+        with self.__lock:
+            running = self.__running.get(key)
+            if running is None:
+                self.__running[key] = Event()
+                return True
+            self.__stats['coalesced'] += 1
+        running.wait(sum(self.__timeout))
+        return False
+
+    def __finish(self, key: str) -> None:
+        with self.__lock:
+            running = self.__running.pop(key, None)
+        if running is not None:
+            running.set()
+
+    def get_stats(self) -> ProxyStats:
+        """
+        Returns the statistics of the proxy.
+
+        Returns:
+            The request, cache and transfer counters.
+        """
+        with self.__lock:
+            return ProxyStats(**self.__stats)
+
+    def close(self) -> None:
+        """
+        Closes all sessions.
+        """
+        self.__sessions.close()
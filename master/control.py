@@ -9,35 +9,40 @@
 import atexit
 from queue import Queue
 import socket
+import struct
+import zlib
 import pandas as pd
 from common.logger import Logger
 
 from flask import Flask, render_template
-from threading import Thread
+from threading import Lock, Thread, Timer
 from time import sleep
 import uuid
 from os import system, makedirs, path
 import requests
 from json import loads as json_loads
 from shutil import make_archive
-from glob import glob
-from os.path import basename
-from cv2 import imread, imwrite
 from json import dump as json_dump
-from time import clock_settime, clock_gettime, CLOCK_REALTIME
+from time import clock_settime, clock_gettime, CLOCK_REALTIME, time_ns
 
 from master.desktop_control_thread import DesktopControlThread
 from master.camera_control_thread import CameraControlThread
 from master.marker_check import MarkerChecker
+from master.bundle_adjustment import BundleAdjustment
+from master.calibration_store import CalibrationStore
 from master.stoppable_thread import StoppableThread
 from master.button_control import ButtonControl
 from master.led_control import LedControl
-from master.focus_stack import focus_stack
+from master.focus_stack_pool import FocusStackPool
+from master.photo_downloader import DownloadJob, PhotoDownloader
+from master.session_archive import SessionArchive
+from master.session_catalog import SessionCatalog
+from master.thumbnails import ThumbnailCache
+from common.messaging import MessageEndpoint
+from common.aruco_codec import FragmentBuffer, decode_aruco
 
 from typing import Literal, NoReturn
-from numpy.typing import NDArray
-from numpy import uint8
-from common.typen import ArucoMarkerPos, ArucoMetaBroadcast, CommonCamSettings, Metadata, Point3D, ArucoMarkerCorners
+from common.typen import ArucoMarkerPos, ArucoMetaBroadcast, CommonCamSettings, DownloadStats, MessagingStats, Metadata, Point3D, ArucoMarkerCorners
 from common.conf import Conf
 
 
@@ -50,16 +55,53 @@ class Control:
     __pending_download_count: dict[str, int] = {}
     __pending_aruco_count: dict[str, int] = {}
     __pending_photo_types: dict[str, Literal["photo", "stack"]] = {}
+    __stack_frames: dict[str, int] = {}
     __cams_in_standby = True
     __desktop_message_queue: Queue[str] = Queue()
     __marker: dict[int, ArucoMarkerCorners] = {}
     __metadata: dict[str, dict[str, Metadata]] = {}
     __camera_settings: CommonCamSettings
+    __counter_lock = Lock()
+    __calibration_lock = Lock()
+    __aruco_fragments = FragmentBuffer()
+    __zip_lock = Lock()
 
     def __init__(self,  app: Flask) -> None:
         self.__webapp = app
         self.__conf = Conf().get()
 
+        port = int(self.__conf['both']['BroadCastPort'])
+        self.__endpoint = MessageEndpoint(
+            socket.gethostname(), port,
+            # the cameras only receive broadcasts
+            lambda addr: ("255.255.255.255", port),
+            timeout=self.__conf['both'].getfloat('AckTimeout', 0.5),
+            retries=self.__conf['both'].getint('AckRetries', 5))
+
+        server_conf = self.__conf['server']
+        self.__session_timeout = server_conf.getfloat('SessionTimeout', 120)
+        # the cameras stack their frames and send only the fused image
+        self.__stack_on_camera = server_conf.getint('StackOnCamera', 0) == 1
+        self.__trigger_delay = server_conf.getfloat('TriggerDelay', 1.0)
+        self.__downloader = PhotoDownloader(
+            self.__photo_downloaded,
+            workers=server_conf.getint('DownloadWorkers', 4),
+            per_camera=server_conf.getint('DownloadsPerCamera', 2),
+            retries=server_conf.getint('DownloadRetries', 3),
+            backoff=server_conf.getfloat('DownloadBackoff', 0.5))
+        self.__stacker = FocusStackPool(
+            self.__photo_stacked,
+            workers=server_conf.getint('StackWorkers', 0),
+            tile_rows=server_conf.getint('StackTileRows', 0),
+            homography_file=server_conf['Folder'] + "homographies.json")
+        self.__archive: SessionArchive | None = None
+        if server_conf.getint('IncrementalZip', 1) == 1:
+            self.__archive = SessionArchive(server_conf['Folder'])
+        self.__thumbnails = ThumbnailCache(
+            server_conf['Folder'],
+            width=server_conf.getint('ThumbnailWidth', 320),
+            columns=server_conf.getint('MosaicColumns', 0))
+
         self.__camera_settings = {
             'exposure_sync': int(self.__conf['kameras']['ExposureSync']) == 1,
             'exposure_value': float(self.__conf['kameras']['ExposureValue'])
@@ -71,6 +113,11 @@ class Control:
 
         if not path.exists(self.__conf['server']['Folder']):
             makedirs(self.__conf['server']['Folder'])
+        self.__calibration = CalibrationStore(
+            self.__conf['server']['Folder'] + "calibration.sqlite")
+        self.__catalog = SessionCatalog(
+            self.__conf['server']['Folder'] + "sessions.sqlite")
+        self.__catalog.import_archives(self.__conf['server']['Folder'])
 
         self.__led_control = LedControl(self)
         self.__button_control = ButtonControl(self)
@@ -78,10 +125,15 @@ class Control:
         Logger().info("Control started!")
 
     def start(self):
+        # start the stacking workers now, not with the first stack
+        self.__stacker.start()
+
         self.thread_webinterface = StoppableThread(
             target=self.__webapp.run, args=('0.0.0.0', int(self.__conf['server']['WebPort'])))
         self.thread_webinterface.start()
 
+        self.__downloader.start()
+
         self.thread_camera_interface = CameraControlThread(self)
         self.thread_camera_interface.start()
 
@@ -98,8 +150,19 @@ class Control:
         if send_search:
             self.send_to_all('search')
 
-    def capture_photo(self, action: Literal['photo', 'stack'] = "photo",
-                      id: str = "") -> str:
+    def capture_photo(self, action: Literal['photo', 'stack', 'trigger'] = "photo",
+                      id: str = "", focus: list[float] | None = None) -> str:
+        """
+        Starts a capture on all cameras.
+
+        Args:
+            action: 'photo', 'stack' or 'trigger'.
+            id: The ID of the capture, a new one is created if empty.
+            focus: The lens positions of a stack in dioptre, defaults to StackFocus.
+
+        Returns:
+            The ID of the capture.
+        """
         if len(self.__list_of_cameras) == 0:
             self.send_to_desktop("No cameras found!")
             return "No cameras found!"
@@ -109,20 +172,72 @@ class Control:
 
         self.send_to_desktop(f"photoStart: {id}")
 
-        Thread(target=self.__capture_thread, args=(action, id)).start()
+        if focus is None or len(focus) == 0:
+            focus = [float(f) for f in self.__conf['kameras'].get(
+                'StackFocus', '1,2,4,5,7').split(',')]
+        Thread(target=self.__capture_thread, args=(action, id, focus)).start()
         return id
 
-    def __capture_thread(self, action: Literal['photo', 'stack'], id: str):
+    def __capture_thread(self, action: Literal['photo', 'stack', 'trigger'], id: str,
+                         focus: list[float]):
         if 'exposure_sync' in self.__camera_settings:
             self.sync_exposure()
 
-        photo_count = len(self.__list_of_cameras) * \
-            (5 if action == "stack" else 1)
+        fused = action == "stack" and self.__stack_on_camera
+        if fused:
+            # the fused image and its sharpness map, the markers of the base frame
+            photos, markers = 2, 1
+        elif action == "stack":
+            photos = markers = len(focus)
+        else:
+            photos = markers = 1
+        photo_count = len(self.__list_of_cameras) * photos
         self.__pending_photo_count[id] = photo_count
         self.__pending_download_count[id] = photo_count
-        self.__pending_aruco_count[id] = photo_count
-        self.__pending_photo_types[id] = action
-        self.send_to_all(f'{action}:{id}')
+        self.__pending_aruco_count[id] = len(self.__list_of_cameras) * markers
+        self.__pending_photo_types[id] = "stack" if action == "stack" and not fused else "photo"
+        if action == "stack":
+            # the stacking of a camera starts as soon as all of its frames are in
+            self.__stack_frames[id] = len(focus)
+        self.__catalog.start(id, action, len(self.__list_of_cameras))
+        if action == "trigger":
+            # all cameras take the frame exposed closest to this time
+            target = time_ns() + int(self.__trigger_delay * 1e9)
+            self.send_to_all(f'trigger:{id}:{target}')
+        elif action == "stack":
+            self.send_to_all(f'stack:{id}:' + ','.join(f'{f:g}' for f in focus) +
+                             (':fused' if fused else ''))
+        else:
+            self.send_to_all(f'{action}:{id}')
+        self.__start_session_timer(id)
+
+    def __start_session_timer(self, id: str) -> None:
+        """ finalize the capture after the session timeout """
+        timer = Timer(self.__session_timeout, self.__session_timed_out, args=(id,))
+        timer.daemon = True
+        timer.start()
+
+    def __session_timed_out(self, id: str) -> None:
+        """ finalize a capture with the photos and markers that have arrived """
+        with self.__counter_lock:
+            missing_photos = self.__pending_photo_count.pop(id, 0)
+            all_downloaded = False
+            if missing_photos > 0 and id in self.__pending_download_count:
+                self.__pending_download_count[id] -= missing_photos
+                all_downloaded = self.__pending_download_count[id] == 0
+            missing_aruco = self.__pending_aruco_count.get(id, 0)
+            if missing_aruco > 0:
+                # late results are ignored from now on
+                self.__pending_aruco_count[id] = 0
+        if missing_photos == 0 and missing_aruco == 0:
+            return
+        Logger().warning("Timeout of %s: %d photos and %d marker results missing",
+                         id, missing_photos, missing_aruco)
+        self.send_to_desktop(f"timeout:{id}")
+        if all_downloaded:
+            self.all_images_downloaded(id, self.__check_folder(id))
+        if missing_aruco > 0:
+            self.__all_aruco_received(id)
 
     def sync_exposure(self):
         self.__led_control.photo_light()
@@ -153,12 +268,9 @@ class Control:
         self.__desktop_message_queue.put(message)
 
     def send_to_all(self, msg_str: str) -> None:
-        msg = msg_str.encode("utf-8")
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                           socket.IPPROTO_UDP) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.sendto(msg, ("255.255.255.255", int(
-                self.__conf['both']['BroadCastPort'])))
+        """ broadcast a message, repeated until all known cameras acknowledged it """
+        self.__endpoint.broadcast(msg_str.encode("utf-8"),
+                                  set(self.__list_of_cameras))
 
     def found_camera(self, hostname: str, ip: str) -> None:
         if hostname in self.__list_of_cameras:
@@ -170,91 +282,175 @@ class Control:
                 f'settings:{{"exposure_value":{self.__camera_settings["exposure_value"]}}}')
 
     def receive_photo(self, ip: str, id_lens: str, filename: str) -> None:
-        global photo_count
         Logger().info("Photo received: %s", filename)
         id = id_lens.split("_")[0]
         Logger().info("Photo received: ID %s", id)
-        if id not in self.__pending_photo_count:
-            Logger().info("Error: Photo not requested!")
-            return
-        self.__pending_photo_count[id] -= 1
+        with self.__counter_lock:
+            if id not in self.__pending_photo_count:
+                Logger().info("Error: Photo not requested!")
+                return
+            self.__pending_photo_count[id] -= 1
+            all_taken = self.__pending_photo_count[id] == 0
+            if all_taken:
+                del self.__pending_photo_count[id]
         hostname = self.__get_hostname(ip)
         if len(hostname) > 0:
-            hostname = hostname[0]
-        else:
-            Logger().info("Error: Hostname not found!")
-            return
-        Thread(target=self.__download_photo, args=(
-            ip, id, filename, hostname)).start()
-        if self.__pending_photo_count[id] == 0:
+            self.__download_photo(ip, id, filename, hostname[0])
+        if all_taken:
             self.__led_control.status_led(1)
-            del self.__pending_photo_count[id]
             Logger().info("All photos taken!")
+        if len(hostname) == 0:
+            Logger().info("Error: Hostname not found!")
+            # the photo is never downloaded, the capture must not wait for it
+            with self.__counter_lock:
+                self.__pending_download_count[id] -= 1
+                all_downloaded = self.__pending_download_count[id] == 0
+            if all_downloaded:
+                self.all_images_downloaded(id, self.__check_folder(id))
+
+    def download_raw_frames(self, id: str) -> None:
+        """
+        Downloads the frames of a focus stack that has been stacked on the cameras.
+
+        The lens positions are taken from the <id>.stack.json of each camera,
+        the frames are written to the raw folder of the session.
+
+        Args:
+            id: The ID of the stack.
+        """
+        def download():
+            folder = self.__check_folder(id) + "raw/"
+            makedirs(folder, exist_ok=True)
+            port = self.__conf["kameras"]['WebPort']
+            for hostname, ip in list(self.__list_of_cameras.items()):
+                base = f"http://{ip}:{port}/bilder/"
+                try:
+                    timeline = requests.get(base + id + ".stack.json", timeout=10)
+                    timeline.raise_for_status()
+                    for frame in timeline.json():
+                        name = f"{id}_{frame['lens_position']:g}.jpg"
+                        r = requests.get(base + name, timeout=30)
+                        r.raise_for_status()
+                        with open(folder + hostname + name[36:], "wb") as f:
+                            f.write(r.content)
+                except Exception as e:
+                    Logger().error("Error downloading frames of %s from %s: %s", id, hostname, e)
+            Logger().info("Raw frames of %s downloaded", id)
+            self.send_to_desktop(f"rawFrames:{id}")
+        Thread(target=download, name="RawFrames").start()
 
     def __download_photo(self, ip: str, id: str,
                          name: str, hostname: str) -> None:
-        """ collect photos """
-        global download_count
-        Logger().info("Downloading photo...")
+        """ queue photo for the download workers """
         folder = self.__check_folder(id)
-
-        Logger().info("Collecting photo from  %s...", hostname)
-        try:
-            url = "http://" + ip + ":" + \
-                self.__conf["kameras"]['WebPort'] + "/bilder/" + name
-            Logger().info(url)
-            r = requests.get(url, allow_redirects=True)
-            open(folder + hostname + name[36:], 'wb').write(r.content)
-        except Exception as e:
-            Logger().info("Error collecting photo from %s: %s", hostname, e)
-        self.__pending_download_count[id] -= 1
-        if self.__pending_download_count[id] == 0:
-            self.all_images_downloaded(id, folder)
+        url = "http://" + ip + ":" + \
+            self.__conf["kameras"]['WebPort'] + "/bilder/" + name
+        Logger().info("Collecting photo from %s: %s", hostname, url)
+        self.__downloader.download(DownloadJob(
+            id, hostname, ip, url, folder + hostname + name[36:]))
+
+    def __photo_downloaded(self, job: DownloadJob, success: bool) -> None:
+        """ called by the download workers after each photo """
+        if not success:
+            Logger().info("Error collecting photo from %s", job.hostname)
+        else:
+            self.__add_to_archive(job.id, job.target)
+            self.__catalog.add_photo(job.id, path.getsize(job.target))
+            if path.basename(job.target) == job.hostname + ".jpg":
+                self.__thumbnails.add(job.id, job.target)
+            if self.__pending_photo_types.get(job.id) == "stack":
+                self.__stacker.add_frame(
+                    job.id, job.hostname, job.target,
+                    self.__check_folder(job.id) + job.hostname + ".jpg",
+                    self.__stack_frames.get(job.id, 0))
+        with self.__counter_lock:
+            self.__pending_download_count[job.id] -= 1
+            all_downloaded = self.__pending_download_count[job.id] == 0
+        if all_downloaded:
+            self.all_images_downloaded(job.id, self.__check_folder(job.id))
 
     def all_images_downloaded(self, id, folder):
         Logger().info("Collecting photos done!")
         del self.__pending_download_count[id]
         if self.__pending_photo_types[id] == "stack":
-            self.__stack_photos(id)
+            self.__stacker.finish(
+                id, lambda: self.__all_photos_stacked(id, folder))
+            return
+        self.__all_photos_stacked(id, folder)
+
+    def __all_photos_stacked(self, id, folder):
         self.__led_control.photo_light()
         del self.__pending_photo_types[id]
+        self.__stack_frames.pop(id, None)
+        self.__catalog.complete(id)
+        self.__thumbnails.finish(id)
         self.zip_and_send_folder(id, folder)
 
-    def zip_and_send_folder(self, id, folder):
-        Logger().info("Zipping folder...")
-        if path.exists(self.__conf['server']['Folder'] + id + '.zip'):
-            Logger().info("Info: Zip already exists!")
-            return
-        if id in self.__pending_download_count:
-            return
-        if id in self.__pending_photo_count:
-            return
-        if id in self.__pending_aruco_count:
-            return
-        if id in self.__pending_photo_types:
-            return
-        if not path.exists(folder):
-            Logger().info("Error: Folder not found!")
+    def __photo_stacked(self, id: str, hostname: str, output: str | None) -> None:
+        """ called by the stacking pool after each camera """
+        if output is None:
+            Logger().info("Error stacking photos of %s", hostname)
             return
+        Logger().info("Stacked photos of %s", hostname)
+        self.__add_to_archive(id, output)
+        # the stacked image replaces the thumbnail of the first frame
+        self.__thumbnails.add(id, output)
 
-        """
-        self.send_to_desktop(
-            f"aruco:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/aruco.json")
-        self.send_to_desktop(
-            f"meta:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/meta.json")
-        self.send_to_desktop(
-            f"marker:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/marker.json")
-        self.send_to_desktop(
-            f"cameras:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/cameras.json")
-        """
+    def zip_and_send_folder(self, id, folder):
+        Logger().info("Zipping folder...")
+        with self.__zip_lock:
+            if path.exists(self.__conf['server']['Folder'] + id + '.zip'):
+                Logger().info("Info: Zip already exists!")
+                return
+            if id in self.__pending_download_count:
+                return
+            if id in self.__pending_photo_count:
+                return
+            if id in self.__pending_aruco_count:
+                return
+            if id in self.__pending_photo_types:
+                return
+            if not path.exists(folder):
+                Logger().info("Error: Folder not found!")
+                return
 
-        make_archive(self.__conf['server']['Folder'] + id, 'zip', folder)
+            """
+            self.send_to_desktop(
+                f"aruco:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/aruco.json")
+            self.send_to_desktop(
+                f"meta:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/meta.json")
+            self.send_to_desktop(
+                f"marker:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/marker.json")
+            self.send_to_desktop(
+                f"cameras:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}/cameras.json")
+            """
+
+            if self.__archive is None or self.__archive.close(id) is None:
+                make_archive(
+                    self.__conf['server']['Folder'] + id, 'zip', folder)
+            self.__catalog.zipped(
+                id, path.getsize(self.__conf['server']['Folder'] + id + '.zip'))
         self.send_to_desktop(
             f"photoZip:{id}:{socket.gethostname()}:{self.__conf['server']['WebPort']}/bilder/{id}.zip")
         Logger().info("Zip done!")
 
         self.check_and_copy_usb(id + '.zip')
 
+    def __add_to_archive(self, id: str, file: str) -> None:
+        """ append a finished file to the incremental zip of the session """
+        if self.__archive is None:
+            return
+        try:
+            self.__archive.add(id, file)
+        except Exception as e:
+            Logger().error("Error adding %s to zip: %s", file, e)
+
+    def __write_json(self, id: str, folder: str, name: str, data) -> None:
+        """ write a json file of the session and append it to the zip """
+        with open(folder + name, "w") as f:
+            json_dump(data, f, indent=2)
+        self.__add_to_archive(id, folder + name)
+
     def check_and_copy_usb(self, file):
         try:
             if not path.exists('/dev/sda1'):
@@ -265,79 +461,137 @@ class Control:
             if not path.ismount('/mnt/usb'):
                 system('sudo mount /dev/sda1 /mnt/usb')
 
-            file = self.__conf['server']['Folder'] + file
             Logger().info("Copy to USB...")
-            system("cp " + file + " /mnt/usb")
+            system("cp " + self.__conf['server']['Folder'] + file + " /mnt/usb")
             system("sync")
             system("sudo umount /dev/sda1")
+            self.__catalog.copied(file.removesuffix('.zip'))
         except Exception as e:
             Logger().error("Error copying to USB: %s", e)
         Logger().info("Copy to USB done!")
 
     def __check_folder(self, id):
         folder = self.__conf['server']['Folder'] + id + "/"
-        if not path.exists(folder):
-            makedirs(folder)
+        makedirs(folder, exist_ok=True)
         return folder
 
-    def __stack_photos(self, id: str) -> None:
-        folder: str = self.__check_folder(id)
-        imgs: list[str] = glob(folder + "*.jpg")
-        groups: dict[str, list[NDArray[uint8]]] = {}
-        imgs.sort()
-        for i in imgs:
-            name = basename(i)
-            name = name.split("_")[0]
-            if name not in groups:
-                groups[name] = []
-            groups[name].append(imread(i))  # type: ignore
-        for camera, bilder in groups.items():
-            imwrite(folder + camera + ".jpg", focus_stack(bilder))
-
     def find_aruco(self):
         Logger().info("Searching for Aruco...")
         id = str(uuid.uuid4())
-        self.send_to_all('aruco:' + id)
         self.__pending_aruco_count[id] = len(self.__list_of_cameras)
+        self.__catalog.start(id, 'aruco', len(self.__list_of_cameras))
+        self.send_to_all('aruco:' + id)
+        self.__start_session_timer(id)
 
     def receive_aruco(self, data: str) -> None:
+        """ JSON result of cameras without binary encoding """
         i1: int = data.find(":")
         i2: int = data[i1+1:].find(":")
         id: str = data[:i1]
 
         hostname: str = data[i1+1:i1+i2+1]
-        if id not in self.__detected_markers:
-            self.__detected_markers[id] = {}
-        if id not in self.__metadata:
-            self.__metadata[id] = {}
         j: ArucoMetaBroadcast = json_loads(data[i1+i2+2:])
+        self.__aruco_result(id, hostname, j)
+
+    def receive_aruco_fragment(self, data: bytes) -> None:
+        """ fragment of a binary result: <id>:<hostname>:<key>:<index>:<total>:<data> """
+        try:
+            id, hostname, key, index, total, chunk = data.split(b":", 5)
+            # the numbers of the results start at 1 on every camera
+            result = self.__aruco_fragments.add(
+                f"{id.decode('utf-8')}:{hostname.decode('utf-8')}:{key.decode('utf-8')}",
+                int(index), int(total), chunk)
+            if result is None:
+                return
+            j = decode_aruco(result)
+        except (ValueError, zlib.error, struct.error) as e:
+            Logger().error("Error decoding aruco fragment: %s", e)
+            return
+        self.__aruco_result(id.decode("utf-8"), hostname.decode("utf-8"), j)
+
+    def fetch_aruco(self, ip: str, data: str) -> None:
+        """ fetch a large binary result from the camera: <id>:<hostname>:<key> """
+        id, hostname, key = data.split(":", 2)
+
+        def fetch():
+            try:
+                r = requests.get(
+                    f"http://{ip}:{self.__conf['kameras']['WebPort']}/aruco/{key}", timeout=10)
+                r.raise_for_status()
+                j = decode_aruco(r.content)
+            except Exception as e:
+                Logger().error("Error fetching aruco from %s: %s", hostname, e)
+                return
+            self.__aruco_result(id, hostname, j)
+        Thread(target=fetch).start()
+
+    def __aruco_result(self, id: str, hostname: str, j: ArucoMetaBroadcast) -> None:
         aruco = j['aruco']
         meta: Metadata = j['meta']  # type: ignore
-        self.__detected_markers[id][hostname] = aruco
-        self.__metadata[id][hostname] = meta
-        self.__pending_aruco_count[id] -= 1
+        with self.__counter_lock:
+            if self.__pending_aruco_count.get(id, 0) == 0:
+                Logger().info("Error: Aruco of %s not requested!", id)
+                return
+            self.__detected_markers.setdefault(id, {})[hostname] = aruco
+            self.__metadata.setdefault(id, {})[hostname] = meta
+            self.__pending_aruco_count[id] -= 1
+            all_received = self.__pending_aruco_count[id] == 0
 
-        if self.__pending_aruco_count[id] == 0:
-            self.__all_aruco_received(id)
+        if all_received:
+            # the pose estimation must not block the receiving thread
+            Thread(target=self.__all_aruco_received, args=(id,)).start()
 
     def __all_aruco_received(self, id):
         Logger().info("Aruco done!")
         folder = self.__check_folder(id)
+        if id not in self.__detected_markers:
+            # no camera answered before the timeout
+            del self.__pending_aruco_count[id]
+            self.zip_and_send_folder(id, folder)
+            return
 
-        json_dump(self.__metadata[id], open(
-            folder + 'meta.json', "w"), indent=2)
-
-        filter = MarkerChecker(
-            self.__marker, self.__detected_markers[id], self.__metadata[id])
-        self.__detected_markers[id] = filter.get_filtered_positions()
-        self.__marker = filter.get_corrected_coordinates()
+        self.__write_json(id, folder, 'meta.json', self.__metadata[id])
+        self.__write_trigger_report(id, folder)
+
+        with self.__calibration_lock:
+            detected = self.__detected_markers[id]
+            # cameras whose markers have not moved keep their last pose
+            changed = self.__calibration.changed_cameras(
+                detected, self.__metadata[id],
+                self.__conf['server'].getfloat('CalibrationTolerance', 0.5))
+            Logger().info("%d of %d cameras changed", len(changed), len(detected))
+            filter = MarkerChecker(
+                self.__marker, detected, self.__metadata[id],
+                poses=self.__calibration.get_last_poses(),
+                workers=self.__conf['server'].getint('PoseWorkers', 0),
+                fixed=set(detected) - changed)
+            self.__detected_markers[id] = filter.get_filtered_positions()
+            self.__marker = filter.get_corrected_coordinates()
+
+            version = self.__calibration.begin_version(id)
+            self.__calibration.add_observations(version, detected)
+            self.__calibration.set_cameras(
+                version, filter.get_poses(), self.__metadata[id], changed)
+            self.__calibration.set_markers(version, self.__marker)
         cameras = filter.get_cameras()
 
-        json_dump(self.__detected_markers[id], open(
-            folder + 'aruco.json', "w"), indent=2)
+        # the refined network is written to the session only, the stored
+        # marker coordinates stay the reference of the next sessions
+        marker_coords = self.__marker
+        if self.__conf['server'].getint('BundleAdjustment', 0) == 1:
+            adjustment = BundleAdjustment(
+                self.__marker, self.__detected_markers[id], self.__metadata[id],
+                filter.get_poses(),
+                refine_intrinsics=self.__conf['server'].getint('BundleIntrinsics', 0) == 1)
+            marker_coords = adjustment.get_corrected_coordinates()
+            cameras = adjustment.get_cameras()
+            self.__write_json(id, folder, 'rms.json', adjustment.get_rms())
+
+        self.__write_json(id, folder, 'aruco.json',
+                          self.__detected_markers[id])
 
         marker = {}
-        for pid, corners in self.__marker.items():
+        for pid, corners in marker_coords.items():
             marker[pid] = {}
             for corner, pos in enumerate(corners):
                 if pos is None:
@@ -345,15 +599,28 @@ class Control:
                 marker[pid][corner] = [pos.x,  pos.y,  pos.z]
         Logger().info("Marker: %s", marker)
 
-        json_dump(marker, open(
-            folder + 'marker.json', "w"), indent=2)
-
-        json_dump(cameras, open(
-            folder + 'cameras.json', "w"), indent=2)
+        self.__write_json(id, folder, 'marker.json', marker)
+        self.__write_json(id, folder, 'cameras.json', cameras)
+        self.__write_json(id, folder, 'residuals.json', filter.get_residuals())
 
         del self.__pending_aruco_count[id]
         self.zip_and_send_folder(id, folder)
 
+    def __write_trigger_report(self, id: str, folder: str) -> None:
+        """ per-camera skew of a scheduled trigger in ms """
+        skew = {hostname: meta['TriggerSkew'] / 1e6
+                for hostname, meta in self.__metadata[id].items()
+                if 'TriggerSkew' in meta}
+        if len(skew) == 0:
+            return
+        report = {
+            'cameras': dict(sorted(skew.items())),
+            'min': min(skew.values()),
+            'max': max(skew.values()),
+            'spread': max(skew.values()) - min(skew.values())}
+        Logger().info("Trigger spread of %s: %.2f ms", id, report['spread'])
+        self.__write_json(id, folder, 'trigger.json', report)
+
     def set_marker_from_csv(self, file, save=True) -> None:
         m = pd.read_csv(file)
 
@@ -366,6 +633,8 @@ class Control:
             self.__marker[id][c] = Point3D(r['x'], r['y'], r['z'])
         if save:
             self.__save_markers()
+            self.__calibration.set_markers(
+                self.__calibration.begin_version("marker.csv"), self.__marker)
 
     def __save_markers(self, ) -> None:
         with open(self.__conf['server']['Folder'] + "marker.csv", "w") as f:
@@ -377,9 +646,16 @@ class Control:
                     f.write(f"{id},{corner},{pos.x},{pos.y},{pos.z}\n")
 
     def __load_markers(self, ) -> None:
+        self.__marker = self.__calibration.get_markers()
+        if len(self.__marker) > 0:
+            Logger().info("Marker loaded from calibration store!")
+            return
         try:
             self.set_marker_from_csv(
                 self.__conf['server']['Folder'] + "marker.csv", False)
+            # the first version of the calibration store
+            self.__calibration.set_markers(
+                self.__calibration.begin_version("marker.csv"), self.__marker)
             Logger().info("Marker loaded!")
         except Exception as e:
             Logger().error("Error loading marker! %s", e)
@@ -428,6 +704,9 @@ class Control:
         self.__system_is_stopping = True
         sleep(1)
         self.thread_desktop_interface.stop()
+        self.__downloader.stop()
+        self.__stacker.stop()
+        self.__thumbnails.shutdown()
         self.thread_webinterface.stop()
         self.thread_camera_interface.stop()
 
@@ -480,9 +759,18 @@ class Control:
     def get_cams_started(self) -> bool:
         return self.__cams_in_standby
 
+    def get_endpoint(self) -> MessageEndpoint:
+        return self.__endpoint
+
     def get_leds(self) -> LedControl:
         return self.__led_control
 
+    def get_thumbnails(self) -> ThumbnailCache:
+        return self.__thumbnails
+
+    def get_catalog(self) -> SessionCatalog:
+        return self.__catalog
+
     def __get_hostname(self, ip: str) -> list[str]:
         return [k for k, v in self.__list_of_cameras.items() if v == ip]
 
@@ -497,3 +785,9 @@ class Control:
 
     def get_detected_markers(self):
         return self.__detected_markers
+
+    def get_download_stats(self) -> DownloadStats:
+        return self.__downloader.get_stats()
+
+    def get_messaging_stats(self) -> MessagingStats:
+        return self.__endpoint.get_stats()
@@ -120,6 +120,11 @@ class DesktopControlThread(StoppableThread):
                                     if len(parts) > 1:
                                         id = parts[1]
                                     self.__control.capture_photo('photo', id)
+                                case 'trigger':
+                                    id = ""
+                                    if len(parts) > 1:
+                                        id = parts[1]
+                                    self.__control.capture_photo('trigger', id)
 
                         except socket.timeout:
                             continue
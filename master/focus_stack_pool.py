@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count, sysconf
+from os.path import basename, splitext
+from struct import unpack
+from threading import Condition, Lock, Thread
+from typing import Callable, NamedTuple
+
+from cv2 import imread, imwrite
+
+from common.logger import Logger
+from common.focus_stack import HomographyCache, focus_stack
+
+# estimated peak memory of the streaming focus_stack per pixel:
+# current and aligned frame, output, float32 sharpness map and gray image
+BYTES_PER_PIXEL = 16
+
+
+def lens_position(file: str) -> float:
+    """
+    Returns the lens position of a frame named <hostname>_<lens position>.jpg.
+    """
+    try:
+        return float(splitext(basename(file))[0].split('_')[-1])
+    except ValueError:
+        return 0.
+
+
+def stack_group(files: list[str], output: str, tile_rows: int = 0,
+                homographies: dict[str, list[list[float]]] | None = None) -> tuple[str, dict[str, list[list[float]]]]:
+    """
+    Stacks the frames of one camera, executed in a worker process.
+
+    The frames are read one at a time while they are merged.
+
+    Args:
+        files: The frames of the camera.
+        output: The file the stacked image is written to.
+        tile_rows: The height of the tiles the sharpness is computed in.
+        homographies: The cached homographies of the camera.
+
+    Returns:
+        The file the stacked image has been written to and the updated homographies.
+    """
+    homographies = dict(homographies or {})
+    imwrite(output, focus_stack((imread(f) for f in files), tile_rows,
+                                [lens_position(f) for f in files], homographies))
+    return output, homographies
+
+
+def jpeg_size(file: str) -> tuple[int, int]:
+    """
+    Reads the size of a JPEG from its frame header without decoding it.
+
+    Args:
+        file: The JPEG file.
+
+    Returns:
+        The width and height of the image, (0, 0) if it could not be read.
+    """
+    with open(file, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return 0, 0
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return 0, 0
+            if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7:
+                continue
+            length = unpack('>H', f.read(2))[0]
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                height, width = unpack('>xHH', f.read(5))
+                return width, height
+            f.seek(length - 2, 1)
+
+
+def available_memory() -> int:
+    """
+    Returns the memory available for new processes in bytes.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return sysconf('SC_PAGE_SIZE') * sysconf('SC_AVPHYS_PAGES')
+
+
+class StackGroup(NamedTuple):
+    """
+    Represents the frames of one camera that are stacked together.
+
+    Attributes:
+        id (str): The ID of the capture.
+        hostname (str): The hostname of the camera.
+        files (list[str]): The frames of the camera.
+        output (str): The file the stacked image is written to.
+        memory (int): The estimated peak memory of the stacking.
+    """
+    id: str
+    hostname: str
+    files: list[str]
+    output: str
+    memory: int
+
+
+class FocusStackPool:
+    """
+    Stacks the frames of the cameras in a pool of worker processes.
+
+    The stack of a camera is started as soon as all of its frames have been
+    downloaded. Each worker only loads the frames of its camera, the number of
+    cameras stacked at the same time is limited by the available memory.
+
+    Attributes:
+        __frames_per_camera (int): The default number of frames of a complete stack.
+        __callback (Callable[[str, str, str | None], None]): Called with id, hostname and output after each stack.
+        __frames (dict[str, dict[str, list[str]]]): The downloaded frames by id and hostname.
+        __pending (deque[StackGroup]): The groups waiting for memory.
+        __running (dict[str, int]): The number of unfinished groups by id.
+
+    Methods:
+        start(): None
+        stop(): None
+        add_frame(id: str, hostname: str, file: str, output: str, frames: int = 0): None
+        finish(id: str, callback: Callable[[], None]): None
+    """
+
+    def __init__(self, callback: Callable[[str, str, str | None], None],
+                 frames_per_camera: int = 5, workers: int = 0,
+                 memory_fraction: float = 0.75, tile_rows: int = 0,
+                 homography_file: str | None = None):
+        """
+        Initializes the FocusStackPool object.
+
+        Args:
+            callback: Called with id, hostname and the stacked file (None on error) after each stack.
+            frames_per_camera: The number of frames of a complete stack if a capture does not tell.
+            workers: The number of worker processes, 0 for the number of cpus.
+            memory_fraction: The part of the available memory used for stacking.
+            tile_rows: The height of the tiles the sharpness is computed in, 0 for whole images.
+            homography_file: The file the homographies of the alignment are cached in.
+        """
+        self.__callback = callback
+        self.__frames_per_camera = frames_per_camera
+        self.__workers = workers if workers > 0 else (cpu_count() or 1)
+        self.__memory_fraction = memory_fraction
+        self.__tile_rows = tile_rows
+        self.__homographies: HomographyCache | None = None
+        if homography_file is not None:
+            self.__homographies = HomographyCache(homography_file)
+
+        self.__executor: ProcessPoolExecutor | None = None
+        self.__condition = Condition()
+        self.__frames: dict[str, dict[str, list[str]]] = {}
+        self.__outputs: dict[str, dict[str, str]] = {}
+        self.__pending: deque[StackGroup] = deque()
+        self.__running: dict[str, int] = {}
+        self.__finished: dict[str, Callable[[], None]] = {}
+        self.__reserved = 0
+        self.__active = 0
+        self.__budget = 0
+        self.__stopping = False
+        self.__dispatcher: Thread | None = None
+        self.__start_lock = Lock()
+
+    def start(self) -> None:
+        """
+        Starts the worker processes and the dispatcher thread.
+
+        The workers are forked by a fork server, a fresh process without the
+        threads of Control and its locks, so start() is safe at any time,
+        also lazily from the download threads. The fork server imports this
+        module once, the workers inherit OpenCV without importing it again.
+        """
+        with self.__start_lock:
+            if self.__executor is not None:
+                return
+            context = get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            executor = ProcessPoolExecutor(self.__workers, mp_context=context)
+            # start all workers now, not with the first stack
+            for f in [executor.submit(int) for _ in range(self.__workers)]:
+                f.result()
+            with self.__condition:
+                self.__executor = executor
+                self.__stopping = False
+            self.__dispatcher = Thread(target=self.__dispatch,
+                                       name="FocusStackDispatcher", daemon=True)
+            self.__dispatcher.start()
+
+    def stop(self) -> None:
+        """
+        Stops the dispatcher and the worker processes.
+        """
+        with self.__condition:
+            self.__stopping = True
+            executor, self.__executor = self.__executor, None
+            self.__condition.notify_all()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def add_frame(self, id: str, hostname: str, file: str, output: str, frames: int = 0) -> None:
+        """
+        Registers a downloaded frame, the stack is started if the camera is complete.
+
+        Args:
+            id: The ID of the capture.
+            hostname: The hostname of the camera.
+            file: The downloaded frame.
+            output: The file the stacked image of the camera is written to.
+            frames: The number of lens positions of the capture, 0 for frames_per_camera.
+        """
+        self.start()
+        with self.__condition:
+            files = self.__frames.setdefault(id, {}).setdefault(hostname, [])
+            files.append(file)
+            self.__outputs.setdefault(id, {})[hostname] = output
+            if len(files) >= (frames or self.__frames_per_camera):
+                self.__queue_group(id, hostname)
+
+    def finish(self, id: str, callback: Callable[[], None]) -> None:
+        """
+        Stacks the incomplete cameras of a capture and calls back when all stacks are done.
+
+        Args:
+            id: The ID of the capture.
+            callback: Called after all stacks of the capture have been written.
+        """
+        self.start()
+        with self.__condition:
+            for hostname in list(self.__frames.get(id, {}).keys()):
+                self.__queue_group(id, hostname)
+            self.__frames.pop(id, None)
+            self.__outputs.pop(id, None)
+            if self.__running.get(id, 0) == 0:
+                self.__running.pop(id, None)
+            else:
+                self.__finished[id] = callback
+                return
+        callback()
+
+    def __queue_group(self, id: str, hostname: str) -> None:
+        """
+        Moves the frames of a camera to the dispatcher queue, the condition has to be held.
+        """
+        files = sorted(self.__frames[id].pop(hostname))
+        if len(files) == 0:
+            return
+        width, height = jpeg_size(files[0])
+        memory = width * height * BYTES_PER_PIXEL
+        self.__pending.append(StackGroup(
+            id, hostname, files, self.__outputs[id][hostname], memory))
+        self.__running[id] = self.__running.get(id, 0) + 1
+        self.__condition.notify_all()
+
+    def __fits(self, group: StackGroup) -> bool:
+        if self.__active == 0:
+            # always allow one group, even if it exceeds the budget
+            self.__budget = int(available_memory() * self.__memory_fraction)
+            return True
+        return self.__active < self.__workers and \
+            self.__reserved + group.memory <= self.__budget
+
+    def __dispatch(self) -> None:
+        """
+        Main loop of the dispatcher thread, submits groups as long as memory is left.
+        """
+        while True:
+            with self.__condition:
+                while not self.__stopping and not (
+                        self.__pending and self.__fits(self.__pending[0])):
+                    self.__condition.wait()
+                if self.__stopping or self.__executor is None:
+                    return
+                group = self.__pending.popleft()
+                self.__reserved += group.memory
+                self.__active += 1
+                Logger().info("Stacking %s of %s (%d MB reserved)",
+                              group.hostname, group.id, self.__reserved >> 20)
+                homographies = None
+                if self.__homographies is not None:
+                    homographies = self.__homographies.get(group.hostname)
+                future = self.__executor.submit(
+                    stack_group, group.files, group.output, self.__tile_rows,
+                    homographies)
+            future.add_done_callback(
+                lambda f, g=group: self.__group_done(g, f))
+
+    def __group_done(self, group: StackGroup, future: Future[tuple[str, dict[str, list[list[float]]]]]) -> None:
+        """
+        Called after a worker has finished a group.
+        """
+        output: str | None = None
+        try:
+            output, homographies = future.result()
+            if self.__homographies is not None:
+                self.__homographies.update(group.hostname, homographies)
+        except Exception as e:
+            Logger().error("Error stacking %s of %s: %s",
+                           group.hostname, group.id, e)
+        with self.__condition:
+            self.__reserved -= group.memory
+            self.__active -= 1
+            self.__condition.notify_all()
+        try:
+            self.__callback(group.id, group.hostname, output)
+        except Exception as e:
+            Logger().error("Error in stack callback: %s", e)
+        finished: Callable[[], None] | None = None
+        with self.__condition:
+            self.__running[group.id] -= 1
+            if self.__running[group.id] == 0 and group.id in self.__finished:
+                del self.__running[group.id]
+                finished = self.__finished.pop(group.id)
+        if finished is not None:
+            finished()
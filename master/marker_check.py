@@ -6,31 +6,154 @@
 @version: 2024.03.11
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import cpu_count
+
 import cv2
 import numpy as np
-import pandas as pd
+import numpy.typing as npt
 from common.logger import Logger
-from common.typen import ArucoMarkerPos, ArucoMarkerCorners, CameraExterior, Metadata, Point3D
+from common.typen import ArucoMarkerPos, ArucoMarkerCorners, ArucoMarkerResidual, CameraExterior, Metadata, Point3D
 from common.conf import Conf
-from scipy import stats
+
+# inlier flags of the observations
+UNCHECKED = -1
+OUTLIER = 0
+INLIER = 1
+
+# one detected corner in one image
+OBSERVATION = np.dtype([('host', '<i4'), ('id', '<i8'), ('corner', '<i8'),
+                        ('x', '<f8'), ('y', '<f8')])
+
+# maximum reprojection error of an inlier in pixels
+REPROJECTION_ERROR = 10.0
+
+# reweighting of the triangulation, residuals of ROBUST_SCALE pixels get half the weight
+IRLS_ITERATIONS = 5
+ROBUST_SCALE = 3.0
+
+
+def point_key(id: npt.ArrayLike, corner: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    """
+    Combines marker id and corner to one integer used as lookup key.
+    """
+    return np.asarray(id, dtype=np.int64) * 4 + np.asarray(corner, dtype=np.int64)
+
+
+def triangulate(projection: npt.NDArray[np.float64], normalized: npt.NDArray[np.float64],
+                point: npt.NDArray[np.intp], count: int,
+                weights: npt.NDArray[np.float64] | None = None) -> npt.NDArray[np.float64]:
+    """
+    Triangulates many points from any number of views at once (weighted linear DLT).
+
+    Each observation adds two rows of the DLT system of its point. Instead of
+    an SVD per point the 4x4 normal matrices of all points are accumulated and
+    their eigenvectors of the smallest eigenvalue are computed in one call.
+
+    Args:
+        projection: The projection matrix [R|t] of each observation, shape (n, 3, 4).
+        normalized: The undistorted, normalized image point of each observation, shape (n, 2).
+        point: The index of the point of each observation, shape (n,).
+        count: The number of points.
+        weights: The weight of each observation, shape (n,).
+
+    Returns:
+        The points, shape (count, 3). Points seen by less than two views are undetermined.
+    """
+    rows = np.stack([normalized[:, 0, None] * projection[:, 2] - projection[:, 0],
+                     normalized[:, 1, None] * projection[:, 2] - projection[:, 1]], axis=1)
+    normal = np.einsum('nri,nrj->nij', rows, rows)
+    if weights is not None:
+        normal *= weights[:, None, None]
+    a = np.zeros((count, 4, 4))
+    np.add.at(a, point, normal)
+    x = np.linalg.eigh(a)[1][:, :, 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x[:, :3] / x[:, 3:]
+
+
+def reprojection_error(projection: npt.NDArray[np.float64], normalized: npt.NDArray[np.float64],
+                       coords: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """
+    The distance between normalized image points and their reprojected coordinates.
+
+    Args:
+        projection: The projection matrix [R|t] of each observation, shape (n, 3, 4).
+        normalized: The undistorted, normalized image point of each observation, shape (n, 2).
+        coords: The coordinate of each observation, shape (n, 3).
+
+    Returns:
+        The residuals in normalized image coordinates, shape (n,).
+    """
+    p = np.einsum('nij,nj->ni', projection[:, :, :3], coords) + projection[:, :, 3]
+    return np.linalg.norm(p[:, :2] / p[:, 2:] - normalized, axis=1)
+
+
+@lru_cache(maxsize=64)
+def camera_matrix(lens_position: float, c_offset: float = 0, cx_offset: float = 0, cy_offset: float = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the camera matrix and distortion coefficients.
+
+    The result is cached per lens position, the arrays are read-only.
+
+    Args:
+        lens_position: The lens position value.
+        c_offset: The c offset value.
+        cx_offset: The cx offset value.
+        cy_offset: The cy offset value.
+
+    Returns:
+        A tuple containing the camera matrix and distortion coefficients.
+    """
+    param = Conf().get()['calibration']
+    c = float(param['f']) + c_offset + \
+        lens_position * float(param['f_factor'])
+    cx = float(param['cx']) + cx_offset + \
+        lens_position * float(param['cx_factor'])
+    cy = float(param['cy']) + cy_offset + \
+        lens_position * float(param['cy_factor'])
+    cameraMatrix = np.array([[c, 0, cx], [0, c, cy], [0, 0, 1]])
+    distCoeffs = np.array([float(param['k1']) + lens_position *
+                           float(param['k1_factor']),
+                           float(param['k2']) + lens_position *
+                           float(param['k2_factor']),
+                           float(param['p1']) + lens_position *
+                           float(param['p1_factor']),
+                           float(param['p2']) + lens_position *
+                           float(param['p2_factor']),
+                           float(param['k3']) + lens_position *
+                           float(param['k3_factor'])])
+    cameraMatrix.setflags(write=False)
+    distCoeffs.setflags(write=False)
+    return cameraMatrix, distCoeffs
 
 
 class MarkerChecker:
     """A class to check marker positions and filter them if necessary.
 
+    The observations, coordinates and lens positions are kept in NumPy arrays.
+    Hostnames are replaced by their index in the sorted list of hostnames,
+    marker id and corner by the key id * 4 + corner.
+
     Attributes:
-        __marker_coords (dict[int, ArucoMarkerCorners]): A dictionary containing marker coordinates.
-        __marker_pos (dict[str, list[ArucoMarkerPos]]): A dictionary containing marker positions.
-        __metadata (dict[str, Metadata]): A dictionary containing metadata.
+        __hosts (list[str]): The sorted hostnames, the index is used in the arrays.
+        __obs (npt.NDArray): The observations as structured array of OBSERVATION.
+        __inlier (npt.NDArray[np.int8]): The inlier flag of each observation (UNCHECKED, OUTLIER, INLIER).
+        __lens (npt.NDArray[np.float64]): The lens position of each host, NaN without metadata.
+        __keys (npt.NDArray[np.int64]): The sorted keys of the known marker coordinates.
+        __coords (npt.NDArray[np.float64]): The coordinates of the keys.
+        __cameras (dict[str, CameraExterior]): The exterior orientation of the cameras.
+        __poses (dict[str, dict[str, np.ndarray]]): The intrinsics and pose of each camera of the last check.
+        __guess (dict[str, dict[str, np.ndarray]]): Poses of a previous session used as start values.
+        __fixed (set[str]): Cameras keeping their pose of __guess.
+        __workers (int): The number of threads estimating the poses.
         __is_filtered (bool): A boolean indicating if the marker positions have been filtered.
     """
 
-    __marker_coords: pd.DataFrame
-    __marker_pos: pd.DataFrame
-    __metadata:  pd.DataFrame
     __cameras: dict[str, CameraExterior]
 
-    def __init__(self, marker_coords: dict[int, ArucoMarkerCorners], marker_pos: dict[str, list[ArucoMarkerPos]], metadata: dict[str, Metadata], cameras: dict[str, CameraExterior] = {}):
+    def __init__(self, marker_coords: dict[int, ArucoMarkerCorners], marker_pos: dict[str, list[ArucoMarkerPos]], metadata: dict[str, Metadata], cameras: dict[str, CameraExterior] = {}, poses: dict[str, dict[str, np.ndarray]] = {}, workers: int = 0, fixed: set[str] = set()):
         """
         Initialize the MarkerChecker class.
 
@@ -38,96 +161,70 @@ class MarkerChecker:
             marker_coords (dict[int, ArucoMarkerCorners]): A dictionary containing marker coordinates.
             marker_pos (dict[str, list[ArucoMarkerPos]]): A dictionary containing marker positions.
             metadata (dict[str, Metadata]): A dictionary containing metadata.
+            cameras (dict[str, CameraExterior]): Known exterior orientations, updated by check().
+            poses (dict[str, dict[str, np.ndarray]]): rvecs and tvecs of a previous check used as start values.
+            workers (int): The number of threads estimating the poses, 0 for one per CPU.
+            fixed (set[str]): Cameras keeping their pose of poses, e.g. because their observations have not changed.
         """
-        self.__marker_coords = self.__create_marker_coords_dataframe(
-            marker_coords)
-        self.__marker_pos = self.__create_marker_pos_dataframe(marker_pos)
-        self.__metadata = self.__create_metadata_dataframe(metadata)
-        self.__cameras = cameras
-        self.__is_filtered = False
+        self.__hosts = sorted(set(marker_pos) | set(metadata))
+        host_index = {h: i for i, h in enumerate(self.__hosts)}
 
-    def __create_marker_coords_dataframe(self, marker_coords: dict[int, ArucoMarkerCorners]) -> pd.DataFrame:
-        """
-        Create a dataframe containing the marker coordinates.
+        self.__obs = np.array(
+            [(host_index[hostname], pos['id'], pos['corner'], pos['x'], pos['y'])
+             for hostname, positions in marker_pos.items() for pos in positions],
+            dtype=OBSERVATION)
+        self.__inlier = np.full(len(self.__obs), UNCHECKED, dtype=np.int8)
 
-        Returns:
-            A dataframe containing the marker coordinates.
-        """
-        data: list[tuple[int, int, float, float, float]] = []
+        self.__lens = np.full(len(self.__hosts), np.nan)
+        for hostname, meta in metadata.items():
+            if 'LensPosition' in meta:
+                self.__lens[host_index[hostname]] = meta['LensPosition']
+
+        keys: list[int] = []
+        coords: list[tuple[float, float, float]] = []
         for id, corners in marker_coords.items():
             if corners is None:
                 continue
             for corner, coord in enumerate(corners):
                 if coord is None:
                     continue
-                data.append((id, corner, coord.x, coord.y, coord.z))
-        return pd.DataFrame(data, columns=['id', 'corner', 'wx', 'wy', 'wz']).set_index(['id', 'corner'])
+                keys.append(id * 4 + corner)
+                coords.append((coord.x, coord.y, coord.z))
+        order = np.argsort(np.asarray(keys, dtype=np.int64), kind='stable')
+        self.__keys = np.asarray(keys, dtype=np.int64)[order]
+        self.__coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)[order]
+
+        self.__cameras = dict(cameras)
+        self.__poses: dict[str, dict[str, np.ndarray]] = {}
+        self.__guess = dict(poses)
+        self.__fixed = set(fixed)
+        self.__workers = workers if workers > 0 else (cpu_count() or 1)
+        self.__is_filtered = False
 
-    def __create_marker_pos_dataframe(self, marker_pos: dict[str, list[ArucoMarkerPos]]) -> pd.DataFrame:
+    def __coord_index(self, keys: npt.NDArray[np.int64]) -> npt.NDArray[np.intp]:
         """
-        Create a dataframe containing the marker positions.
+        Looks up the rows of the coordinates of the given keys.
 
         Returns:
-            A dataframe containing the marker positions.
-        """
-        data = []
-        for hostname, positions in marker_pos.items():
-            for pos in positions:
-                data.append(
-                    [hostname, pos['id'], pos['corner'], pos['x'], pos['y'], None])
-        d = pd.DataFrame(
-            data, columns=['hostname', 'id', 'corner', 'x', 'y', 'inlier']).set_index(['hostname', 'id', 'corner'])
-        return d
-
-    def __create_metadata_dataframe(self, metadata: dict[str, Metadata]) -> pd.DataFrame:
+            The row in __coords for each key, -1 if the coordinate is unknown.
         """
-        Create a dataframe containing the metadata.
-
-        Returns:
-            A dataframe containing the metadata.
+        idx = np.searchsorted(self.__keys, keys)
+        idx[idx == len(self.__keys)] = 0
+        found = len(self.__keys) > 0
+        if found:
+            found = self.__keys[idx] == keys
+        return np.where(found, idx, -1)
+
+    def __set_coord(self, key: int, coord: npt.NDArray[np.float64]) -> None:
         """
-        # read metadata
-        data = []
-        for hostname, meta in metadata.items():
-            if 'LensPosition' not in meta:
-                continue
-            data.append([hostname, meta['LensPosition']])
-        pdm = pd.DataFrame(
-            data, columns=['hostname', 'LensPosition']).set_index('hostname')
-        return pdm
-
-    def __camera_matrix(self, lens_position: float, c_offset: float = 0, cx_offset: float = 0, cy_offset: float = 0) -> tuple[np.ndarray, np.ndarray]:
+        Sets the coordinate of a key, unknown keys are inserted.
         """
-        Get the camera matrix and distortion coefficients.
-
-        Args:
-            lens_position: The lens position value.
-            c_offset: The c offset value.
-            cx_offset: The cx offset value.
-            cy_offset: The cy offset value.
-
-        Returns:
-            A tuple containing the camera matrix and distortion coefficients.
-        """
-        param = Conf().get()['calibration']
-        c = float(param['f']) + c_offset + \
-            lens_position * float(param['f_factor'])
-        cx = float(param['cx']) + cx_offset + \
-            lens_position * float(param['cx_factor'])
-        cy = float(param['cy']) + cy_offset + \
-            lens_position * float(param['cy_factor'])
-        cameraMatrix = np.array([[c, 0, cx], [0, c, cy], [0, 0, 1]])
-        distCoeffs = np.array([float(param['k1']) + lens_position *
-                               float(param['k1_factor']),
-                               float(param['k2']) + lens_position *
-                               float(param['k2_factor']),
-                               float(param['p1']) + lens_position *
-                               float(param['p1_factor']),
-                               float(param['p2']) + lens_position *
-                               float(param['p2_factor']),
-                               float(param['k3']) + lens_position *
-                               float(param['k3_factor'])])
-        return cameraMatrix, distCoeffs
+        i = int(np.searchsorted(self.__keys, key))
+        if i < len(self.__keys) and self.__keys[i] == key:
+            self.__coords[i] = coord
+            return
+        self.__keys = np.insert(self.__keys, i, key)
+        self.__coords = np.insert(self.__coords, i, coord, axis=0)
 
     def check(self) -> None:
         """
@@ -137,154 +234,195 @@ class MarkerChecker:
         # check and mark marker positions
         cameras = self.__check_marker_position()
 
-        # check outliers on wrong coordinates
-        t = self.__marker_pos.groupby(['id', 'corner'])['inlier'].agg(
-            [pd.Series.count, pd.Series.mode])
-        # Replace with True if mode is a list (Number of outliers = Number of inliers)
-        # Logger().info(type(t['mode']))
-        t['mode'] = t['mode'].apply(
-            lambda x: True if isinstance(x, list) else x)
-
-        t = t[t['count'] > 2]
-        try:
-            # TODO: REPAIR THIS
-            t = t[(t['mode'] == False)]
-        except Exception:
-            Logger().info("Error in filtering")
-            pass
-
-        t.reset_index(inplace=True)
-
-        # Logger().info(t)
+        # recalculate points seen by more than two cameras if the majority
+        # of the cameras marked them as outliers (probably a wrong coordinate)
+        keys = point_key(self.__obs['id'], self.__obs['corner'])
+        unique, inverse = np.unique(keys, return_inverse=True)
+        inliers = np.bincount(inverse, weights=self.__inlier == INLIER,
+                              minlength=len(unique))
+        outliers = np.bincount(inverse, weights=self.__inlier == OUTLIER,
+                               minlength=len(unique))
+        wrong = unique[(inliers + outliers > 2) & (outliers > inliers)]
+        points = np.stack([wrong // 4, wrong % 4], axis=1)
 
         # recalculate coordinates
-        something_changed = self.recalculate_coordinates(cameras, t)
+        something_changed = self.recalculate_coordinates(cameras, points)
 
         if something_changed:
             Logger().info("Some coordinates have changed")
             cameras = self.__check_marker_position()
 
+        self.__poses = cameras
         self.__is_filtered = True
 
-    def recalculate_coordinates(self, cameras: dict[str, dict[str, np.ndarray]], t: pd.DataFrame) -> bool:
+    def recalculate_coordinates(self, cameras: dict[str, dict[str, np.ndarray]], points: npt.NDArray[np.int64]) -> bool:
         """
         Recalculate the coordinates.
 
+        All points are triangulated together from all cameras observing them
+        (N-view DLT). Observations with a large reprojection error get a lower
+        weight in the next iterations (iteratively reweighted least squares).
+
         Args:
             cameras: A dictionary containing the cameras.
-            df: A dataframe containing the marker positions.
-            t: A dataframe containing the marker positions.
+            points: The id and corner of the points to recalculate, shape (n, 2).
 
         Returns:
             A boolean indicating if the coordinates have been recalculated.
         """
-        df = self.__create_dataframe()
-
-        something_changed = False
-        for _, row in t.iterrows():
-            group: pd.DataFrame = df[(df['id'] == row['id']) & (
-                df['corner'] == row['corner'])]
-            # group['index'] = df.reset_index().index
-
-            coord_neu = []
-            j = group.add_suffix('_a').merge(
-                group.add_suffix('_b'), how='cross')
-            j = j[j['hostname_a'] < j['hostname_b']]
-
-            for _, view in j.iterrows():
-                camera1 = cameras[view['hostname_a']]
-                camera2 = cameras[view['hostname_b']]
-                r1, _ = cv2.Rodrigues(camera1['rvecs'])
-                r2, _ = cv2.Rodrigues(camera2['rvecs'])
-                P1 = np.c_[r1, camera1['tvecs']]
-                P2 = np.c_[r2, camera2['tvecs']]
-                v1 = cv2.undistortPoints(
-                    np.array([[[view['x_a'], view['y_a']]]]), camera1['cameraMatrix'], camera1['distCoeffs'])
-                v2 = cv2.undistortPoints(
-                    np.array([[[view['x_b'], view['y_b']]]]), camera2['cameraMatrix'], camera2['distCoeffs'])
-                coord = cv2.triangulatePoints(P1, P2, v1, v2)
-                coord = coord / coord[3]
-                coord_neu.append(coord[:3].flatten())
-            if len(coord_neu) == 0:
-                continue
-            Logger().debug(coord_neu)
-            coords_neu = pd.DataFrame(coord_neu, columns=['wx', 'wy', 'wz'])
-            # df.loc[(df['id'] == row['id']) & (df['corner'] == row['corner']),
-            #       ['x', 'y']] = coord_neu[:2]
-            Logger().info(f"Korrigiere {row['id']} {row['corner']}")
-            zscore = np.abs(stats.zscore(coords_neu[["wx", "wy", "wz"]]))
-            # print(zscore)
-            Logger().debug(zscore)
-            # Identify outliers as students with a z-score greater than 3
-            threshold = 2
-            coords_neu = coords_neu[zscore <= threshold].dropna()
-            Logger().debug(coords_neu.mean())
-            Logger().debug(group[['wx', 'wy', 'wz']])
-
-            neu = coords_neu.mean().to_numpy()
-            self.__marker_coords.at[(row['id'], row['corner']), 'wx'] = neu[0]
-            self.__marker_coords.at[(row['id'], row['corner']), 'wy'] = neu[1]
-            self.__marker_coords.at[(row['id'], row['corner']), 'wz'] = neu[2]
-
-            # row['id']) & (
-            #   self.__marker_coords['corner'] == row['corner']), ['wx', 'wy', 'wz']] = coords_neu.mean().to_numpy()
-            # self.__marker_coords[row['id']][row['corner']] = (
-            #    coords_neu['wx'].mean(), coords_neu['wy'].mean(), coords_neu['wz'].mean())
-
-            Logger().debug(
-                f"Original: {group[['wx', 'wy', 'wz']].mean().to_numpy()}")
-            Logger().debug(self.__marker_coords)
-            something_changed = True
-        return something_changed
+        if len(points) == 0:
+            return False
+        host_ids = {self.__hosts.index(h): c for h, c in cameras.items()}
+        obs = self.__obs
+        keys = point_key(obs['id'], obs['corner'])
+        usable = np.isin(keys, point_key(points[:, 0], points[:, 1])) & \
+            np.isin(obs['host'], list(host_ids))
+        rows = np.flatnonzero(usable)
+        if len(rows) == 0:
+            return False
+
+        # undistort all used observations of a camera at once, one projection
+        # matrix and focal length per camera
+        normalized = np.empty((len(rows), 2))
+        projection = np.empty((len(self.__hosts), 3, 4))
+        focal = np.ones(len(self.__hosts))
+        hosts = obs['host'][rows]
+        for host in np.unique(hosts).tolist():
+            camera = host_ids[host]
+            r = hosts == host
+            image = np.stack([obs['x'][rows[r]], obs['y'][rows[r]]], axis=1)
+            normalized[r] = cv2.undistortPoints(
+                image.reshape(-1, 1, 2), camera['cameraMatrix'], camera['distCoeffs']).reshape(-1, 2)
+            projection[host] = np.c_[cv2.Rodrigues(camera['rvecs'])[0],
+                                     camera['tvecs']]
+            focal[host] = camera['cameraMatrix'][0, 0]
+        projection = projection[hosts]
+        focal = focal[hosts]
+
+        unique, point = np.unique(keys[rows], return_inverse=True)
+        weights = np.ones(len(rows))
+        for _ in range(IRLS_ITERATIONS):
+            coords = triangulate(projection, normalized, point, len(unique), weights)
+            residual = reprojection_error(projection, normalized, coords[point]) * focal
+            weights = 1 / (1 + (residual / ROBUST_SCALE) ** 2)
+
+        # a point needs two cameras
+        views = np.bincount(point, minlength=len(unique))
+        solved = (views >= 2) & np.isfinite(coords).all(axis=1)
+        rms = np.sqrt(np.bincount(point, weights=residual ** 2,
+                                  minlength=len(unique)) / np.maximum(views, 1))
+        for key, coord, error in zip(unique[solved].tolist(), coords[solved], rms[solved].tolist()):
+            Logger().info("Korrigiere %s %s (RMS %.2f px)", key // 4, key % 4, error)
+            Logger().debug(coord)
+            self.__set_coord(key, coord)
+        for key in unique[~solved].tolist():
+            Logger().info("Not enough cameras for %s %s", key // 4, key % 4)
+        return bool(solved.any())
 
     def __check_marker_position(self) -> dict[str, dict[str, np.ndarray]]:
         """
         Check the marker positions and filter them if necessary.
 
+        The poses of the cameras are estimated in parallel.
+
         Returns:
-            A tuple containing the cameras and the marker positions.
+            A dictionary containing the intrinsics and the pose of each camera.
         """
-
-        df = self.__create_dataframe()
-        if len(df) == 0:
+        obs = self.__obs
+        with_meta = ~np.isnan(self.__lens[obs['host']])
+        if not with_meta.any():
             Logger().warning("No data to process")
             return {}
-        cameras = {}
+        coord_index = self.__coord_index(point_key(obs['id'], obs['corner']))
+        jobs = []
+        for host in np.unique(obs['host'][with_meta]).tolist():
+            rows = np.flatnonzero(obs['host'] == host)
+            # observations of points without coordinate are outliers
+            self.__inlier[rows] = OUTLIER
+            known = rows[coord_index[rows] >= 0]
+            # RANSAC depends on the order of the points, sort them by marker
+            known = known[np.argsort(coord_index[known], kind='stable')]
+            if len(known) < 4:
+                Logger().warning("Not enough markers for %s", self.__hosts[host])
+                continue
+            jobs.append((host, known))
+
+        with ThreadPoolExecutor(self.__workers) as executor:
+            results = list(executor.map(
+                lambda job: self.__solve_pose(*job, coord_index), jobs))
 
-        for (hostname, lensposition), group in df[df["wx"] != None].groupby(['hostname', 'LensPosition']):  # noqa: E711
-            Logger().debug(f"Processing {hostname}")
-            cameraMatrix, distCoeffs = self.__camera_matrix(lensposition)
-            objp = group[['wx', 'wy', 'wz']].to_numpy(dtype=np.float32)
-            imgp = group[['x', 'y']].to_numpy(dtype=np.float32)
-            ret, rvecs, tvecs, inlier = cv2.solvePnPRansac(
-                objp, imgp, cameraMatrix, distCoeffs, reprojectionError=10.0)
+        cameras = {}
+        for (host, known), (cameraMatrix, distCoeffs, rvecs, tvecs, inlier) in zip(jobs, results):
+            hostname = self.__hosts[host]
             cameras[hostname] = {'cameraMatrix': cameraMatrix,
                                  'distCoeffs': distCoeffs, 'rvecs': rvecs, 'tvecs': tvecs}
-            rVec = rvecs[:, 0]
-            rMat = cv2.Rodrigues(rVec)[0]
-            R = np.linalg.inv(rMat)
-            t = tvecs[:, 0].T
-            t = -R@t
-            rVecEuler = self.rotationMatrixToEuler(R)
-            self.__cameras[hostname] = {
-                "x": t[0], "y": t[1], "z": t[2], "roll": rVecEuler[0], "pitch": rVecEuler[1], "yaw": rVecEuler[2]}
-
-            for i, ind in enumerate(group.index):
-                id = df.at[ind, 'id']
-                corner = df.at[ind, 'corner']
-                is_inlier = False
-                if inlier is not None and i in inlier:
-                    is_inlier = True
-                self.__marker_pos.loc[(
-                    hostname, id, corner), 'inlier'] = is_inlier
+            self.__cameras[hostname] = self.camera_exterior(rvecs, tvecs)
+
+            self.__inlier[known[inlier]] = INLIER
         return cameras
 
-    def __create_dataframe(self) -> pd.DataFrame:
-        return pd.merge(self.__marker_pos.reset_index(), self.__marker_coords.reset_index(),
-                        left_on=['id', 'corner'],
-                        right_on=['id', 'corner'], how='outer'). \
-            merge(self.__metadata.reset_index(), left_on='hostname',
-                  right_on='hostname')
+    def __solve_pose(self, host: int, known: npt.NDArray[np.intp],
+                     coord_index: npt.NDArray[np.intp]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, npt.NDArray[np.intp]]:
+        """
+        Estimates the pose of one camera.
+
+        A known pose of the camera (previous session) is used as start value if
+        most of the markers are still reprojected close to their detection,
+        otherwise the pose is estimated with RANSAC. Fixed cameras keep their
+        known pose.
+
+        Args:
+            host: The index of the host.
+            known: The rows of the observations of the host with known coordinate.
+            coord_index: The row in __coords of each observation.
+
+        Returns:
+            The camera matrix, distortion coefficients, rotation and translation
+            vector and the indices of the inliers in known.
+        """
+        hostname = self.__hosts[host]
+        Logger().debug(f"Processing {hostname}")
+        cameraMatrix, distCoeffs = camera_matrix(float(self.__lens[host]))
+        objp = self.__coords[coord_index[known]].astype(np.float32)
+        imgp = np.stack([self.__obs['x'][known], self.__obs['y'][known]],
+                        axis=1).astype(np.float32)
+
+        guess = self.__guess.get(hostname)
+        if guess is not None:
+            inlier = self.__reprojection_inliers(
+                objp, imgp, cameraMatrix, distCoeffs, guess['rvecs'], guess['tvecs'])
+            if hostname in self.__fixed and len(inlier) >= 4:
+                return (cameraMatrix, distCoeffs,
+                        np.array(guess['rvecs'], dtype=np.float64).reshape(3, 1),
+                        np.array(guess['tvecs'], dtype=np.float64).reshape(3, 1), inlier)
+            if len(inlier) >= max(4, len(known) // 2):
+                rvecs = np.array(guess['rvecs'], dtype=np.float64).reshape(3, 1)
+                tvecs = np.array(guess['tvecs'], dtype=np.float64).reshape(3, 1)
+                ret, rvecs, tvecs = cv2.solvePnP(
+                    objp[inlier], imgp[inlier], cameraMatrix, distCoeffs, rvecs, tvecs,
+                    useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+                inlier = self.__reprojection_inliers(
+                    objp, imgp, cameraMatrix, distCoeffs, rvecs, tvecs)
+                if ret and len(inlier) >= max(4, len(known) // 2):
+                    return cameraMatrix, distCoeffs, rvecs, tvecs, inlier
+            Logger().info("Previous pose of %s does not fit", hostname)
+
+        ret, rvecs, tvecs, inlier = cv2.solvePnPRansac(
+            objp, imgp, cameraMatrix, distCoeffs, reprojectionError=REPROJECTION_ERROR)
+        if inlier is None:
+            return cameraMatrix, distCoeffs, rvecs, tvecs, np.empty(0, dtype=np.intp)
+        return cameraMatrix, distCoeffs, rvecs, tvecs, inlier.ravel()
+
+    @staticmethod
+    def __reprojection_inliers(objp: np.ndarray, imgp: np.ndarray, cameraMatrix: np.ndarray,
+                               distCoeffs: np.ndarray, rvecs: np.ndarray, tvecs: np.ndarray) -> npt.NDArray[np.intp]:
+        """
+        Returns the indices of the points reprojected closer than REPROJECTION_ERROR.
+        """
+        image, _ = cv2.projectPoints(objp, np.asarray(rvecs, dtype=np.float64),
+                                     np.asarray(tvecs, dtype=np.float64), cameraMatrix, distCoeffs)
+        error = np.linalg.norm(image.reshape(-1, 2) - imgp, axis=1)
+        return np.flatnonzero(error < REPROJECTION_ERROR)
 
     def get_corrected_coordinates(self) -> dict[int, ArucoMarkerCorners]:
         """
@@ -295,15 +433,12 @@ class MarkerChecker:
         """
         if not self.__is_filtered:
             self.check()
-        d = {}
-        for id, corners in self.__marker_coords.reset_index().groupby('id'):
-            d[id] = ArucoMarkerCorners()
-            for _, coord in corners.iterrows():
-                d[id][int(coord['corner'])] = Point3D(
-                    coord['wx'], coord['wy'], coord['wz'])
-                # Logger().info(
-                #    f"ID: {id} Corner: {coord['corner']} Coord: {coord['wx']} {coord['wy']} {coord['wz']}")
-
+        d: dict[int, ArucoMarkerCorners] = {}
+        for key, coord in zip(self.__keys.tolist(), self.__coords.tolist()):
+            id, corner = divmod(key, 4)
+            if id not in d:
+                d[id] = ArucoMarkerCorners()
+            d[id][corner] = Point3D(*coord)
         return d
 
     def get_filtered_positions(self) -> dict[str, list[ArucoMarkerPos]]:
@@ -315,18 +450,51 @@ class MarkerChecker:
         """
         if not self.__is_filtered:
             self.check()
-        d = {}
-
-        group = self.__marker_pos[self.__marker_pos['inlier']
-                                  != False].reset_index().groupby('hostname')  # noqa: E712
+        d: dict[str, list[ArucoMarkerPos]] = {}
+        obs = self.__obs[self.__inlier != OUTLIER]
+        for host, id, corner, x, y in obs.tolist():
+            d.setdefault(self.__hosts[host], []).append(
+                {'id': id, 'corner': corner, 'x': x, 'y': y})
+        return dict(sorted(d.items()))
+
+    def get_residuals(self) -> dict[str, list[ArucoMarkerResidual]]:
+        """
+        Get the reprojection residuals of all observations of known coordinates.
 
-        for hostname, positions in group:
-            d[hostname] = []
-            for _, pos in positions.iterrows():
-                d[hostname].append(
-                    {'id': pos['id'], 'corner': pos['corner'], 'x': pos['x'], 'y': pos['y']})
+        Returns:
+            A dictionary containing the residuals in pixels per camera.
+        """
+        if not self.__is_filtered:
+            self.check()
+        obs = self.__obs
+        coord_index = self.__coord_index(point_key(obs['id'], obs['corner']))
+        d: dict[str, list[ArucoMarkerResidual]] = {}
+        for hostname, camera in sorted(self.__poses.items()):
+            rows = np.flatnonzero((obs['host'] == self.__hosts.index(hostname)) &
+                                  (coord_index >= 0))
+            if len(rows) == 0:
+                continue
+            image, _ = cv2.projectPoints(self.__coords[coord_index[rows]], camera['rvecs'],
+                                         camera['tvecs'], camera['cameraMatrix'], camera['distCoeffs'])
+            residual = np.linalg.norm(image.reshape(-1, 2) - np.stack(
+                [obs['x'][rows], obs['y'][rows]], axis=1), axis=1)
+            d[hostname] = [{'id': id, 'corner': corner, 'residual': r}
+                           for id, corner, r in zip(obs['id'][rows].tolist(), obs['corner'][rows].tolist(), residual.tolist())]
         return d
 
+    def get_poses(self) -> dict[str, dict[str, np.ndarray]]:
+        """
+        Get the intrinsics, rotation and translation vectors of the cameras.
+
+        They can be passed as poses to the MarkerChecker of the next session.
+
+        Returns:
+            A dictionary containing cameraMatrix, distCoeffs, rvecs and tvecs per camera.
+        """
+        if not self.__is_filtered:
+            self.check()
+        return dict(self.__poses)
+
     def get_cameras(self) -> dict[str, CameraExterior]:
         """
         Get the cameras.
@@ -336,7 +504,28 @@ class MarkerChecker:
         """
         return self.__cameras
 
-    def rotationMatrixToEuler(self, R: np.ndarray) -> np.ndarray:
+    @staticmethod
+    def camera_exterior(rvecs: np.ndarray, tvecs: np.ndarray) -> CameraExterior:
+        """
+        Converts the rotation and translation vector of OpenCV to the exterior orientation.
+
+        Args:
+            rvecs: The rotation vector, shape (3, 1).
+            tvecs: The translation vector, shape (3, 1).
+
+        Returns:
+            The position and the Euler angles of the camera.
+        """
+        rVec = rvecs[:, 0]
+        rMat = cv2.Rodrigues(rVec)[0]
+        R = np.linalg.inv(rMat)
+        t = tvecs[:, 0].T
+        t = -R@t
+        rVecEuler = MarkerChecker.rotationMatrixToEuler(R)
+        return {"x": t[0], "y": t[1], "z": t[2], "roll": rVecEuler[0], "pitch": rVecEuler[1], "yaw": rVecEuler[2]}
+
+    @staticmethod
+    def rotationMatrixToEuler(R: np.ndarray) -> np.ndarray:
         """
         Converts a rotation matrix to Euler angles.
         from: https://learnopencv.com/rotation-matrix-to-euler-angles/
@@ -347,7 +536,7 @@ class MarkerChecker:
         Returns:
             The Euler angles.
         """
-        if not self.isRotationMatrix(R):
+        if not MarkerChecker.isRotationMatrix(R):
             raise ValueError("Not a valid rotation matrix")
 
         sy = np.sqrt(R[0, 0] * R[0, 0] + R[1, 0] * R[1, 0])
@@ -365,7 +554,8 @@ class MarkerChecker:
 
         return np.array([x, y, z])
 
-    def isRotationMatrix(self, R: np.ndarray) -> bool:
+    @staticmethod
+    def isRotationMatrix(R: np.ndarray) -> bool:
         """
         Check if a matrix is a valid rotation matrix.
         from: https://learnopencv.com/rotation-matrix-to-euler-angles/
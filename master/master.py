@@ -8,15 +8,14 @@
 
 from common.logger import Logger
 from common.conf import Conf
-from flask import Flask, Response, redirect, render_template, request, send_from_directory
+from flask import Flask, Response, abort, redirect, render_template, request, send_file, send_from_directory
 from flask_cors import CORS
 from os import PathLike, path
 from json import dumps as json_dumps
-from glob import glob
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Literal, NoReturn
-from requests import get, Response as GetResponse
 
+from master.camera_proxy import CameraProxy
 from master.control import Control
 
 conf = Conf().get()
@@ -26,7 +25,9 @@ app = Flask(__name__, static_url_path='/bilder',
             static_folder=conf['server']['Folder'], template_folder='../template')
 CORS(app)
 
-control = Control(app)
+# created when run as main, the focus stacking workers import this module again
+control: Control
+camera_proxy: CameraProxy
 
 
 @app.route("/static/<path:filename>")
@@ -46,18 +47,27 @@ def time(time: int) -> str:
 
 @app.route("/overviewZip")
 def overviewZip() -> str:
-    '''Overview of all zip files with images.'''
-    filelist = glob(conf['server']['Folder'] + "*.zip")
-    filelist.sort(key=lambda x: path.getmtime(x), reverse=True)
-
-    def f2d(file: str):
-        time = path.getmtime(file)
-        p = file.replace(conf['server']['Folder'], "")
-        t = datetime.utcfromtimestamp(time).strftime('%Y-%m-%d %H:%M:%S')
-        return {'path': p, 'time': t}
-    files = [f2d(file) for file in filelist]
-
-    return render_template('overviewZip.htm', files=files, usb=path.exists('/dev/sda1'))
+    '''Overview of all sessions, the page loads them from /sessions.'''
+    return render_template('overviewZip.htm', usb=path.exists('/dev/sda1'))
+
+
+@app.route("/sessions")
+def sessions() -> str:
+    """ One page of the session catalog: ?offset=0&limit=50&type=stack&since=2024-03-01&until=2024-03-31 """
+    def day(arg: str, days: int = 0) -> float | None:
+        if not request.args.get(arg):
+            return None
+        try:
+            return (datetime.fromisoformat(request.args[arg]) + timedelta(days=days)).timestamp()
+        except ValueError:
+            abort(400)
+    type = request.args.get('type') or None
+    since, until = day('since'), day('until', 1)
+    catalog = control.get_catalog()
+    return json_dumps({
+        'total': catalog.count(type, since, until),
+        'sessions': catalog.page(request.args.get('offset', 0, int),
+                                 min(request.args.get('limit', 50, int), 500), type, since, until)})
 
 
 @app.route("/usb/<path:filename>")
@@ -92,9 +102,49 @@ def stack_html(id: str = "") -> str:
     return capture_html("stack", id)
 
 
-def capture_html(action: Literal['photo', 'stack'] = "photo", id: str = "") -> str:
+@app.route("/raw/<id>")
+def raw_frames(id: str) -> str:
+    """ the frames of a stack that has been stacked on the cameras """
+    control.download_raw_frames(id)
+    return render_template('wait.htm', time=10, target_url="/overviewZip", title="Download frames...")
+
+
+@app.route("/thumb/<id>/<camera>.jpg")
+def thumbnail(id: str, camera: str) -> Response:
+    """ small copy of a camera image, revalidated by its ETag """
+    file = control.get_thumbnails().thumbnail(id, camera)
+    if file is None:
+        abort(404)
+    return send_file(file, mimetype='image/jpeg', max_age=0)
+
+
+@app.route("/mosaic/<id>.jpg")
+def mosaic(id: str) -> Response:
+    """ all cameras of a session in one image """
+    file = control.get_thumbnails().mosaic(id)
+    if file is None:
+        abort(404)
+    return send_file(file, mimetype='image/jpeg', max_age=0)
+
+
+@app.route("/trigger")
+@app.route("/trigger/<id>")
+def trigger_html(id: str = "") -> str:
+    """ all cameras take the frame exposed closest to a common time """
+    return capture_html("trigger", id)
+
+
+def capture_html(action: Literal['photo', 'stack', 'trigger'] = "photo", id: str = "") -> str:
     if id == "":
-        id = control.capture_photo(action)
+        focus = None
+        if action == "stack" and request.args.get('focus'):
+            # /stack?focus=1,2.5,4
+            try:
+                focus = [float(f) for f in request.args['focus'].split(',') if f.strip()]
+            except ValueError:
+                Logger().error("Invalid lens positions: %s", request.args['focus'])
+                abort(400)
+        id = control.capture_photo(action, focus=focus)
         return render_template('wait.htm', time=10,
                                target_url=f"/{action}/{id}", title="Photo...")
 
@@ -151,10 +201,30 @@ def resume() -> str:
     return render_template('wait.htm', time=5, target_url="/", title="Resume...")
 
 
-@app.route('/proxy/<host>/<path>')
-def proxy(host: str, path: str) -> bytes:
-    r: GetResponse = get("http://"+host+"/"+path)
-    return r.content
+@app.route('/proxy/<host>/<path:path>', methods=['GET', 'POST'])
+def proxy(host: str, path: str) -> Response:
+    """ passes a request through to a camera, the answer is streamed """
+    r = camera_proxy.request(request.method, host, path, request.query_string.decode(),
+                             request.headers.items(), request.get_data() or None)
+    return Response(r.body, status=r.status, headers=r.headers)
+
+
+@app.route("/proxyStats")
+def proxy_stats() -> str:
+    """ Statistics of the proxy to the cameras """
+    return json_dumps(camera_proxy.get_stats(), indent=2)
+
+
+@app.route("/downloadStats")
+def download_stats() -> str:
+    """ Statistics of the photo download workers """
+    return json_dumps(control.get_download_stats(), indent=2)
+
+
+@app.route("/messagingStats")
+def messaging_stats() -> str:
+    """ Statistics of the UDP messages to the cameras """
+    return json_dumps(control.get_messaging_stats(), indent=2)
 
 
 @app.route("/update")
@@ -242,4 +312,9 @@ def config_post() -> str:
                            title="Setup...")
 
 
-control.start()
+if __name__ == "__main__":
+    control = Control(app)
+    camera_proxy = CameraProxy(pool_size=conf['server'].getint('ProxyConnections', 4),
+                               read_timeout=conf['server'].getfloat('ProxyTimeout', 10.),
+                               cache_ttl=conf['server'].getfloat('ProxyCacheTime', 0.))
+    control.start()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from collections import deque
+from os import path, remove, replace
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, NamedTuple
+
+from requests import RequestException
+
+from common.logger import Logger
+from common.typen import DownloadStats
+from master.session_pool import SessionPool
+
+
+class DownloadJob(NamedTuple):
+    """
+    Represents a photo that has to be collected from a camera.
+
+    Attributes:
+        id (str): The ID of the capture.
+        hostname (str): The hostname of the camera.
+        ip (str): The ip of the camera.
+        url (str): The url of the photo on the camera.
+        target (str): The file the photo is written to.
+    """
+    id: str
+    hostname: str
+    ip: str
+    url: str
+    target: str
+
+
+class PhotoDownloader:
+    """
+    A bounded pool of worker threads that collects photos from the cameras.
+
+    Photos are streamed in chunks into a temporary file next to the target,
+    which is renamed after the download has been completed. Every camera gets
+    a keep-alive session and a limited number of parallel downloads, failed
+    downloads are retried with an exponential backoff.
+
+    Each camera has its own queue. An idle worker takes the next job of a
+    camera with a free slot, the cameras take turns. If all cameras with
+    pending jobs are busy, the workers wait until a download has finished.
+
+    Attributes:
+        __pending (dict[str, deque[DownloadJob]]): The pending downloads by camera ip, in the order the cameras take turns.
+        __busy (dict[str, int]): The number of running downloads by camera ip.
+        __condition (Condition): Signals new jobs, free slots and stopping.
+        __sessions (SessionPool): The keep-alive sessions per camera.
+        __callback (Callable[[DownloadJob, bool], None]): Called after each job.
+
+    Methods:
+        start(): None
+        stop(): None
+        download(job: DownloadJob): None
+        get_stats(): DownloadStats
+    """
+
+    __RATE_WINDOW = 10.
+
+    def __init__(self, callback: Callable[[DownloadJob, bool], None],
+                 workers: int = 4, per_camera: int = 2, retries: int = 3,
+                 backoff: float = 0.5, chunk_size: int = 65536,
+                 timeout: float = 10.):
+        """
+        Initializes the PhotoDownloader object.
+
+        Args:
+            callback: Called with the job and the success after each download.
+            workers: The number of worker threads.
+            per_camera: The maximum number of parallel downloads per camera.
+            retries: The number of retries after a failed download.
+            backoff: The waiting time before the first retry in seconds.
+            chunk_size: The size of the chunks written to disk.
+            timeout: The connect and read timeout in seconds.
+        """
+        self.__callback = callback
+        self.__workers = workers
+        self.__per_camera = per_camera
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__chunk_size = chunk_size
+        self.__timeout = timeout
+
+        self.__pending: dict[str, deque[DownloadJob]] = {}
+        self.__busy: dict[str, int] = {}
+        self.__condition = Condition()
+        self.__stopping = False
+        self.__sessions = SessionPool(per_camera)
+        self.__threads: list[Thread] = []
+
+        self.__stats_lock = Lock()
+        self.__active = 0
+        self.__done = 0
+        self.__failed = 0
+        self.__retry_count = 0
+        self.__bytes_total = 0
+        self.__transfers: deque[tuple[float, int]] = deque()
+
+    def start(self) -> None:
+        """
+        Starts the worker threads.
+        """
+        if self.__threads:
+            return
+        with self.__condition:
+            self.__stopping = False
+        for i in range(self.__workers):
+            t = Thread(target=self.__work, name=f"Download-{i}", daemon=True)
+            t.start()
+            self.__threads.append(t)
+
+    def stop(self) -> None:
+        """
+        Stops the worker threads and closes all sessions.
+        """
+        with self.__condition:
+            self.__stopping = True
+            self.__condition.notify_all()
+        for t in self.__threads:
+            t.join()
+        self.__threads = []
+        self.__sessions.close()
+
+    def download(self, job: DownloadJob) -> None:
+        """
+        Adds a photo to the download queue.
+
+        Args:
+            job: The photo to collect.
+        """
+        self.start()
+        with self.__condition:
+            self.__pending.setdefault(job.ip, deque()).append(job)
+            self.__condition.notify()
+
+    def get_stats(self) -> DownloadStats:
+        """
+        Returns the statistics of the download pipeline.
+
+        Returns:
+            The queue depth, transfer counters and the current download rate.
+        """
+        with self.__condition:
+            queue_depth = sum(len(jobs) for jobs in self.__pending.values())
+        with self.__stats_lock:
+            self.__drop_old_transfers()
+            rate = sum(b for _, b in self.__transfers) / self.__RATE_WINDOW
+            return {'queue_depth': queue_depth,
+                    'active': self.__active,
+                    'done': self.__done,
+                    'failed': self.__failed,
+                    'retries': self.__retry_count,
+                    'bytes_total': self.__bytes_total,
+                    'bytes_per_second': rate}
+
+    def __drop_old_transfers(self) -> None:
+        limit = monotonic() - self.__RATE_WINDOW
+        while self.__transfers and self.__transfers[0][0] < limit:
+            self.__transfers.popleft()
+
+    def __next_job(self) -> DownloadJob | None:
+        """
+        Takes the next job of a camera with a free slot, the condition has to be held.
+        """
+        for ip, jobs in self.__pending.items():
+            if self.__busy.get(ip, 0) < self.__per_camera:
+                job = jobs.popleft()
+                # the camera takes its next turn after the others
+                del self.__pending[ip]
+                if jobs:
+                    self.__pending[ip] = jobs
+                self.__busy[ip] = self.__busy.get(ip, 0) + 1
+                return job
+        return None
+
+    def __work(self) -> None:
+        """
+        Main loop of a worker thread.
+        """
+        while True:
+            with self.__condition:
+                job = None
+                while job is None and not self.__stopping:
+                    job = self.__next_job()
+                    if job is None:
+                        self.__condition.wait()
+                if job is None:
+                    return
+            with self.__stats_lock:
+                self.__active += 1
+            success = False
+            try:
+                success = self.__download_with_retry(job)
+            finally:
+                with self.__condition:
+                    self.__busy[job.ip] -= 1
+                    if self.__busy[job.ip] == 0:
+                        del self.__busy[job.ip]
+                    # the camera has a free slot again
+                    self.__condition.notify()
+                with self.__stats_lock:
+                    self.__active -= 1
+                    if success:
+                        self.__done += 1
+                    else:
+                        self.__failed += 1
+            try:
+                self.__callback(job, success)
+            except Exception as e:
+                Logger().error("Error in download callback: %s", e)
+
+    def __download_with_retry(self, job: DownloadJob) -> bool:
+        """
+        Downloads a photo and retries it with an exponential backoff.
+
+        Args:
+            job: The photo to collect.
+
+        Returns:
+            True if the photo has been written to disk.
+        """
+        for attempt in range(self.__retries + 1):
+            if attempt > 0:
+                with self.__stats_lock:
+                    self.__retry_count += 1
+                sleep(self.__backoff * 2 ** (attempt - 1))
+            try:
+                self.__stream_to_file(job)
+                return True
+            except (RequestException, OSError) as e:
+                Logger().info("Error collecting photo from %s (attempt %d): %s",
+                              job.hostname, attempt + 1, e)
+        return False
+
+    def __stream_to_file(self, job: DownloadJob) -> None:
+        """
+        Streams a photo into a temporary file and renames it to the target.
+
+        Args:
+            job: The photo to collect.
+        """
+        tmp = job.target + ".part"
+        session = self.__sessions.get(job.ip)
+        try:
+            with session.get(job.url, stream=True,
+                             timeout=self.__timeout) as r:
+                r.raise_for_status()
+                with open(tmp, 'wb') as f:
+                    for chunk in r.iter_content(self.__chunk_size):
+                        f.write(chunk)
+                        with self.__stats_lock:
+                            self.__bytes_total += len(chunk)
+                            self.__transfers.append((monotonic(), len(chunk)))
+                            self.__drop_old_transfers()
+            replace(tmp, job.target)
+        finally:
+            if path.exists(tmp):
+                remove(tmp)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from os import path, replace
+from shutil import copyfileobj
+from threading import Lock
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from common.logger import Logger
+
+
+class SessionArchive:
+    """
+    Builds the zip archives of the capture sessions incrementally.
+
+    Every file is appended to the open archive of its session as soon as it
+    has been written, so finishing the archive only has to write the central
+    directory. JPEGs are stored without compression, they would not shrink
+    anyway. The archive is written as `<id>.zip.part` and renamed to
+    `<id>.zip` when it is closed.
+
+    A file added a second time, e.g. a rewritten JSON file, is not appended
+    again. The archive is rewritten with its current version when it is
+    closed instead, so every name exists once.
+
+    Attributes:
+        __folder (str): The folder the archives are written to.
+        __archives (dict[str, ZipFile]): The open archives by session ID.
+        __replaced (dict[str, dict[str, str]]): The files added again by session ID and name in the archive.
+        __lock (Lock): Lock for the access to the archives.
+
+    Methods:
+        add(id: str, file: str, arcname: str | None = None): None
+        close(id: str): str | None
+    """
+
+    def __init__(self, folder: str):
+        """
+        Initializes the SessionArchive object.
+
+        Args:
+            folder: The folder the archives are written to.
+        """
+        self.__folder = folder
+        self.__archives: dict[str, ZipFile] = {}
+        self.__replaced: dict[str, dict[str, str]] = {}
+        self.__lock = Lock()
+
+    def __archive_file(self, id: str) -> str:
+        return self.__folder + id + '.zip'
+
+    @staticmethod
+    def __compression(arcname: str) -> int:
+        return ZIP_STORED if arcname.lower().endswith(
+            ('.jpg', '.jpeg', '.png', '.zip')) else ZIP_DEFLATED
+
+    def add(self, id: str, file: str, arcname: str | None = None) -> None:
+        """
+        Appends a file to the archive of a session, the archive is opened if necessary.
+
+        Args:
+            id: The ID of the session.
+            file: The file to append.
+            arcname: The name inside the archive, defaults to the basename of the file.
+        """
+        if arcname is None:
+            arcname = path.basename(file)
+        with self.__lock:
+            if id not in self.__archives:
+                self.__archives[id] = ZipFile(
+                    self.__archive_file(id) + '.part', 'w')
+                self.__replaced[id] = {}
+            archive = self.__archives[id]
+            if arcname in archive.namelist():
+                Logger().info("%s already in archive %s, it is replaced on closing",
+                              arcname, id)
+                self.__replaced[id][arcname] = file
+                return
+            archive.write(file, arcname, compress_type=self.__compression(arcname))
+
+    def close(self, id: str) -> str | None:
+        """
+        Finishes the archive of a session.
+
+        Args:
+            id: The ID of the session.
+
+        Returns:
+            The filename of the finished archive or None if no archive has been started.
+        """
+        with self.__lock:
+            archive = self.__archives.pop(id, None)
+            replaced = self.__replaced.pop(id, {})
+            if archive is None:
+                return None
+            archive.close()
+            file = self.__archive_file(id)
+            if len(replaced) > 0:
+                self.__rewrite(file + '.part', replaced)
+            replace(file + '.part', file)
+            return file
+
+    def __rewrite(self, file: str, replaced: dict[str, str]) -> None:
+        """
+        Rewrites an archive with the current version of the replaced files.
+
+        Args:
+            file: The archive.
+            replaced: The files to take from the disk by name in the archive.
+        """
+        with ZipFile(file) as old, ZipFile(file + '.new', 'w') as new:
+            for info in old.infolist():
+                if info.filename in replaced:
+                    new.write(replaced[info.filename], info.filename,
+                              compress_type=self.__compression(info.filename))
+                    continue
+                copy = ZipInfo(info.filename, info.date_time)
+                copy.compress_type = info.compress_type
+                with old.open(info) as src, new.open(copy, 'w') as dst:
+                    copyfileobj(src, dst)
+        replace(file + '.new', file)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import sqlite3
+from glob import glob
+from os import path
+from threading import Lock
+from time import time
+
+from common.typen import SessionInfo
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    started REAL NOT NULL,
+    cameras INTEGER NOT NULL DEFAULT 0,
+    photos INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    completed REAL,
+    zipped REAL,
+    zip_size INTEGER,
+    usb REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started);
+CREATE INDEX IF NOT EXISTS sessions_type ON sessions (type, started);
+"""
+
+COLUMNS = "id, type, started, cameras, photos, bytes, completed, zipped, zip_size, usb"
+
+
+class SessionCatalog:
+    """
+    Database of the capture sessions, so the overview does not have to list the picture folder.
+
+    Control records each session when it starts, when its photos have
+    arrived, when its archive has been written and when it has been copied
+    to USB. Archives missing in the catalog, e.g. from before it existed,
+    can be imported from the folder.
+
+    Attributes:
+        __db (sqlite3.Connection): The connection to the database.
+        __lock (Lock): Lock for the access to the connection.
+
+    Methods:
+        start(id: str, type: str, cameras: int): None
+        add_photo(id: str, size: int): None
+        complete(id: str): None
+        zipped(id: str, size: int): None
+        copied(id: str): None
+        get(id: str): SessionInfo | None
+        page(offset: int = 0, limit: int = 50, type: str | None = None, since: float | None = None, until: float | None = None): list[SessionInfo]
+        count(type: str | None = None, since: float | None = None, until: float | None = None): int
+        import_archives(folder: str): int
+        close(): None
+    """
+
+    def __init__(self, file: str):
+        """
+        Initializes the SessionCatalog object, the tables are created if necessary.
+
+        Args:
+            file: The SQLite database file.
+        """
+        self.__db = sqlite3.connect(file, check_same_thread=False)
+        self.__lock = Lock()
+        with self.__lock, self.__db:
+            self.__db.executescript(SCHEMA)
+
+    def start(self, id: str, type: str, cameras: int) -> None:
+        """
+        Records a new session.
+
+        Args:
+            id: The ID of the session.
+            type: 'photo', 'stack', 'trigger' or 'aruco'.
+            cameras: The number of cameras the session is sent to.
+        """
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO sessions (id, type, started, cameras) VALUES (?, ?, ?, ?)",
+                (id, type, time(), cameras))
+
+    def add_photo(self, id: str, size: int) -> None:
+        """
+        Counts a downloaded photo.
+
+        Args:
+            id: The ID of the session.
+            size: The size of the photo in bytes.
+        """
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "UPDATE sessions SET photos = photos + 1, bytes = bytes + ? WHERE id = ?", (size, id))
+
+    def complete(self, id: str) -> None:
+        """
+        Records that all photos of a session have arrived.
+
+        Args:
+            id: The ID of the session.
+        """
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "UPDATE sessions SET completed = COALESCE(completed, ?) WHERE id = ?", (time(), id))
+
+    def zipped(self, id: str, size: int) -> None:
+        """
+        Records the archive of a session.
+
+        Args:
+            id: The ID of the session.
+            size: The size of the archive in bytes.
+        """
+        now = time()
+        with self.__lock, self.__db:
+            self.__db.execute(
+                """UPDATE sessions SET zipped = ?, zip_size = ?, completed = COALESCE(completed, ?)
+                   WHERE id = ?""", (now, size, now, id))
+
+    def copied(self, id: str) -> None:
+        """
+        Records that the archive of a session has been copied to USB.
+
+        Args:
+            id: The ID of the session.
+        """
+        with self.__lock, self.__db:
+            self.__db.execute("UPDATE sessions SET usb = ? WHERE id = ?", (time(), id))
+
+    @staticmethod
+    def __to_info(row: tuple) -> SessionInfo:
+        info = SessionInfo(**dict(zip(COLUMNS.split(", "), row)), duration=None)  # type: ignore
+        end = info['zipped'] or info['completed']
+        if end is not None:
+            info['duration'] = end - info['started']
+        return info
+
+    @staticmethod
+    def __where(type: str | None, since: float | None,
+                until: float | None) -> tuple[str, list[str | float]]:
+        conditions: list[str] = []
+        args: list[str | float] = []
+        if type is not None:
+            conditions.append("type = ?")
+            args.append(type)
+        if since is not None:
+            conditions.append("started >= ?")
+            args.append(since)
+        if until is not None:
+            conditions.append("started < ?")
+            args.append(until)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), args
+
+    def get(self, id: str) -> SessionInfo | None:
+        """
+        Get a session by its ID.
+
+        Args:
+            id: The ID of the session.
+
+        Returns:
+            The session or None if it is unknown.
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                f"SELECT {COLUMNS} FROM sessions WHERE id = ?", (id,)).fetchone()
+        return None if row is None else self.__to_info(row)
+
+    def page(self, offset: int = 0, limit: int = 50, type: str | None = None,
+             since: float | None = None, until: float | None = None) -> list[SessionInfo]:
+        """
+        Get one page of sessions, the newest first.
+
+        Args:
+            offset: The number of sessions skipped.
+            limit: The maximum number of sessions.
+            type: Only sessions of this type.
+            since: Only sessions started at or after this Unix time.
+            until: Only sessions started before this Unix time.
+
+        Returns:
+            The sessions of the page.
+        """
+        where, args = self.__where(type, since, until)
+        with self.__lock:
+            rows = self.__db.execute(
+                f"SELECT {COLUMNS} FROM sessions{where} ORDER BY started DESC LIMIT ? OFFSET ?",
+                args + [limit, offset]).fetchall()
+        return [self.__to_info(row) for row in rows]
+
+    def count(self, type: str | None = None, since: float | None = None,
+              until: float | None = None) -> int:
+        """
+        Get the number of sessions matching the filter of page().
+
+        Returns:
+            The number of sessions.
+        """
+        where, args = self.__where(type, since, until)
+        with self.__lock:
+            return self.__db.execute(f"SELECT COUNT(*) FROM sessions{where}", args).fetchone()[0]
+
+    def import_archives(self, folder: str) -> int:
+        """
+        Adds the zip archives of a folder that are not in the catalog yet.
+
+        Their type is unknown, the start and finish times are the modification time of the archive.
+
+        Args:
+            folder: The folder of the archives.
+
+        Returns:
+            The number of imported archives.
+        """
+        rows = []
+        for file in glob(folder + "*.zip"):
+            mtime = path.getmtime(file)
+            rows.append((path.basename(file)[:-4], "unknown", mtime, mtime, mtime, path.getsize(file)))
+        with self.__lock, self.__db:
+            cursor = self.__db.executemany(
+                """INSERT OR IGNORE INTO sessions (id, type, started, completed, zipped, zip_size)
+                   VALUES (?, ?, ?, ?, ?, ?)""", rows)
+            return cursor.rowcount
+
+    def close(self) -> None:
+        """
+        Closes the database.
+        """
+        with self.__lock:
+            self.__db.close()
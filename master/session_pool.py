@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Lock
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    """
+    Holds one keep-alive HTTP session per camera host.
+
+    A new TCP connection per request is expensive on the Raspberry Pis, so
+    every host gets its own `requests.Session` with a small connection pool
+    that is reused for all following requests.
+
+    Attributes:
+        __sessions (dict[str, Session]): The sessions by host.
+        __pool_size (int): The number of connections kept open per host.
+        __lock (Lock): Lock for the creation of new sessions.
+
+    Methods:
+        get(host: str): Session
+        close(): None
+    """
+
+    def __init__(self, pool_size: int = 2):
+        """
+        Initializes the SessionPool object.
+
+        Args:
+            pool_size: The number of connections kept open per host.
+        """
+        self.__sessions: dict[str, Session] = {}
+        self.__pool_size = pool_size
+        self.__lock = Lock()
+
+    def get(self, host: str) -> Session:
+        """
+        Returns the session for the given host and creates it if necessary.
+
+        Args:
+            host: The host (ip or ip:port) of the camera.
+
+        Returns:
+            The session for the host.
+        """
+        with self.__lock:
+            if host not in self.__sessions:
+                session = Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.__pool_size)
+                session.mount("http://", adapter)
+                self.__sessions[host] = session
+            return self.__sessions[host]
+
+    def close(self) -> None:
+        """
+        Closes all sessions.
+        """
+        with self.__lock:
+            for session in self.__sessions.values():
+                session.close()
+            self.__sessions.clear()
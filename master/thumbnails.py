@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from glob import glob
+from math import ceil, sqrt
+from os import makedirs, path, replace
+from threading import Lock
+
+import numpy as np
+import numpy.typing as npt
+from cv2 import (FONT_HERSHEY_SIMPLEX, IMREAD_COLOR, IMREAD_REDUCED_COLOR_2, IMREAD_REDUCED_COLOR_4,
+                 IMREAD_REDUCED_COLOR_8, IMWRITE_JPEG_QUALITY, INTER_AREA, LINE_AA, imencode, imread,
+                 putText, resize)
+
+from common.logger import Logger
+
+REDUCED = {8: IMREAD_REDUCED_COLOR_8, 4: IMREAD_REDUCED_COLOR_4, 2: IMREAD_REDUCED_COLOR_2, 1: IMREAD_COLOR}
+
+# session IDs and camera names taken from URLs, nothing that leaves the folder
+NAME = re.compile(r"[\w-]+")
+# the images of the cameras, the frames of a stack are named <hostname>_<lens position>.jpg
+HOSTNAME = re.compile(r"[A-Za-z0-9-]+")
+
+
+def read_reduced(file: str, width: int) -> npt.NDArray[np.uint8] | None:
+    """
+    Reads a JPEG scaled down by libjpeg while decoding.
+
+    The image is decoded at 1/8 first, only if that is smaller than the
+    requested width it is decoded again with the largest sufficient factor.
+
+    Args:
+        file: The JPEG file.
+        width: The minimum width of the result.
+
+    Returns:
+        The image, at least width pixels wide if the original is, or None if it cannot be read.
+    """
+    img = imread(file, REDUCED[8])
+    if img is None or img.shape[1] >= width:
+        return img
+    full = img.shape[1] * 8
+    factor = next(f for f in (4, 2, 1) if full // f >= width or f == 1)
+    return imread(file, REDUCED[factor])
+
+
+class ThumbnailCache:
+    """
+    Keeps small copies of the camera images of the capture sessions and a mosaic of all cameras.
+
+    The thumbnails are written to thumbs/<id>/ next to the sessions, so
+    they are neither part of the session folder nor of its zip. They are
+    created in a background thread when a photo has been downloaded and
+    recreated when a stacked image replaces it. A thumbnail or mosaic that
+    is older than its source is recreated when it is requested. The mosaic
+    shows the cameras whose images are in the session folder.
+
+    Attributes:
+        __folder (str): The folder of the sessions.
+        __width (int): The width of the thumbnails.
+        __columns (int): The number of columns of the mosaic, 0 for a square layout.
+        __mosaics (dict[str, list[str]]): The cameras of the last mosaic by session ID.
+        __lock (Lock): Lock for writing the thumbnails.
+        __executor (ThreadPoolExecutor): Creates the thumbnails after the downloads.
+
+    Methods:
+        add(id: str, file: str): Future
+        thumbnail(id: str, camera: str): str | None
+        cameras(id: str): list[str]
+        mosaic(id: str): str | None
+        finish(id: str): Future
+        shutdown(): None
+    """
+
+    def __init__(self, folder: str, width: int = 320, columns: int = 0):
+        """
+        Initializes the ThumbnailCache object.
+
+        Args:
+            folder: The folder of the sessions.
+            width: The width of the thumbnails.
+            columns: The number of columns of the mosaic, 0 for a square layout.
+        """
+        self.__folder = folder
+        self.__width = width
+        self.__columns = columns
+        self.__mosaics: dict[str, list[str]] = {}
+        self.__lock = Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Thumbnails")
+
+    def __thumb_folder(self, id: str) -> str:
+        return self.__folder + "thumbs/" + id + "/"
+
+    def add(self, id: str, file: str) -> Future:
+        """
+        Queues the thumbnail of a camera image that has been written or replaced.
+
+        Args:
+            id: The ID of the session.
+            file: The image <camera>.jpg in the session folder.
+        """
+        camera = path.splitext(path.basename(file))[0]
+        return self.__executor.submit(self.__create, id, camera)
+
+    def thumbnail(self, id: str, camera: str) -> str | None:
+        """
+        Returns the thumbnail of a camera, it is created if it is missing or outdated.
+
+        Args:
+            id: The ID of the session.
+            camera: The hostname of the camera.
+
+        Returns:
+            The file of the thumbnail or None if the session has no image of the camera.
+        """
+        if not NAME.fullmatch(id) or not NAME.fullmatch(camera):
+            return None
+        source = self.__folder + id + "/" + camera + ".jpg"
+        thumb = self.__thumb_folder(id) + camera + ".jpg"
+        if not path.exists(source):
+            return None
+        if path.exists(thumb) and path.getmtime(thumb) >= path.getmtime(source):
+            return thumb
+        return self.__create(id, camera)
+
+    def __create(self, id: str, camera: str) -> str | None:
+        if not NAME.fullmatch(id) or not NAME.fullmatch(camera):
+            Logger().warning("Invalid thumbnail %s/%s", id, camera)
+            return None
+        source = self.__folder + id + "/" + camera + ".jpg"
+        thumb = self.__thumb_folder(id) + camera + ".jpg"
+        try:
+            img = read_reduced(source, self.__width)
+            if img is None:
+                Logger().warning("Cannot read %s", source)
+                return None
+            if img.shape[1] > self.__width:
+                img = resize(img, (self.__width, img.shape[0] * self.__width // img.shape[1]),
+                             interpolation=INTER_AREA)
+            with self.__lock:
+                self.__write(thumb, img)
+            return thumb
+        except Exception as e:
+            Logger().error("Error creating thumbnail of %s: %s", source, e)
+            return None
+
+    def cameras(self, id: str) -> list[str]:
+        """
+        Returns the cameras with an image in the session folder.
+
+        Args:
+            id: The ID of the session.
+
+        Returns:
+            The sorted hostnames of the cameras.
+        """
+        if not NAME.fullmatch(id):
+            return []
+        names = [path.splitext(path.basename(f))[0] for f in glob(self.__folder + id + "/*.jpg")]
+        return sorted(name for name in names if HOSTNAME.fullmatch(name))
+
+    def mosaic(self, id: str) -> str | None:
+        """
+        Returns a single image with the thumbnails of all cameras, it is created if it is outdated.
+
+        Args:
+            id: The ID of the session.
+
+        Returns:
+            The file of the mosaic or None if the session has no images.
+        """
+        cameras = self.cameras(id)
+        thumbs = [(camera, self.thumbnail(id, camera)) for camera in cameras]
+        thumbs = [(camera, thumb) for camera, thumb in thumbs if thumb is not None]
+        if len(thumbs) == 0:
+            return None
+        mosaic = self.__thumb_folder(id) + "mosaic.jpg"
+        if (path.exists(mosaic) and self.__mosaics.get(id) == cameras and
+                all(path.getmtime(thumb) <= path.getmtime(mosaic) for _, thumb in thumbs)):
+            return mosaic
+
+        columns = self.__columns or ceil(sqrt(len(thumbs)))
+        rows = ceil(len(thumbs) / columns)
+        tiles = [(camera, imread(thumb)) for camera, thumb in thumbs]
+        h, w = tiles[0][1].shape[:2]
+        sheet = np.zeros((rows * h, columns * w, 3), dtype=np.uint8)
+        for i, (camera, tile) in enumerate(tiles):
+            if tile.shape[:2] != (h, w):
+                tile = resize(tile, (w, h), interpolation=INTER_AREA)
+            y, x = i // columns * h, i % columns * w
+            sheet[y:y + h, x:x + w] = tile
+            putText(sheet, camera, (x + 4, y + h - 6), FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 3, LINE_AA)
+            putText(sheet, camera, (x + 4, y + h - 6), FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, LINE_AA)
+        with self.__lock:
+            self.__write(mosaic, sheet)
+            self.__mosaics[id] = list(cameras)
+        return mosaic
+
+    def finish(self, id: str) -> Future:
+        """
+        Queues the mosaic of a session whose photos have all been written.
+
+        Args:
+            id: The ID of the session.
+        """
+        return self.__executor.submit(self.mosaic, id)
+
+    def __write(self, file: str, img: npt.NDArray[np.uint8]) -> None:
+        """
+        Writes a JPEG into a temporary file and renames it, a reader never gets a partial image.
+        """
+        makedirs(path.dirname(file), exist_ok=True)
+        ok, data = imencode(".jpg", img, [IMWRITE_JPEG_QUALITY, 85])
+        if not ok:
+            raise ValueError("Cannot encode " + file)
+        with open(file + ".part", "wb") as f:
+            f.write(data.tobytes())
+        replace(file + ".part", file)
+
+    def shutdown(self) -> None:
+        """
+        Waits for the queued thumbnails.
+        """
+        self.__executor.shutdown(wait=True)
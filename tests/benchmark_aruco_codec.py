@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares the JSON and the binary encoding of the ArUco results.
+
+Run from the repository root: python -m tests.benchmark_aruco_codec
+
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from json import dumps, loads
+from timeit import timeit
+
+from common.aruco_codec import FRAGMENT_SIZE, decode_aruco, encode_aruco, fragment
+from common.typen import ArucoMarkerPos, ArucoMetaBroadcast, Metadata
+
+META: Metadata = {
+    'SensorTimestamp': 1714133412345678, 'ScalerCrop': [0, 0, 4608, 2592],
+    'AfPauseState': 0, 'ExposureTime': 19996, 'SensorBlackLevels': [4096] * 4,
+    'AnalogueGain': 1.0, 'FrameDuration': 90001, 'SensorTemperature': 36.0,
+    'LensPosition': 2.0, 'DigitalGain': 1.0011, 'AfState': 0, 'AeLocked': True,
+    'Lux': 391.3, 'FocusFoM': 1241, 'ColourGains': [2.0117, 1.8046],
+    'ColourTemperature': 4534,
+    'ColourCorrectionMatrix': [1.7, -0.5, -0.2, -0.3, 1.6, -0.3, -0.1, -0.6, 1.7]}
+
+
+def main():
+    print(f"{'markers':>7} {'json B':>8} {'binary B':>8} {'fragments':>9} "
+          f"{'json enc/dec us':>16} {'bin enc/dec us':>15}")
+    for count in [1, 10, 30, 100, 300]:
+        marker: list[ArucoMarkerPos] = [
+            {'id': i // 4, 'corner': i % 4, 'x': 1234.5678 + i, 'y': 2345.6789 - i}
+            for i in range(count * 4)]
+        data: ArucoMetaBroadcast = {'aruco': marker, 'meta': META}
+        json_str = dumps(data, indent=None, separators=(",", ":"))
+        binary = encode_aruco(marker, META)
+        n = 200
+        json_enc = timeit(lambda: dumps(data, separators=(",", ":")), number=n)
+        json_dec = timeit(lambda: loads(json_str), number=n)
+        bin_enc = timeit(lambda: encode_aruco(marker, META), number=n)
+        bin_dec = timeit(lambda: decode_aruco(binary), number=n)
+        print(f"{count:>7} {len(json_str):>8} {len(binary):>8} "
+              f"{len(fragment(binary, FRAGMENT_SIZE)):>9} "
+              f"{json_enc / n * 1e6:>7.0f}/{json_dec / n * 1e6:<8.0f} "
+              f"{bin_enc / n * 1e6:>7.0f}/{bin_dec / n * 1e6:<7.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the bundle adjustment on synthetic rigs with up to 200 cameras.
+
+The poses of the MarkerChecker are perturbed by about 3 mrad and 3 mm
+before the adjustment. The size of the Jacobian shows how much a dense
+matrix would need.
+
+Run from the repository root: python -m tests.benchmark_bundle_adjustment
+
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import logging
+from time import perf_counter
+
+import numpy as np
+
+from common.logger import Logger
+from master.bundle_adjustment import BundleAdjustment
+from master.marker_check import MarkerChecker
+from tests.benchmark_marker_check import scaled_rig
+
+
+def measure(cameras: int, markers: int, refine_intrinsics: bool = False) -> None:
+    coords, pos, meta = scaled_rig(cameras=cameras, markers=markers)
+    checker = MarkerChecker(coords, pos, meta)
+    positions = checker.get_filtered_positions()
+    rng = np.random.default_rng(0)
+    poses = {h: {'rvecs': p['rvecs'] + rng.normal(0, 0.003, (3, 1)),
+                 'tvecs': p['tvecs'] + rng.normal(0, 0.003, (3, 1))}
+             for h, p in checker.get_poses().items()}
+
+    adjustment = BundleAdjustment(coords, positions, meta, poses,
+                                  refine_intrinsics=refine_intrinsics)
+    before = np.median(list(adjustment.get_rms().values()))
+    start = perf_counter()
+    adjustment.adjust()
+    duration = perf_counter() - start
+    after = np.median(list(adjustment.get_rms().values()))
+
+    observations = sum(len(p) for p in positions.values())
+    params = cameras * 6 + markers * 4 * 3 + (8 if refine_intrinsics else 0)
+    rows = observations * 2 + markers * 4 * 3
+    print(f"{cameras:4d} cameras, {markers:4d} markers{' + intrinsics' if refine_intrinsics else '':>13}: "
+          f"{duration * 1000:8.1f} ms, median RMS {before:6.2f} px -> {after:5.2f} px, "
+          f"dense Jacobian {rows * params * 8 / 2**20:7.1f} MiB")
+
+
+def main():
+    Logger().get().setLevel(logging.WARNING)
+    for cameras, markers in [(25, 50), (50, 100), (100, 200), (200, 200)]:
+        measure(cameras, markers)
+    measure(100, 200, refine_intrinsics=True)
+
+
+if __name__ == '__main__':
+    main()
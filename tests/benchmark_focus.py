@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the latency of a focus stack with a simulated lens and frames in real time.
+
+Run from the repository root: python -m tests.benchmark_focus
+
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Condition, Event, Thread
+from time import perf_counter, sleep
+from typing import Any, Callable
+
+from camera.focus_controller import FocusController
+
+STACK = [1, 2, 4, 5, 7]
+
+
+class SimulatedLens:
+    """
+    A running camera whose lens needs offset + slope * distance seconds to settle.
+
+    Every frame reports its LensPosition to the callback, frames exposed
+    while the lens moves report a position on the way to the target.
+    """
+
+    def __init__(self, frame_time: float = 0.07, offset: float = 0.08, slope: float = 0.03,
+                 callback: Callable[[dict[str, Any]], None] | None = None):
+        self.frame_time = frame_time
+        self.__offset = offset
+        self.__slope = slope
+        self.__callback = callback
+        self.__start_position = 0.
+        self.__target = 0.
+        self.__start = perf_counter()
+        self.__frame = 0
+        self.__condition = Condition()
+        self.__stop = Event()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def set_lens(self, position: float) -> None:
+        with self.__condition:
+            self.__start_position = self.position()
+            self.__target = position
+            self.__start = perf_counter()
+
+    def position(self) -> float:
+        settle = self.__offset + self.__slope * abs(self.__target - self.__start_position)
+        done = min(1., (perf_counter() - self.__start) / settle)
+        return self.__start_position + (self.__target - self.__start_position) * done
+
+    def capture_metadata(self) -> dict[str, Any]:
+        with self.__condition:
+            frame = self.__frame
+            self.__condition.wait_for(lambda: self.__frame > frame)
+            return self.__metadata
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.frame_time):
+            with self.__condition:
+                self.__metadata = {'LensPosition': self.position()}
+                self.__frame += 1
+                self.__condition.notify_all()
+            if self.__callback is not None:
+                self.__callback(self.__metadata)
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.__thread.join()
+
+
+def polling(lens: SimulatedLens, position: float) -> None:
+    """
+    The former CameraInterface.focus: polls the metadata every 0.1 s.
+    """
+    lens.set_lens(position)
+    for _ in range(10):
+        if abs(lens.capture_metadata()["LensPosition"] - position) < 0.01:
+            break
+        sleep(0.1)
+
+
+def stack(mode: str, encode: float, repeat: int = 3) -> tuple[float, list[float]]:
+    controller: FocusController | None = None
+    lens = SimulatedLens(callback=lambda m: controller.frame(m) if controller else None)
+    controller = FocusController(lens.set_lens, timeout=1.)
+    totals = []
+    frames: list[float] = []
+    for _ in range(repeat):
+        polling(lens, 0.)
+        start = perf_counter()
+        if mode == 'pipelined':
+            controller.move(STACK[0])
+        for i, position in enumerate(STACK):
+            t = perf_counter()
+            if mode == 'polling':
+                polling(lens, position)
+            elif mode == 'controller':
+                controller.focus(position)
+            else:
+                controller.wait()
+            lens.capture_metadata()  # the capture
+            if mode == 'pipelined' and i + 1 < len(STACK):
+                controller.move(STACK[i + 1])
+            sleep(encode)  # encoding and writing the frame
+            frames.append(perf_counter() - t)
+        totals.append(perf_counter() - start)
+    lens.stop()
+    return min(totals), frames
+
+
+def main():
+    print(f"{'mode':>10} {'encode ms':>9} {'stack ms':>8} {'frame ms (max)':>15}")
+    for encode in [0.05, 0.3]:
+        for mode in ['polling', 'controller', 'pipelined']:
+            total, frames = stack(mode, encode)
+            print(f"{mode:>10} {encode * 1000:>9.0f} {total * 1000:>8.0f} "
+                  f"{sum(frames) / len(frames) * 1000:>6.0f} ({max(frames) * 1000:.0f})")
+
+
+if __name__ == '__main__':
+    main()
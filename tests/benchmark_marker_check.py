@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the MarkerChecker on the fixtures and on a rig scaled up to 100 cameras and 200 markers,
+with one or all CPUs and warm-started from the poses of a previous run.
+
+The scaled rig uses the calibration of config.ini, marker corners with the
+size of the markers of tests/marker.json and cameras on a ring around them.
+
+Run from the repository root: python -m tests.benchmark_marker_check
+
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import logging
+from json import load
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from common.conf import Conf
+from common.logger import Logger
+from common.typen import ArucoMarkerCorners, ArucoMarkerPos, Metadata, Point3D
+from master.marker_check import MarkerChecker
+
+
+def fixture() -> tuple[dict[int, ArucoMarkerCorners], dict[str, list[ArucoMarkerPos]], dict[str, Metadata]]:
+    marker_coord_str: dict[str, dict[str, list[float]]] = load(
+        open('tests/marker.json', 'r'))
+    coords = {int(marker): ArucoMarkerCorners({
+        int(corner): Point3D(*c) for corner, c in corners.items()})
+        for marker, corners in marker_coord_str.items()}
+    pos: dict[str, list[ArucoMarkerPos]] = load(open('tests/aruco.json', 'r'))
+    meta: dict[str, Metadata] = {h: {'LensPosition': 1.} for h in pos}
+    return coords, pos, meta
+
+
+def scaled_rig(cameras: int = 100, markers: int = 200, noise: float = 0.5,
+               seed: int = 0) -> tuple[dict[int, ArucoMarkerCorners], dict[str, list[ArucoMarkerPos]], dict[str, Metadata]]:
+    """
+    Markers facing the center on a cylinder, cameras on a larger cylinder looking at the center.
+    """
+    rng = np.random.default_rng(seed)
+    param = Conf().get()['calibration']
+    lens = 1.
+    f = float(param['f']) + lens * float(param['f_factor'])
+    cx = float(param['cx']) + lens * float(param['cx_factor'])
+    cy = float(param['cy']) + lens * float(param['cy_factor'])
+    k = np.array([[f, 0, cx], [0, f, cy], [0, 0, 1]])
+    dist = np.array([float(param[p]) + lens * float(param[p + '_factor'])
+                     for p in ['k1', 'k2', 'p1', 'p2', 'k3']])
+
+    size = 0.034
+    coords: dict[int, ArucoMarkerCorners] = {}
+    for id in range(markers):
+        a = 2 * np.pi * id / markers
+        z = 0.05 + 0.4 * ((id * 7) % markers) / markers
+        center = np.array([0.45 * np.cos(a), 0.45 * np.sin(a), z])
+        tangent = np.array([-np.sin(a), np.cos(a), 0])
+        up = np.array([0, 0, 1.])
+        corners = [center + (dx * tangent + dy * up) * size / 2
+                   for dx, dy in [(-1, 1), (1, 1), (1, -1), (-1, -1)]]
+        coords[id] = ArucoMarkerCorners(
+            {i: Point3D(*c) for i, c in enumerate(corners)})
+    world = np.array([[c for c in coords[id]] for id in range(markers)],
+                     dtype=np.float64).reshape(-1, 3)
+
+    pos: dict[str, list[ArucoMarkerPos]] = {}
+    for cam in range(cameras):
+        a = 2 * np.pi * cam / cameras
+        eye = np.array([0.7 * np.cos(a), 0.7 * np.sin(a), 0.1 + 0.3 * (cam % 4) / 3])
+        forward = np.array([0, 0, 0.25]) - eye
+        forward /= np.linalg.norm(forward)
+        right = np.cross(forward, [0, 0, 1.])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        r = np.stack([right, down, forward])
+        t = -r @ eye
+        image, _ = cv2.projectPoints(world, cv2.Rodrigues(r)[0], t, k, dist)
+        image = image.reshape(-1, 2) + rng.normal(0, noise, (len(world), 2))
+        depth = (world - eye) @ forward
+        visible = (depth > 0.1) & (image[:, 0] > 0) & (image[:, 0] < 4608) & \
+            (image[:, 1] > 0) & (image[:, 1] < 2592)
+        pos[f"camera{cam:03d}"] = [
+            {'id': i // 4, 'corner': i % 4, 'x': float(x), 'y': float(y)}
+            for i, (x, y) in enumerate(image) if visible[i]]
+    meta: dict[str, Metadata] = {h: {'LensPosition': lens} for h in pos}
+    return coords, pos, meta
+
+
+def measure(name: str, coords, pos, meta, repeat: int = 3, **kwargs) -> None:
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        checker = MarkerChecker(coords, pos, meta, **kwargs)
+        checker.check()
+        checker.get_filtered_positions()
+        checker.get_corrected_coordinates()
+        checker.get_cameras()
+        times.append(perf_counter() - start)
+    observations = sum(len(p) for p in pos.values())
+    print(f"{name:>10}: {len(pos):4d} cameras, {len(coords):4d} markers, "
+          f"{observations:6d} observations: {min(times) * 1000:8.1f} ms")
+
+
+def main():
+    Logger().get().setLevel(logging.WARNING)
+    measure('fixture', *fixture())
+    coords, pos, meta = scaled_rig()
+    measure('scaled', coords, pos, meta)
+    measure('serial', coords, pos, meta, workers=1)
+    # a fixed rig calibrated again with the poses of the previous session
+    poses = MarkerChecker(coords, pos, meta).get_poses()
+    measure('warm', coords, pos, meta, poses=poses)
+    # one wrong coordinate triggers the recalculation
+    c = coords[3][1]
+    assert c is not None
+    coords[3][1] = Point3D(c.x, c.y, c.z + 0.05)
+    measure('recalc', coords, pos, meta)
+
+
+if __name__ == '__main__':
+    main()
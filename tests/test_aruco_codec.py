@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import pytest
+
+from common.aruco_codec import FragmentBuffer, decode_aruco, encode_aruco, fragment
+from common.typen import ArucoMarkerPos, Metadata
+
+
+def markers(count: int) -> list[ArucoMarkerPos]:
+    return [{'id': i // 4, 'corner': i % 4, 'x': 100.25 + i, 'y': 2000.5 - i}
+            for i in range(count)]
+
+
+class TestArucoCodec:
+    meta: Metadata = {'SensorTimestamp': 123456789, 'LensPosition': 2.5,
+                      'ScalerCrop': [0, 0, 4608, 2592]}
+
+    def test_roundtrip(self):
+        m = markers(40)
+        result = decode_aruco(encode_aruco(m, self.meta))
+        assert result['aruco'] == m
+        assert result['meta'] == self.meta
+
+    def test_empty(self):
+        result = decode_aruco(encode_aruco([], {}))
+        assert result == {'aruco': [], 'meta': {}}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            decode_aruco(b'[{"id": 1}]')
+
+    def test_reassembly_out_of_order(self):
+        data = encode_aruco(markers(400), self.meta)
+        fragments = fragment(data, 1000)
+        assert len(fragments) > 2
+        buffer = FragmentBuffer()
+        order = list(reversed(range(len(fragments))))
+        for i in order[:-1]:
+            assert buffer.add('a', i, len(fragments), fragments[i]) is None
+        assert buffer.add('a', order[-1], len(fragments),
+                          fragments[order[-1]]) == data
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Event
+
+import numpy as np
+import pytest
+
+from camera.aruco_worker import ArucoWorker
+from camera.camera_aruco import Aruco
+from cv2 import imread
+
+
+def markers(n: int) -> list:
+    return [{'id': i, 'corner': c, 'x': 0., 'y': 0.} for i in range(n) for c in range(4)]
+
+
+class TestArucoWorker:
+
+    @pytest.fixture
+    def blocked(self):
+        """
+        A worker whose first detection waits for the event.
+        """
+        release = Event()
+        started = Event()
+        detected: list[int] = []
+
+        def detect(img):
+            started.set()
+            release.wait(5)
+            detected.append(int(img[0, 0]))
+            return markers(int(img[0, 0]))
+        worker = ArucoWorker(detect, max_images=10, confident=2,
+                             load=lambda file: np.full((4, 4), int(file), dtype=np.uint8))
+        worker.start()
+        yield worker, release, detected, started
+        release.set()
+        worker.stop()
+
+    def test_newest_session_first(self, blocked):
+        worker, release, detected, started = blocked
+        results: list[str] = []
+        for session, value in [('a', 1), ('b', 2), ('c', 3), ('b', 4), ('c', 5)]:
+            worker.submit(session, str(value), {}, lambda m, meta, s=session: results.append(s),
+                          image=np.full((4, 4), value, dtype=np.uint8))
+            started.wait(5)
+        release.set()
+        worker.join()
+        # 'a' was already being detected, then the newest session first
+        assert detected == [1, 3, 5, 2, 4]
+        assert results == ['a', 'c', 'c', 'b', 'b']
+
+    def test_reuse_stack(self, blocked):
+        worker, release, detected, started = blocked
+        results: list[tuple[int, int]] = []
+        release.set()
+        for frame, (value, position) in enumerate([(1, 1.), (3, 1.), (0, 2.), (5, 1.001)]):
+            worker.submit('stack', str(value), {'frame': frame, 'LensPosition': position},
+                          lambda m, meta: results.append((meta['frame'], len(m) // 4)),
+                          image=np.full((4, 4), value, dtype=np.uint8), reuse=True)
+        worker.join()
+        # the first frame is not confident, the second one is used for the same lens position,
+        # the frame at another lens position is detected again
+        assert detected == [1, 3, 0]
+        assert results == [(0, 1), (1, 3), (2, 0), (3, 3)]
+        assert worker.get_stats()['reused'] == 1
+
+    def test_sessions_dropped(self, blocked):
+        worker, release, detected, started = blocked
+        release.set()
+        # every single photo is a session of its own
+        for value in range(20):
+            worker.submit(f"photo{value}", str(value), {}, lambda m, meta: None,
+                          image=np.full((4, 4), value, dtype=np.uint8))
+        worker.join()
+        assert len(detected) == 20
+        assert worker._ArucoWorker__sessions == {}
+
+    def test_spill(self):
+        worker = ArucoWorker(lambda img: markers(int(img[0, 0])), max_images=1,
+                             load=lambda file: np.full((4, 4), int(file), dtype=np.uint8))
+        for value in [1, 2, 3]:
+            worker.submit('a', str(value), {}, lambda m, meta: None,
+                          image=np.full((4, 4), value, dtype=np.uint8))
+        stats = worker.get_stats()
+        assert stats['in_memory'] == 1
+        assert stats['spilled'] == 2
+        worker.start()
+        worker.join()
+        stats = worker.get_stats()
+        assert stats['processed'] == 3
+        assert stats['in_memory'] == 0
+        worker.stop()
+
+    def test_error(self):
+        worker = ArucoWorker(lambda img: markers(1), load=lambda file: None)
+        worker.start()
+        called: list[bool] = []
+        worker.submit('a', 'missing.jpg', {}, lambda m, meta: called.append(True))
+        worker.join()
+        assert called == []
+        assert worker.get_stats()['errors'] == 1
+        worker.stop()
+
+    def test_detect_file(self):
+        # always the full search, the second image is not searched in the windows of the first
+        worker = ArucoWorker(Aruco(scale=1, use_rois=False).detect_from_rgb)
+        worker.start()
+        results: list[list] = []
+        worker.submit('a', 'tests/test.jpg', {}, lambda m, meta: results.append(m))
+        worker.submit('a', 'tests/test.jpg', {}, lambda m, meta: results.append(m),
+                      image=imread('tests/test.jpg'))
+        worker.join()
+        worker.stop()
+        assert len(results) == 2
+        assert len(results[0]) > 0
+        assert results[0] == results[1]
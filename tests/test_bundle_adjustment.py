@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from common.typen import Point3D
+from master.bundle_adjustment import BundleAdjustment, project, rotation_matrices
+from master.marker_check import MarkerChecker, camera_matrix
+from tests.benchmark_marker_check import scaled_rig
+
+
+class TestBundleAdjustment:
+
+    @pytest.fixture
+    def rig(self):
+        coords, pos, meta = scaled_rig(cameras=24, markers=40, noise=0.3)
+        checker = MarkerChecker(coords, pos, meta)
+        return coords, checker.get_filtered_positions(), meta, checker.get_poses()
+
+    def test_project_like_opencv(self):
+        rng = np.random.default_rng(0)
+        points = rng.uniform(-0.3, 0.3, (50, 3))
+        rvec = rng.normal(0, 0.3, 3)
+        tvec = np.array([0.01, 0.02, 1.])
+        cameraMatrix, distCoeffs = camera_matrix(1.)
+        expected = cv2.projectPoints(points, rvec, tvec, cameraMatrix, distCoeffs)[0].reshape(-1, 2)
+        intrinsics = np.r_[cameraMatrix[0, 0], cameraMatrix[0, 2], cameraMatrix[1, 2], distCoeffs]
+        image = project(np.repeat(rotation_matrices(rvec[None]), 50, axis=0), np.tile(tvec, (50, 1)),
+                        np.tile(intrinsics, (50, 1)), points)
+        assert np.abs(image - expected).max() < 1e-6
+
+    def test_perturbed_poses(self, rig):
+        coords, pos, meta, poses = rig
+        rng = np.random.default_rng(1)
+        perturbed = {h: {'rvecs': p['rvecs'] + rng.normal(0, 0.003, (3, 1)),
+                         'tvecs': p['tvecs'] + rng.normal(0, 0.003, (3, 1))}
+                     for h, p in poses.items()}
+        adjustment = BundleAdjustment(coords, pos, meta, perturbed)
+        before = adjustment.get_rms()
+        adjustment.adjust()
+        after = adjustment.get_rms()
+        assert set(after) == set(pos)
+        assert max(before.values()) > 5
+        # the noise of the image coordinates is 0.3 px per axis
+        assert max(after.values()) < 1
+
+        expected = MarkerChecker.camera_exterior
+        for hostname, camera in adjustment.get_cameras().items():
+            reference = expected(poses[hostname]['rvecs'], poses[hostname]['tvecs'])
+            for axis in ['x', 'y', 'z']:
+                assert abs(camera[axis] - reference[axis]) < 0.002
+
+    def test_wrong_coordinate(self, rig):
+        coords, pos, meta, poses = rig
+        c = coords[5][2]
+        assert c is not None
+        coords[5][2] = Point3D(c.x, c.y, c.z + 0.003)
+        adjustment = BundleAdjustment(coords, pos, meta, poses, coordinate_sigma=0.01)
+        corrected = adjustment.get_corrected_coordinates()[5][2]
+        assert corrected is not None
+        assert abs(corrected.z - c.z) < 0.001
+        # coordinates without observation are kept
+        assert set(adjustment.get_corrected_coordinates()) == set(coords)
+
+    def test_intrinsics(self, rig):
+        coords, pos, _, poses = rig
+        # the calibration of another lens position as start value
+        wrong = {h: {'LensPosition': 3.} for h in pos}
+        fixed = BundleAdjustment(coords, pos, wrong, poses)
+        fixed.adjust(max_nfev=20)
+        refined = BundleAdjustment(coords, pos, wrong, poses, refine_intrinsics=True)
+        refined.adjust()
+        assert max(refined.get_rms().values()) < 1
+        assert np.median(list(fixed.get_rms().values())) > 2
+        cameraMatrix, _ = camera_matrix(1.)
+        f = next(iter(refined.get_poses().values()))['cameraMatrix'][0, 0]
+        assert abs(f - cameraMatrix[0, 0]) < 5
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from json import load
+
+import numpy as np
+import pytest
+
+from common.typen import ArucoMarkerCorners, ArucoMarkerPos, Metadata, Point3D
+from master.calibration_store import CalibrationStore
+from master.marker_check import MarkerChecker
+
+
+class TestCalibrationStore:
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        store = CalibrationStore(str(tmp_path / "calibration.sqlite"))
+        yield store
+        store.close()
+
+    @pytest.fixture
+    def session(self):
+        marker_coord_str: dict[str, dict[str, list[float]]] = load(
+            open('tests/marker.json', 'r'))
+        coords = {int(marker): ArucoMarkerCorners({
+            int(corner): Point3D(*c) for corner, c in corners.items()})
+            for marker, corners in marker_coord_str.items()}
+        pos: dict[str, list[ArucoMarkerPos]] = load(open('tests/aruco.json', 'r'))
+        meta: dict[str, Metadata] = {h: {'LensPosition': 1.} for h in pos}
+        return coords, pos, meta
+
+    def test_marker_versions(self, store, session):
+        coords, _, _ = session
+        first = store.begin_version("a")
+        assert store.set_markers(first, coords) == sum(
+            c is not None for corners in coords.values() for c in corners)
+
+        # only the changed corner is stored again
+        c = coords[15][1]
+        coords[15][1] = Point3D(c.x, c.y, c.z + 0.1)
+        second = store.begin_version("b")
+        assert second > first
+        assert store.set_markers(second, coords) == 1
+        markers = store.get_markers()
+        assert markers[15][1] == coords[15][1]
+        assert markers[15][0] == coords[15][0]
+
+    def test_last_pose(self, store, session):
+        coords, pos, meta = session
+        checker = MarkerChecker(coords, pos, meta)
+        poses = checker.get_poses()
+        version = store.begin_version("a")
+        store.add_observations(version, pos)
+        store.set_cameras(version, poses, meta)
+        assert store.get_last_pose("unknown") is None
+        pose = store.get_last_pose("camera04")
+        assert pose is not None
+        for k in ['cameraMatrix', 'distCoeffs', 'rvecs', 'tvecs']:
+            assert np.allclose(pose[k], poses["camera04"][k])
+        assert set(store.get_last_poses()) == set(poses)
+
+    def test_changed_cameras(self, store, session):
+        coords, pos, meta = session
+        assert store.changed_cameras(pos, meta) == set(pos)
+        checker = MarkerChecker(coords, pos, meta)
+        version = store.begin_version("a")
+        store.add_observations(version, pos)
+        store.set_cameras(version, checker.get_poses(), meta)
+        assert store.changed_cameras(pos, meta) == set()
+
+        pos["camera04"][3]['x'] += 2
+        pos["camera05"] = pos["camera05"][1:]
+        meta["camera06"] = {'LensPosition': 2.}
+        pos["camera07"][0]['y'] += 0.1
+        assert store.changed_cameras(pos, meta) == {"camera04", "camera05", "camera06"}
+
+    def test_incremental_update(self, store, session):
+        coords, pos, meta = session
+        checker = MarkerChecker(coords, pos, meta)
+        version = store.begin_version("a")
+        store.add_observations(version, pos)
+        store.set_cameras(version, checker.get_poses(), meta)
+
+        # the next session: one camera moved, the others are unchanged
+        pos["camera04"] = [dict(p, x=p['x'] + 30) for p in pos["camera04"]]
+        changed = store.changed_cameras(pos, meta)
+        assert changed == {"camera04"}
+        checker = MarkerChecker(coords, pos, meta, poses=store.get_last_poses(),
+                                fixed=set(pos) - changed)
+        poses = checker.get_poses()
+        last = store.get_last_poses()
+        assert np.array_equal(poses["camera05"]['rvecs'], last["camera05"]['rvecs'])
+        assert not np.allclose(poses["camera04"]['tvecs'], last["camera04"]['tvecs'])
+
+        version = store.begin_version("b")
+        store.add_observations(version, pos)
+        store.set_cameras(version, poses, meta, changed)
+        assert store.changed_cameras(pos, meta) == set()
@@ -8,11 +8,14 @@
 
 from glob import glob
 from json import dump
+import numpy as np
+import numpy.typing as npt
 import pytest
 
 from camera.camera_aruco import Aruco
 from cv2 import imread
 from cv2 import cvtColor, COLOR_BGR2GRAY
+from cv2.aruco import Dictionary_create, drawMarker
 from common.logger import Logger
 
 
@@ -49,6 +52,93 @@ class TestCameraAruco:
         assert marker[0]['x'] <= 4608
         assert marker[0]['y'] <= 2592
 
+    @staticmethod
+    def sort(marker):
+        return sorted(marker, key=lambda m: (m['id'], m['corner']))
+
+    def test_scaled_and_roi_like_full(self):
+        moved = np.roll(self.img, 200, axis=1)
+        aruco = Aruco(scale=2)
+        # the markers of the first detection are the reference, then the
+        # windows are searched, the moved markers are found in the downscaled image
+        for img, mode in [(self.img, 'full'), (self.img, 'roi'), (moved, 'scaled')]:
+            full = self.sort(Aruco(scale=1, use_rois=False).detect(img))
+            marker = self.sort(aruco.detect_from_rgb(img))
+            assert aruco.get_stats()[-1]['mode'] == mode
+            assert [(m['id'], m['corner']) for m in marker] == \
+                [(m['id'], m['corner']) for m in full]
+            for m, f in zip(marker, full):
+                assert abs(m['x'] - f['x']) < 0.05
+                assert abs(m['y'] - f['y']) < 0.05
+
+    @staticmethod
+    def markers(small: bool = True) -> npt.NDArray[np.uint8]:
+        """
+        A large marker 1 and a marker 2 too small for the downscaled search.
+        """
+        d = Dictionary_create(32, 3)
+        img = np.full((480, 640), 255, np.uint8)
+        img[40:240, 40:240] = drawMarker(d, 1, 200)
+        if small:
+            img[300:316, 400:416] = drawMarker(d, 2, 16)
+        return img
+
+    @staticmethod
+    def ids(marker) -> list[int]:
+        return sorted({m['id'] for m in marker})
+
+    def test_small_marker(self):
+        img = self.markers()
+        moved = np.roll(img, 50, axis=1)
+        # marker 2 is not found in the downscaled image
+        scaled = Aruco(scale=2, use_rois=False)
+        scaled.detect(self.markers(small=False))
+        assert self.ids(scaled.detect(moved)) == [1]
+        assert scaled.get_stats()[-1]['mode'] == 'scaled'
+        aruco = Aruco(scale=2)
+        assert self.ids(aruco.detect(img)) == [1, 2]
+        assert aruco.get_stats()[-1]['mode'] == 'full'
+        assert self.ids(aruco.detect(img)) == [1, 2]
+        assert aruco.get_stats()[-1]['mode'] == 'roi'
+        # the windows are empty, the downscaled search misses marker 2
+        assert self.ids(aruco.detect(moved)) == [1, 2]
+        stats = aruco.get_stats()[-1]
+        assert stats['mode'] == 'full' and stats['search'] > 0
+        assert self.ids(aruco.detect(moved)) == [1, 2]
+        assert aruco.get_stats()[-1]['mode'] == 'roi'
+
+    def test_new_marker(self):
+        aruco = Aruco(scale=2, full_every=3)
+        assert self.ids(aruco.detect(self.markers(small=False))) == [1]
+        img = self.markers()
+        # the windows only contain marker 1 until the next full search
+        for _ in range(3):
+            assert self.ids(aruco.detect(img)) == [1]
+            assert aruco.get_stats()[-1]['mode'] == 'roi'
+        assert self.ids(aruco.detect(img)) == [1, 2]
+        assert aruco.get_stats()[-1]['mode'] == 'full'
+        assert self.ids(aruco.detect(img)) == [1, 2]
+        assert aruco.get_stats()[-1]['mode'] == 'roi'
+
+    def test_fallback(self):
+        aruco = Aruco(scale=1)
+        aruco.detect(self.img_sw)
+        assert aruco.get_stats()[-1]['mode'] == 'full'
+        assert aruco.get_stats()[-1]['windows'] == 0
+        # the markers moved, the windows of the previous detection are empty
+        moved = np.roll(self.img_sw, 400, axis=1)
+        marker = aruco.detect(moved)
+        stats = aruco.get_stats()[-1]
+        assert stats['mode'] == 'full'
+        assert stats['windows'] > 0
+        assert stats['total'] >= stats['full'] + stats['refine']
+        assert self.sort(marker) == self.sort(Aruco(scale=1, use_rois=False).detect(moved))
+
+    def test_no_marker(self):
+        aruco = Aruco()
+        assert aruco.detect(np.zeros((480, 640), dtype=np.uint8)) == []
+        assert aruco.get_stats()[-1]['mode'] == 'full'
+
     @pytest.fixture
     def test_prepare_marker_check(self, aruco: Aruco):
         bilder = glob("../bilderserien/TPKarton/F01/*.jpg")
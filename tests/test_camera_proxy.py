@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from master.camera_proxy import CameraProxy
+
+
+class Camera(BaseHTTPRequestHandler):
+    requests: list[tuple[str, str, bytes]] = []
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.requests.append(("GET", self.path, b""))
+        if self.path.startswith("/slow"):
+            sleep(0.2)
+        if self.path.startswith("/stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+            self.end_headers()
+            for i in range(3):
+                self.wfile.write(b"--frame\r\n" + str(i).encode() + b"\r\n")
+            return
+        data = b"jpeg" * 1000
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Path", self.path)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.requests.append(("POST", self.path, body))
+        self.send_response(201)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+
+class TestCameraProxy:
+
+    @pytest.fixture
+    def camera(self):
+        Camera.requests = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Camera)
+        Thread(target=server.serve_forever, daemon=True).start()
+        yield f"127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
+        server.server_close()
+
+    def test_get(self, camera: str):
+        proxy = CameraProxy()
+        r = proxy.request("GET", camera, "preview/-2", "a=1", [("Host", "master"), ("Connection", "close")])
+        assert r.status == 200
+        headers = dict(r.headers)
+        assert headers["X-Path"] == "/preview/-2?a=1"
+        assert "Connection" not in headers
+        assert b"".join(r.body) == b"jpeg" * 1000
+        stats = proxy.get_stats()
+        assert stats['bytes_total'] == 4000
+        assert stats['active'] == 0
+        proxy.close()
+
+    def test_post(self, camera: str):
+        proxy = CameraProxy()
+        r = proxy.request("POST", camera, "photo/", body=b'{"iso": 100}',
+                          headers=[("Content-Type", "application/json")])
+        assert r.status == 201
+        assert b"".join(r.body) == b"ok"
+        assert Camera.requests == [("POST", "/photo/", b'{"iso": 100}')]
+        proxy.close()
+
+    def test_stream(self, camera: str):
+        proxy = CameraProxy(cache_ttl=10.)
+        for _ in range(2):
+            r = proxy.request("GET", camera, "stream.mjpg")
+            assert b"".join(r.body) == b"--frame\r\n0\r\n--frame\r\n1\r\n--frame\r\n2\r\n"
+        # multipart streams are never cached
+        assert len(Camera.requests) == 2
+        proxy.close()
+
+    def test_cache(self, camera: str):
+        now = [0.]
+        proxy = CameraProxy(cache_ttl=1., clock=lambda: now[0])
+        for _ in range(3):
+            assert b"".join(proxy.request("GET", camera, "preview/").body) == b"jpeg" * 1000
+        assert len(Camera.requests) == 1
+        assert proxy.get_stats()['cached'] == 2
+        now[0] = 2.
+        b"".join(proxy.request("GET", camera, "preview/").body)
+        assert len(Camera.requests) == 2
+        proxy.close()
+
+    def test_coalesce(self, camera: str):
+        proxy = CameraProxy(cache_ttl=1.)
+        results = []
+
+        def get():
+            results.append(b"".join(proxy.request("GET", camera, "slow").body))
+        threads = [Thread(target=get) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [b"jpeg" * 1000] * 4
+        assert len(Camera.requests) == 1
+        assert proxy.get_stats()['coalesced'] == 3
+        proxy.close()
+
+    def test_unreachable(self):
+        proxy = CameraProxy(connect_timeout=0.5)
+        r = proxy.request("GET", "127.0.0.1:1", "preview/")
+        assert r.status == 502
+        assert proxy.get_stats()['errors'] == 1
+        proxy.close()
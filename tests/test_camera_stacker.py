@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import cv2
+import numpy as np
+
+from camera.camera_stacker import CameraStacker
+
+
+class TestCameraStacker:
+    img = cv2.resize(cv2.imread('tests/test.jpg'), (1152, 648))
+
+    def test_stack(self, tmp_path):
+        folder = str(tmp_path) + "/"
+        h = self.img.shape[0]
+        blurred = cv2.GaussianBlur(self.img, (0, 0), 4)
+        a = self.img.copy()
+        a[h//2:] = blurred[h//2:]
+        b = self.img.copy()
+        b[:h//2] = blurred[:h//2]
+        cv2.imwrite(folder + "s_1.jpg", a)
+        cv2.imwrite(folder + "s_2.5.jpg", b)
+
+        results = []
+        stacker = CameraStacker(folder, tile_rows=100, map_width=64, hostname="cam")
+        stacker.stack("s", [1., 2.5], lambda *files: results.append(files)).result()
+        stacker.shutdown()
+
+        assert results == [("s.jpg", "s_sharpness.png")]
+        fused = cv2.imread(folder + "s.jpg")
+        assert fused.shape == self.img.shape
+        sharpness = cv2.imread(folder + "s_sharpness.png", cv2.IMREAD_GRAYSCALE)
+        assert sharpness.shape == (36, 64)
+        assert np.mean(sharpness[:14] == 0) > 0.5
+        assert np.mean(sharpness[22:] == 255) > 0.5
+
+    def test_missing_frames(self, tmp_path):
+        folder = str(tmp_path) + "/"
+        cv2.imwrite(folder + "s_1.jpg", self.img)
+        results = []
+        stacker = CameraStacker(folder, hostname="cam")
+        stacker.stack("s", [1., 2.], lambda *files: results.append(files)).result()
+        stacker.shutdown()
+        # the first frame is sent instead
+        assert results == [("s.jpg", "s_sharpness.png")]
+        assert (tmp_path / "s.jpg").read_bytes() == (tmp_path / "s_1.jpg").read_bytes()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Event
+
+from camera.command_dispatcher import CommandDispatcher
+
+
+class TestCommandDispatcher:
+
+    def test_control_command_while_hardware_busy(self):
+        dispatcher = CommandDispatcher()
+        release = Event()
+        answered = Event()
+        dispatcher.register('photo', lambda arg, addr: release.wait(5),
+                            hardware=True)
+        dispatcher.register('search', lambda arg, addr: answered.set())
+
+        dispatcher.dispatch('photo:1', ('master', 1))
+        dispatcher.dispatch('search', ('master', 1))
+        assert answered.wait(1)
+        release.set()
+
+    def test_superseded_commands_are_dropped(self):
+        dispatcher = CommandDispatcher()
+        release = Event()
+        done = Event()
+        focus: list[str] = []
+        dispatcher.register('photo', lambda arg, addr: release.wait(5),
+                            hardware=True)
+        dispatcher.register('focus', lambda arg, addr: focus.append(arg),
+                            hardware=True, supersede=True)
+        dispatcher.register('stack', lambda arg, addr: done.set(),
+                            hardware=True)
+
+        dispatcher.dispatch('photo:1', ('master', 1))
+        for f in ['0.1', '0.2', '0.3']:
+            dispatcher.dispatch('focus:' + f, ('master', 1))
+        dispatcher.dispatch('stack:2', ('master', 1))
+        assert dispatcher.get_stats()['queue_depth'] == 2
+        release.set()
+        assert done.wait(1)
+
+        assert focus == ['0.3']
+        stats = dispatcher.get_stats()
+        assert stats['commands']['focus']['cancelled'] == 2
+        assert stats['commands']['photo']['count'] == 1
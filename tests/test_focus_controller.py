@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Timer
+
+import pytest
+
+from camera.focus_controller import DEFAULT_OFFSET, DEFAULT_SLOPE, FocusController
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestFocusController:
+
+    @pytest.fixture
+    def clock(self):
+        return Clock()
+
+    @pytest.fixture
+    def lens(self):
+        return []
+
+    @pytest.fixture
+    def controller(self, lens, clock):
+        controller = FocusController(lens.append, timeout=0.2, clock=clock)
+        controller.frame({'LensPosition': 0.})
+        return controller
+
+    def test_move_without_wait(self, controller: FocusController, lens):
+        predicted = controller.move(2.)
+        assert lens == [2.]
+        assert predicted == pytest.approx(DEFAULT_OFFSET + 2 * DEFAULT_SLOPE)
+
+    def test_wait_for_frame(self, controller: FocusController, clock: Clock):
+        controller.move(2.)
+        clock.now = 0.05
+        controller.frame({'LensPosition': 1.})
+        clock.now = 0.12
+        Timer(0.05, controller.frame, args=({'LensPosition': 2.},)).start()
+        assert controller.wait() == pytest.approx(0.12)
+
+    def test_timeout(self, controller: FocusController):
+        controller.move(2.)
+        controller.frame({'LensPosition': 1.})
+        assert controller.wait() is None
+
+    def test_same_position(self, controller: FocusController):
+        assert controller.move(0.) == 0.
+        assert controller.wait() == 0.
+        assert controller.get_model()['n'] == 0
+
+    def test_learn(self, controller: FocusController, clock: Clock):
+        position = 0.
+        for target in [1., 4., 2., 7., 1., 5.]:
+            clock.now = 0.
+            controller.move(target)
+            clock.now = 0.02 + 0.01 * abs(target - position)
+            controller.frame({'LensPosition': target})
+            controller.wait()
+            position = target
+        assert controller.predict(3.) == pytest.approx(0.05)
+        assert controller.predict(0.) == 0.
+
+    def test_persist(self, lens, clock: Clock, tmp_path):
+        file = str(tmp_path / 'focus.json')
+        controller = FocusController(lens.append, file=file, clock=clock)
+        controller.frame({'LensPosition': 0.})
+        controller.move(3.)
+        clock.now = 0.3
+        controller.frame({'LensPosition': 3.})
+        controller.wait()
+        loaded = FocusController(lens.append, file=file)
+        assert loaded.get_model() == controller.get_model()
+        assert loaded.predict(3.) == pytest.approx(0.3)
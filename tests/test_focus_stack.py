@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import cv2
+import numpy as np
+import numpy.typing as npt
+import pytest
+
+from common.focus_stack import HomographyCache, align_images, doLap, focus_stack, iter_aligned, stack_aligned, stack_aligned_index
+
+
+def reference_stack(images: list[npt.NDArray[np.uint8]]) -> npt.NDArray[np.uint8]:
+    """ the merge as it was done before the streaming engine """
+    laps = np.asarray([doLap(cv2.cvtColor(i, cv2.COLOR_BGR2GRAY))
+                       for i in images])
+    output = np.zeros(shape=images[0].shape, dtype=images[0].dtype)
+    abs_laps = np.absolute(laps)
+    maxima = abs_laps.max(axis=0)
+    mask = (abs_laps == maxima).astype(np.uint8)
+    for i in range(0, len(images)):
+        output = cv2.bitwise_not(images[i], output, mask=mask[i])
+    return 255-output  # type: ignore
+
+
+class TestFocusStack:
+    img = cv2.resize(cv2.imread('tests/test.jpg'), (1152, 648))
+
+    @pytest.fixture
+    def images(self) -> list[npt.NDArray[np.uint8]]:
+        # sharp in the upper, blurred in the lower part and the other way round
+        h = self.img.shape[0]
+        blurred = cv2.GaussianBlur(self.img, (0, 0), 4)
+        a = self.img.copy()
+        a[h//2:] = blurred[h//2:]
+        b = self.img.copy()
+        b[:h//2] = blurred[:h//2]
+        return [a, b, cv2.GaussianBlur(self.img, (0, 0), 1)]
+
+    def test_identical_to_reference(self, images):
+        assert np.array_equal(stack_aligned(images), reference_stack(images))
+
+    @pytest.mark.parametrize("tile_rows,overlap", [(1, 4), (37, 4), (100, 8)])
+    def test_tiles_identical_to_reference(self, images, tile_rows, overlap):
+        assert np.array_equal(stack_aligned(images, tile_rows, overlap),
+                              reference_stack(images))
+
+    def test_index(self, images):
+        merged, index = stack_aligned_index(images, tile_rows=100)
+        assert np.array_equal(merged, reference_stack(images))
+        h = index.shape[0]
+        # the sharp half of each image wins
+        assert np.mean(index[:h//2 - 20] == 0) > 0.5
+        assert np.mean(index[h//2 + 20:] == 1) > 0.5
+        for i, image in enumerate(images):
+            assert np.array_equal(merged[index == i], image[index == i])
+
+    def test_streamed_from_generator(self, images):
+        merged = stack_aligned(i for i in images)
+        assert np.array_equal(merged, reference_stack(images))
+
+    def test_focus_stack_identical_to_reference(self, images):
+        assert np.array_equal(focus_stack(images, tile_rows=128),
+                              reference_stack(align_images(images)))
+
+    def test_align_shifted_image(self):
+        shift = np.array([[1, 0, 12], [0, 1, -7]], dtype=np.float64)
+        h, w = self.img.shape[:2]
+        moved = cv2.warpAffine(self.img, shift, (w, h))
+        homographies: dict[str, list[list[float]]] = {}
+        aligned = list(iter_aligned([self.img, moved], [1, 4], homographies))
+        hom = np.asarray(homographies[HomographyCache.key(1, 4)])
+        assert len(aligned) == 2
+        assert abs(hom[0, 2] + 12) < 1
+        assert abs(hom[1, 2] - 7) < 1
+
+    def test_cached_homography_is_reused(self):
+        cached = {HomographyCache.key(1, 2): np.eye(3).tolist()}
+        homographies = dict(cached)
+        aligned = list(iter_aligned(
+            [self.img, self.img.copy()], [1, 2], homographies))
+        assert homographies == cached
+        assert np.array_equal(aligned[1], self.img)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Event, Thread
+
+import cv2
+import pytest
+
+from master.focus_stack_pool import FocusStackPool
+
+
+class TestFocusStackPool:
+    img = cv2.resize(cv2.imread('tests/test.jpg'), (288, 162))
+
+    @pytest.fixture
+    def stacked(self):
+        return []
+
+    @pytest.fixture
+    def started(self):
+        return Event()
+
+    @pytest.fixture
+    def pool(self, stacked, started):
+        pool = FocusStackPool(lambda *args: (stacked.append(args), started.set()), workers=1)
+        yield pool
+        pool.stop()
+
+    def frames(self, tmp_path, hostname: str, positions: list[float]) -> list[str]:
+        files = []
+        for p in positions:
+            file = str(tmp_path / f"{hostname}_{p:g}.jpg")
+            cv2.imwrite(file, cv2.GaussianBlur(self.img, (0, 0), 1 + p / 2))
+            files.append(file)
+        return files
+
+    def finish(self, pool: FocusStackPool, id: str) -> None:
+        done = Event()
+        pool.finish(id, done.set)
+        assert done.wait(30)
+
+    @pytest.mark.parametrize("positions", [[1., 2., 4.], [1., 2., 3., 4., 5., 6., 7.]])
+    def test_positions(self, pool: FocusStackPool, stacked, started: Event, tmp_path, positions):
+        output = str(tmp_path / "cam1.jpg")
+        files = self.frames(tmp_path, "cam1", positions)
+        for file in files[:-1]:
+            pool.add_frame("s", "cam1", file, output, len(positions))
+        assert not started.wait(0.5)
+        # the last frame starts the stack before the capture is finished
+        pool.add_frame("s", "cam1", files[-1], output, len(positions))
+        assert started.wait(30)
+        self.finish(pool, "s")
+        # all frames in one stack
+        assert stacked == [("s", "cam1", output)]
+        assert cv2.imread(output).shape == self.img.shape
+
+    def test_grouping(self, pool: FocusStackPool, stacked, tmp_path):
+        # frames of two captures and two cameras arrive interleaved
+        files = {(id, host): self.frames(tmp_path, f"{id}{host}", [1., 2., 4.])
+                 for id in ("a", "b") for host in ("cam1", "cam2")}
+        for i in range(3):
+            for (id, host), f in files.items():
+                pool.add_frame(id, host, f[i], str(tmp_path / f"{id}{host}.jpg"), 3)
+        self.finish(pool, "a")
+        self.finish(pool, "b")
+        assert sorted(stacked) == [(id, host, str(tmp_path / f"{id}{host}.jpg"))
+                                   for id in ("a", "b") for host in ("cam1", "cam2")]
+
+    def test_start_in_thread(self, pool: FocusStackPool, stacked, started: Event, tmp_path):
+        # the pool is started lazily by a download thread, not before
+        output = str(tmp_path / "cam1.jpg")
+        files = self.frames(tmp_path, "cam1", [1., 2.])
+        threads = [Thread(target=pool.add_frame, args=("s", "cam1", f, output, 2)) for f in files]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert started.wait(30)
+        self.finish(pool, "s")
+        assert stacked == [("s", "cam1", output)]
+
+    def test_finish_missing_frames(self, pool: FocusStackPool, stacked, started: Event, tmp_path):
+        # cam2 is missing one frame, cam3 sent none
+        for host, positions in (("cam1", [1., 2., 4.]), ("cam2", [1., 4.])):
+            for f in self.frames(tmp_path, host, positions):
+                pool.add_frame("s", host, f, str(tmp_path / f"{host}.jpg"), 3)
+        assert started.wait(30)
+        self.finish(pool, "s")
+        # the incomplete camera is stacked with the frames it has
+        assert sorted(stacked) == [("s", "cam1", str(tmp_path / "cam1.jpg")),
+                                   ("s", "cam2", str(tmp_path / "cam2.jpg"))]
+        assert cv2.imread(str(tmp_path / "cam2.jpg")).shape == self.img.shape
+
+    def test_finish_without_frames(self, pool: FocusStackPool):
+        # a capture without any downloaded frame finishes at once
+        self.finish(pool, "empty")
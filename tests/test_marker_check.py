@@ -8,10 +8,11 @@
 
 from copy import deepcopy
 from json import load, dump
+import numpy as np
 import pandas as pd
 import pytest
 
-from master.marker_check import MarkerChecker
+from master.marker_check import IRLS_ITERATIONS, ROBUST_SCALE, MarkerChecker, reprojection_error, triangulate
 from common.typen import ArucoMarkerCorners, ArucoMarkerPos, Metadata, Point3D
 from common.logger import Logger
 
@@ -176,3 +177,79 @@ class TestMarkerChecker:
         assert not any([v is None for v in cameras.values()])
 
         Logger().info(marker)
+
+    def test_residuals(self):
+        marker_coords = self.load_marker_coords()
+        marker_pos: dict[str, list[ArucoMarkerPos]] = load(
+            open('tests/aruco.json', 'r'))
+        marker_pos["camera04"][7]['x'] += 20
+
+        metadata: dict[str, Metadata] = {
+            key: {'LensPosition': 1.} for key in marker_pos.keys()}
+        marker_checker = MarkerChecker(marker_coords, marker_pos, metadata)
+        r = marker_checker.get_residuals()
+        assert set(r) == set(marker_pos)
+        shifted = [o['residual'] for o in r['camera04']
+                   if o['id'] == marker_pos["camera04"][7]['id']
+                   and o['corner'] == marker_pos["camera04"][7]['corner']]
+        assert shifted[0] > 15
+        others = sorted(o['residual'] for o in r['camera04'])
+        assert others[len(others) // 2] < 5
+
+    def test_triangulate_with_outlier(self):
+        rng = np.random.default_rng(1)
+        points = rng.uniform(-0.2, 0.2, (10, 3))
+        projection, normalized, index = [], [], []
+        for cam in range(6):
+            a = 2 * np.pi * cam / 6
+            eye = np.array([np.cos(a), np.sin(a), 0.2])
+            forward = -eye / np.linalg.norm(eye)
+            right = np.cross(forward, [0, 0, 1.])
+            right /= np.linalg.norm(right)
+            r = np.stack([right, np.cross(forward, right), forward])
+            p = np.c_[r, -r @ eye]
+            x = points @ r.T - r @ eye
+            projection += [p] * len(points)
+            normalized += list(x[:, :2] / x[:, 2:])
+            index += list(range(len(points)))
+        projection_a = np.array(projection)
+        normalized_a = np.array(normalized)
+        index_a = np.array(index)
+        # one gross error per point
+        normalized_a[:len(points)] += 0.05
+
+        plain = triangulate(projection_a, normalized_a, index_a, len(points))
+        weights = np.ones(len(index_a))
+        for _ in range(IRLS_ITERATIONS):
+            coords = triangulate(projection_a, normalized_a, index_a, len(points), weights)
+            residual = reprojection_error(projection_a, normalized_a, coords[index_a]) * 3000
+            weights = 1 / (1 + (residual / ROBUST_SCALE) ** 2)
+        assert np.abs(plain - points).max() > 1e-3
+        assert np.abs(coords - points).max() < 1e-4
+
+    def test_warm_start(self):
+        marker_coords = self.load_marker_coords()
+        marker_pos: dict[str, list[ArucoMarkerPos]] = load(
+            open('tests/aruco.json', 'r'))
+        metadata: dict[str, Metadata] = {
+            key: {'LensPosition': 1.} for key in marker_pos.keys()}
+        cold = MarkerChecker(marker_coords, marker_pos, metadata)
+        poses = cold.get_poses()
+        assert set(poses) == set(marker_pos)
+
+        # a wrong start value has to be replaced by RANSAC
+        poses["camera04"] = {'rvecs': np.zeros((3, 1)), 'tvecs': np.array([[0.], [0.], [5.]])}
+        warm = MarkerChecker(marker_coords, marker_pos, metadata, poses=poses, workers=2)
+        warm.check()
+        for axis in ['x', 'y', 'z']:
+            assert abs(warm.get_cameras()["camera04"][axis] -
+                       cold.get_cameras()["camera04"][axis]) < 0.005
+
+        # started from the previous poses, no camera gets worse
+        cold_residuals = cold.get_residuals()
+        warm_residuals = warm.get_residuals()
+        for hostname in marker_pos:
+            c = np.array([o['residual'] for o in cold_residuals[hostname]])
+            w = np.array([o['residual'] for o in warm_residuals[hostname]])
+            assert (w < 10).sum() >= (c < 10).sum()
+            assert np.median(w) <= np.median(c) + 0.5
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import pytest
+
+from master.master import app
+
+
+class TestMaster:
+
+    @pytest.fixture
+    def client(self):
+        return app.test_client()
+
+    @pytest.mark.parametrize("focus", ["a", "1,x", "1;2"])
+    def test_stack_invalid_focus(self, client, focus: str):
+        assert client.get("/stack", query_string={"focus": focus}).status_code == 400
@@ -7,6 +7,7 @@
 """
 
 from flask import Flask
+from common.aruco_codec import encode_aruco, fragment
 from master.control import Control
 
 
@@ -22,3 +23,53 @@ class TestMasterControl:
         marker = control.get_marker()
         assert marker is not None
         assert type(marker) == dict
+
+    def test_aruco_fragments_of_two_cameras(self):
+        control = Control(self.app)
+        # a third camera is missing, so the session is not evaluated yet
+        control._Control__pending_aruco_count["s"] = 3
+        results = {}
+        packets = []
+        for hostname, offset in [("cam1", 0.), ("cam2", 1000.)]:
+            marker = [{'id': i // 4, 'corner': i % 4, 'x': offset + i, 'y': offset - i}
+                      for i in range(400)]
+            results[hostname] = marker
+            parts = fragment(encode_aruco(marker, {'LensPosition': 1.}), 1000)
+            # both cameras number their first result 1
+            packets.append([f"s:{hostname}:s_1:{i}:{len(parts)}:".encode() + p
+                            for i, p in enumerate(parts)])
+        for a, b in zip(*packets):
+            control.receive_aruco_fragment(a)
+            control.receive_aruco_fragment(b)
+        assert control.get_detected_markers()["s"] == results
+
+    def test_aruco_fragment_truncated(self):
+        control = Control(self.app)
+        control._Control__pending_aruco_count["t"] = 3
+        data = encode_aruco([{'id': 1, 'corner': 0, 'x': 1., 'y': 2.}], {'LensPosition': 1.})
+        # the compressed metadata is cut off but the length matches
+        data = data[:-4] + b"\x00" * 4
+        control.receive_aruco_fragment(b"t:cam1:t_1:0:1:" + data)
+        assert "t" not in control.get_detected_markers()
+
+    def test_photo_of_unknown_camera(self):
+        control = Control(self.app)
+        control._Control__pending_photo_count["u"] = 2
+        control._Control__pending_download_count["u"] = 2
+        control._Control__pending_photo_types["u"] = "photo"
+        # the photo cannot be downloaded, the capture only waits for the other one
+        control.receive_photo("10.0.0.99", "u", "u.jpg")
+        assert control._Control__pending_photo_count["u"] == 1
+        assert control._Control__pending_download_count["u"] == 1
+        assert control._Control__pending_photo_types["u"] == "photo"
+
+    def test_last_photo_of_unknown_camera(self, caplog):
+        control = Control(self.app)
+        control._Control__pending_photo_count["v"] = 1
+        control._Control__pending_download_count["v"] = 2
+        control._Control__pending_photo_types["v"] = "photo"
+        control.receive_photo("10.0.0.99", "v", "v.jpg")
+        # all photos have been taken, one download is still running
+        assert "v" not in control._Control__pending_photo_count
+        assert control._Control__pending_download_count["v"] == 1
+        assert "All photos taken!" in caplog.text
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import socket
+
+from common.messaging import BATCH_MAGIC, LENGTH, MessageEndpoint, split_batch
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestMessaging:
+
+    def test_split_batch(self):
+        batch = BATCH_MAGIC + LENGTH.pack(3) + b'abc' + LENGTH.pack(2) + b'de'
+        assert split_batch(batch) == [b'abc', b'de']
+        assert split_batch(b'photo:1') == [b'photo:1']
+
+    def test_acknowledged_over_localhost(self):
+        port_master, port_cam = free_port(), free_port()
+        master = MessageEndpoint('master', port_master,
+                                 lambda addr: ('127.0.0.1', port_cam))
+        cam = MessageEndpoint('cam1', port_cam,
+                              lambda addr: ('127.0.0.1', port_master))
+        master.listen('127.0.0.1')
+        cam.listen('127.0.0.1')
+
+        for i in range(20):
+            cam.send(f'photoDone:{i}'.encode(), ('127.0.0.1', port_master))
+        received: list[bytes] = []
+        while len(received) < 20:
+            received += [e.payload for e, _ in master.receive()]
+        # the acknowledgements
+        for _ in range(100):
+            if cam.get_stats()['unacknowledged'] == 0:
+                break
+            cam.receive()
+        assert sorted(received) == sorted(
+            f'photoDone:{i}'.encode() for i in range(20))
+        stats = cam.get_stats()
+        assert stats['unacknowledged'] == 0
+        assert stats['messages'] >= 20
+        assert stats['batches'] <= stats['messages']
+        master.close()
+        cam.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+
+import pytest
+
+from master.photo_downloader import DownloadJob, PhotoDownloader
+
+
+class Camera(BaseHTTPRequestHandler):
+    """
+    /fail<n>/: the first n requests fail, /slow/: the photo takes a while,
+    /broken/: the connection is closed in the middle of the photo.
+    """
+    lock = Lock()
+    requests: dict[str, int] = {}
+    active = 0
+    max_active = 0
+    halfway = Event()
+    data = b"jpeg" * 1000
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        cls = type(self)
+        with cls.lock:
+            cls.requests[self.path] = cls.requests.get(self.path, 0) + 1
+            count = cls.requests[self.path]
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            if self.path.startswith("/fail") and count <= int(self.path.split("/")[1][4:]):
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.data)))
+            self.end_headers()
+            self.wfile.write(self.data[:100])
+            self.wfile.flush()
+            if self.path.startswith("/broken"):
+                return
+            if self.path.startswith("/slow"):
+                cls.halfway.set()
+                sleep(0.3)
+            self.wfile.write(self.data[100:])
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+class TestPhotoDownloader:
+
+    @pytest.fixture
+    def servers(self):
+        servers: list[ThreadingHTTPServer] = []
+        yield servers
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    @staticmethod
+    def camera(servers: list[ThreadingHTTPServer]) -> tuple[str, type[Camera]]:
+        handler = type("Camera", (Camera,), {"lock": Lock(), "requests": {}, "active": 0,
+                                             "max_active": 0, "halfway": Event()})
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"127.0.0.1:{server.server_address[1]}", handler
+
+    @pytest.fixture
+    def done(self):
+        return []
+
+    @pytest.fixture
+    def downloader(self, done):
+        downloader = PhotoDownloader(lambda job, success: done.append((job.target, success)),
+                                     workers=4, per_camera=2, retries=2, backoff=0.1,
+                                     chunk_size=100, timeout=2)
+        yield downloader
+        downloader.stop()
+
+    @staticmethod
+    def job(host: str, url: str, target) -> DownloadJob:
+        return DownloadJob("s", "cam", host, f"http://{host}{url}", str(target))
+
+    @staticmethod
+    def wait(done: list, count: int) -> None:
+        end = monotonic() + 10
+        while len(done) < count and monotonic() < end:
+            sleep(0.01)
+        assert len(done) == count
+
+    def test_download(self, downloader: PhotoDownloader, done, tmp_path, servers):
+        host, _ = self.camera(servers)
+        downloader.download(self.job(host, "/bilder/a.jpg", tmp_path / "a.jpg"))
+        self.wait(done, 1)
+        assert done == [(str(tmp_path / "a.jpg"), True)]
+        assert (tmp_path / "a.jpg").read_bytes() == Camera.data
+        stats = downloader.get_stats()
+        assert (stats['done'], stats['failed'], stats['retries']) == (1, 0, 0)
+        assert stats['bytes_total'] == len(Camera.data)
+        assert (stats['queue_depth'], stats['active']) == (0, 0)
+
+    def test_retry(self, downloader: PhotoDownloader, done, tmp_path, servers):
+        host, handler = self.camera(servers)
+        t = monotonic()
+        downloader.download(self.job(host, "/fail2/a.jpg", tmp_path / "a.jpg"))
+        self.wait(done, 1)
+        # waited 0.1 s and 0.2 s before the retries
+        assert monotonic() - t >= 0.3
+        assert done == [(str(tmp_path / "a.jpg"), True)]
+        assert handler.requests["/fail2/a.jpg"] == 3
+        assert downloader.get_stats()['retries'] == 2
+
+        # still failing after the last retry
+        downloader.download(self.job(host, "/fail3/b.jpg", tmp_path / "b.jpg"))
+        self.wait(done, 2)
+        assert done[1] == (str(tmp_path / "b.jpg"), False)
+        assert handler.requests["/fail3/b.jpg"] == 3
+        assert not path.exists(tmp_path / "b.jpg")
+        stats = downloader.get_stats()
+        assert (stats['done'], stats['failed'], stats['retries']) == (1, 1, 4)
+
+    def test_part_file(self, downloader: PhotoDownloader, done, tmp_path, servers):
+        host, handler = self.camera(servers)
+        downloader.download(self.job(host, "/slow/a.jpg", tmp_path / "a.jpg"))
+        assert handler.halfway.wait(5)
+        sleep(0.1)
+        # the photo is written to a temporary file first
+        assert path.exists(tmp_path / "a.jpg.part")
+        assert not path.exists(tmp_path / "a.jpg")
+        self.wait(done, 1)
+        assert not path.exists(tmp_path / "a.jpg.part")
+        assert (tmp_path / "a.jpg").read_bytes() == Camera.data
+
+        # an incomplete photo is removed, not renamed
+        downloader.download(self.job(host, "/broken/b.jpg", tmp_path / "b.jpg"))
+        self.wait(done, 2)
+        assert done[1] == (str(tmp_path / "b.jpg"), False)
+        assert not path.exists(tmp_path / "b.jpg")
+        assert not path.exists(tmp_path / "b.jpg.part")
+
+    def test_per_camera_limit(self, downloader: PhotoDownloader, done, tmp_path, servers):
+        host_a, handler_a = self.camera(servers)
+        host_b, handler_b = self.camera(servers)
+        for i in range(6):
+            downloader.download(self.job(host_a, f"/slow/{i}.jpg", tmp_path / f"a{i}.jpg"))
+        for i in range(2):
+            downloader.download(self.job(host_b, f"/slow/{i}.jpg", tmp_path / f"b{i}.jpg"))
+        self.wait(done, 8)
+        assert all(success for _, success in done)
+        assert handler_a.max_active == 2
+        assert handler_b.max_active == 2
+        # the idle workers took the photos of camera b while camera a was busy
+        assert {target for target, _ in done[:4]} >= {str(tmp_path / "b0.jpg"), str(tmp_path / "b1.jpg")}
+        assert downloader.get_stats()['queue_depth'] == 0
+
+    def test_stop(self, downloader: PhotoDownloader, done, tmp_path, servers):
+        host, _ = self.camera(servers)
+        for i in range(6):
+            downloader.download(self.job(host, f"/slow/{i}.jpg", tmp_path / f"{i}.jpg"))
+        sleep(0.1)
+        t = monotonic()
+        downloader.stop()
+        # only the running downloads are finished
+        assert monotonic() - t < 1
+        assert len(done) == 2
+        assert downloader.get_stats()['queue_depth'] == 4
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from datetime import datetime
+
+import cv2
+import numpy as np
+import piexif
+import pytest
+
+from camera.photo_encoder import encode_jpeg, exif_data, frame_view
+
+
+class TestPhotoEncoder:
+    # the camera pads each row of 100 pixels (300 bytes) to 320 bytes
+    config = {"format": "RGB888", "size": (100, 60), "stride": 320}
+    metadata = {"ExposureTime": 20000, "AnalogueGain": 2., "DigitalGain": 1.5,
+                "LensPosition": 4.}
+
+    @pytest.fixture
+    def buffer(self):
+        img = np.zeros((60, 100, 3), dtype=np.uint8)
+        img[:, :50] = (255, 0, 0)
+        img[:, 50:] = (0, 0, 255)
+        padded = np.full((60, 320), 77, dtype=np.uint8)
+        padded[:, :300] = img.reshape(60, 300)
+        return padded.reshape(-1)
+
+    def test_frame_view(self, buffer):
+        img = frame_view(buffer, self.config)
+        assert img.shape == (60, 100, 3)
+        assert np.shares_memory(img, buffer)
+        assert (img[:, :50] == (255, 0, 0)).all() and (img[:, 50:] == (0, 0, 255)).all()
+        # OpenCV reads the strided view
+        assert cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).shape == (60, 100)
+
+    @pytest.mark.parametrize("format, left", [("RGB888", (255, 0, 0)), ("BGR888", (0, 0, 255))])
+    def test_encode(self, buffer, format, left):
+        config = dict(self.config, format=format)
+        data = encode_jpeg(buffer, config, exif_data(self.metadata, "imx708", "cam1"))
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        assert img.shape == (60, 100, 3)
+        # BGR as read by OpenCV, no padding bytes in the image
+        assert np.abs(img[30, 10].astype(int) - left).max() < 10
+        assert np.abs(img[30, 90].astype(int) - left[::-1]).max() < 10
+
+    def test_exif(self, buffer):
+        now = datetime(2024, 3, 11, 12, 30, 15)
+        data = encode_jpeg(buffer, self.config, exif_data(self.metadata, "imx708", "cam1", now))
+        exif = piexif.load(data)
+        assert exif["0th"][piexif.ImageIFD.Make] == b"Raspberry Pi"
+        assert exif["0th"][piexif.ImageIFD.Model] == b"imx708"
+        assert exif["0th"][piexif.ImageIFD.DateTime] == b"2024:03:11 12:30:15"
+        assert exif["Exif"][piexif.ExifIFD.DateTimeOriginal] == b"2024:03:11 12:30:15"
+        assert exif["Exif"][piexif.ExifIFD.ExposureTime] == (20000, 1000000)
+        assert exif["Exif"][piexif.ExifIFD.ISOSpeedRatings] == 300
+        assert exif["Exif"][piexif.ExifIFD.FocalLength] == (474, 100)
+        assert exif["Exif"][piexif.ExifIFD.SubjectDistance] == (25, 100)
+        assert exif["Exif"][piexif.ExifIFD.BodySerialNumber] == b"cam1"
+
+    def test_unsupported(self, buffer):
+        config = dict(self.config, format="YUV420")
+        with pytest.raises(ValueError):
+            frame_view(buffer, config)
+        with pytest.raises(ValueError):
+            encode_jpeg(buffer, config, exif_data({}, "imx708", "cam1"))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from threading import Event, Lock
+from time import sleep
+
+from common.protocol import Address, Envelope, ReliableChannel, decode, encode
+
+
+class Network:
+    """ delivers datagrams between channels in memory, dropping the first ones """
+
+    def __init__(self, drop: int = 0):
+        self.channels: dict[str, ReliableChannel] = {}
+        self.received: dict[str, list[Envelope]] = {}
+        self.drop = drop
+        self.lock = Lock()
+        self.delivered = Event()
+
+    def add(self, name: str) -> ReliableChannel:
+        self.received[name] = []
+        self.channels[name] = ReliableChannel(
+            name, lambda d, a: self.transmit(name, d, a),
+            lambda addr: addr, timeout=0.05, retries=10)
+        return self.channels[name]
+
+    def transmit(self, sender: str, datagram: bytes, addr: Address) -> None:
+        with self.lock:
+            if self.drop > 0:
+                self.drop -= 1
+                return
+        targets = [n for n in self.channels if n != sender] \
+            if addr[0] == 'broadcast' else [addr[0]]
+        for name in targets:
+            envelope = self.channels[name].receive(datagram, (sender, 1))
+            if envelope is not None:
+                self.received[name].append(envelope)
+                self.delivered.set()
+
+
+class TestProtocol:
+
+    def test_envelope(self):
+        data = encode('master', 12, b'photo:1|2')
+        assert decode(data) == Envelope('master', 12, b'photo:1|2')
+
+    def test_legacy_message(self):
+        assert decode(b'photoDone:1:1.jpg') == \
+            Envelope('', 0, b'photoDone:1:1.jpg')
+
+    def test_retransmitted_until_all_acknowledged(self):
+        network = Network(drop=3)
+        master = network.add('master')
+        network.add('cam1')
+        network.add('cam2')
+
+        master.send(b'photo:1', ('broadcast', 1), {'cam1', 'cam2'})
+        for _ in range(100):
+            if master.pending() == 0:
+                break
+            sleep(0.01)
+        assert master.pending() == 0
+        assert [e.payload for e in network.received['cam1']] == [b'photo:1']
+        assert [e.payload for e in network.received['cam2']] == [b'photo:1']
+
+    def test_duplicates_acknowledged_but_dropped(self):
+        network = Network()
+        network.add('master')
+        cam = network.add('cam1')
+        datagram = encode('master', 5, b'photo:1')
+
+        assert cam.receive(datagram, ('master', 1)) is not None
+        assert cam.receive(datagram, ('master', 1)) is None
+
+    def test_answer_acknowledged_by_master(self):
+        network = Network(drop=1)
+        network.add('master')
+        cam = network.add('cam1')
+
+        cam.send(b'photoDone:1:1.jpg', ('master', 1))
+        assert network.delivered.wait(1)
+        for _ in range(100):
+            if cam.pending() == 0:
+                break
+            sleep(0.01)
+        assert cam.pending() == 0
+        assert len(network.received['master']) == 1
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from os import path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import pytest
+
+from master.session_archive import SessionArchive
+
+
+class TestSessionArchive:
+
+    @pytest.fixture
+    def archive(self, tmp_path):
+        return SessionArchive(str(tmp_path) + "/")
+
+    @staticmethod
+    def write(file, data: bytes) -> str:
+        file.write_bytes(data)
+        return str(file)
+
+    def test_append(self, archive: SessionArchive, tmp_path):
+        archive.add("s", self.write(tmp_path / "cam1.jpg", b"jpeg" * 100))
+        archive.add("s", self.write(tmp_path / "meta.json", b"{}" * 100), "data/meta.json")
+        # written while the session runs, published only when it is closed
+        assert path.exists(tmp_path / "s.zip.part")
+        assert not path.exists(tmp_path / "s.zip")
+
+        assert archive.close("s") == str(tmp_path / "s.zip")
+        assert not path.exists(tmp_path / "s.zip.part")
+        with ZipFile(tmp_path / "s.zip") as z:
+            assert z.namelist() == ["cam1.jpg", "data/meta.json"]
+            assert z.getinfo("cam1.jpg").compress_type == ZIP_STORED
+            assert z.getinfo("data/meta.json").compress_type == ZIP_DEFLATED
+            assert z.read("cam1.jpg") == b"jpeg" * 100
+            assert z.testzip() is None
+
+    def test_duplicate(self, archive: SessionArchive, tmp_path):
+        # a rewritten JSON file and a photo downloaded again
+        aruco, photo = tmp_path / "aruco.json", tmp_path / "cam1.jpg"
+        archive.add("s", self.write(aruco, b"[1]"))
+        archive.add("s", self.write(photo, b"old frame"))
+        archive.add("s", self.write(tmp_path / "cam2.jpg", b"jpeg"))
+        archive.add("s", self.write(aruco, b"[1, 2]"))
+        archive.add("s", self.write(photo, b"new frame"))
+        archive.close("s")
+        with ZipFile(tmp_path / "s.zip") as z:
+            assert z.namelist() == ["aruco.json", "cam1.jpg", "cam2.jpg"]
+            assert z.read("aruco.json") == b"[1, 2]"
+            assert z.read("cam1.jpg") == b"new frame"
+            assert z.read("cam2.jpg") == b"jpeg"
+            assert z.getinfo("cam1.jpg").compress_type == ZIP_STORED
+            assert z.getinfo("aruco.json").compress_type == ZIP_DEFLATED
+        # the old version is not left in the archive
+        assert b"old frame" not in (tmp_path / "s.zip").read_bytes()
+        assert not path.exists(tmp_path / "s.zip.part.new")
+
+    def test_sessions(self, archive: SessionArchive, tmp_path):
+        archive.add("a", self.write(tmp_path / "a.jpg", b"a"))
+        archive.add("b", self.write(tmp_path / "b.jpg", b"b"))
+        archive.close("a")
+        assert path.exists(tmp_path / "a.zip")
+        assert path.exists(tmp_path / "b.zip.part")
+        # closing again or an unknown session
+        assert archive.close("a") is None
+        assert archive.close("c") is None
+        archive.close("b")
+        with ZipFile(tmp_path / "b.zip") as z:
+            assert z.namelist() == ["b.jpg"]
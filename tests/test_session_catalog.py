@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from os import utime
+
+import pytest
+
+from master.session_catalog import SessionCatalog
+
+
+class TestSessionCatalog:
+
+    @pytest.fixture
+    def catalog(self, tmp_path):
+        catalog = SessionCatalog(str(tmp_path / "sessions.sqlite"))
+        yield catalog
+        catalog.close()
+
+    def test_lifecycle(self, catalog: SessionCatalog):
+        catalog.start("a", "stack", 3)
+        catalog.add_photo("a", 1000)
+        catalog.add_photo("a", 500)
+        session = catalog.get("a")
+        assert session is not None
+        assert (session['type'], session['cameras'], session['photos'], session['bytes']) == \
+            ("stack", 3, 2, 1500)
+        assert session['completed'] is None and session['duration'] is None
+
+        catalog.complete("a")
+        catalog.zipped("a", 1200)
+        catalog.copied("a")
+        session = catalog.get("a")
+        assert session['zip_size'] == 1200
+        assert session['zipped'] >= session['completed'] >= session['started']
+        assert session['duration'] == pytest.approx(session['zipped'] - session['started'])
+        assert session['usb'] is not None
+        assert catalog.get("b") is None
+
+    def test_page(self, catalog: SessionCatalog):
+        for i in range(5):
+            catalog.start(f"p{i}", "photo", 1)
+            catalog.start(f"a{i}", "aruco", 1)
+        assert catalog.count() == 10
+        assert catalog.count("aruco") == 5
+        page = catalog.page(offset=1, limit=2, type="photo")
+        # the newest first
+        assert [s['id'] for s in page] == ["p3", "p2"]
+        started = catalog.get("p2")['started']
+        assert catalog.count(since=started) == 6
+        assert catalog.count(until=started) == 4
+
+    def test_import(self, catalog: SessionCatalog, tmp_path):
+        (tmp_path / "old.zip").write_bytes(b"x" * 10)
+        utime(tmp_path / "old.zip", (1e9, 1e9))
+        catalog.start("new", "photo", 1)
+        catalog.zipped("new", 5)
+        (tmp_path / "new.zip").write_bytes(b"x" * 5)
+        assert catalog.import_archives(str(tmp_path) + "/") == 1
+        assert catalog.import_archives(str(tmp_path) + "/") == 0
+        old = catalog.get("old")
+        assert (old['type'], old['started'], old['zip_size'], old['duration']) == ("unknown", 1e9, 10, 0.)
+        assert catalog.get("new")['type'] == "photo"
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import numpy as np
+import pytest
+from cv2 import IMREAD_COLOR, imdecode
+
+from camera.stream import FrameStream
+
+
+class Capture:
+    def __init__(self, busy: int = 0):
+        self.calls = 0
+        self.busy = busy
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.busy:
+            return None
+        return np.full((36, 64, 3), self.calls % 256, dtype=np.uint8)
+
+
+class TestFrameStream:
+
+    @pytest.fixture
+    def capture(self):
+        return Capture()
+
+    @pytest.fixture
+    def stream(self, capture):
+        stream = FrameStream(capture, fps=50, idle_timeout=0.2)
+        yield stream
+        stream.stop()
+
+    def test_mjpeg(self, stream: FrameStream):
+        viewer = stream.mjpeg()
+        part = next(viewer)
+        viewer.close()
+        header, data = part.split(b"\r\n\r\n", 1)
+        assert header.startswith(b"--frame\r\nContent-Type: image/jpeg")
+        length = int(header.split(b"Content-Length: ")[1])
+        assert data[length:] == b"\r\n"
+        img = imdecode(np.frombuffer(data[:length], np.uint8), IMREAD_COLOR)
+        assert img.shape == (36, 64, 3)
+
+    def test_shared_producer(self, stream: FrameStream, capture: Capture):
+        a = stream.mjpeg()
+        b = stream.mjpeg()
+        for _ in range(5):
+            next(a)
+            next(b)
+        assert stream.get_stats()['viewers'] == 2
+        a.close()
+        b.close()
+        stats = stream.get_stats()
+        assert stats['viewers'] == 0
+        # both viewers got the frames of one producer
+        assert capture.calls == stats['frames'] + stats['skipped']
+        assert stats['frames'] < 10
+
+    def test_skip_busy(self):
+        stream = FrameStream(Capture(busy=3), fps=50)
+        assert stream.latest() is not None
+        stats = stream.get_stats()
+        assert stats['skipped'] == 3
+        assert stats['frames'] >= 1
+        stream.stop()
+
+    def test_latest_timeout(self):
+        stream = FrameStream(lambda: None, fps=50)
+        assert stream.latest(timeout=0.1) is None
+        stream.stop()
+
+    def test_stop(self, stream: FrameStream, capture: Capture):
+        assert stream.latest() is not None
+        stream.stop()
+        calls = capture.calls
+        assert stream.latest(timeout=0.1) is None
+        assert capture.calls == calls
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+from os import utime
+
+import cv2
+import numpy as np
+
+from master.thumbnails import ThumbnailCache, read_reduced
+
+
+class TestThumbnails:
+    img = cv2.imread('tests/test.jpg')
+
+    def session(self, tmp_path, cameras: list[str]) -> str:
+        folder = tmp_path / "s"
+        folder.mkdir()
+        for camera in cameras:
+            cv2.imwrite(str(folder / (camera + ".jpg")), self.img)
+        return str(tmp_path) + "/"
+
+    def test_read_reduced(self):
+        # decoded at 1/8
+        assert read_reduced('tests/test.jpg', 320).shape == (324, 576, 3)
+        assert read_reduced('tests/test.jpg', 1000).shape == (648, 1152, 3)
+        assert read_reduced('tests/missing.jpg', 320) is None
+
+    def test_thumbnail(self, tmp_path):
+        cache = ThumbnailCache(self.session(tmp_path, ["cam1"]), width=320)
+        cache.add("s", str(tmp_path / "s" / "cam1.jpg")).result()
+        thumb = tmp_path / "thumbs" / "s" / "cam1.jpg"
+        assert cv2.imread(str(thumb)).shape == (180, 320, 3)
+        assert cache.thumbnail("s", "cam1") == str(thumb)
+        assert cache.thumbnail("s", "cam2") is None
+        cache.shutdown()
+
+    def test_replaced(self, tmp_path):
+        folder = self.session(tmp_path, ["cam1"])
+        cache = ThumbnailCache(folder, width=64)
+        thumb = cache.thumbnail("s", "cam1")
+        utime(thumb, (0, 0))
+        # a stacked image replaces the photo
+        cv2.imwrite(folder + "s/cam1.jpg", np.zeros_like(self.img))
+        assert cache.thumbnail("s", "cam1") == thumb
+        assert cv2.imread(thumb).max() < 10
+        cache.shutdown()
+
+    def test_mosaic(self, tmp_path):
+        folder = self.session(tmp_path, ["cam1", "cam2", "cam3"])
+        # the frames of a stack are not part of the mosaic
+        cv2.imwrite(folder + "s/cam1_2.5.jpg", self.img)
+        cv2.imwrite(folder + "s/cam1_4.jpg", self.img)
+        cache = ThumbnailCache(folder, width=64)
+        assert cache.cameras("s") == ["cam1", "cam2", "cam3"]
+        cache.finish("s").result()
+        mosaic = cache.mosaic("s")
+        assert cv2.imread(mosaic).shape == (72, 128, 3)
+        cache = ThumbnailCache(folder, width=64, columns=3)
+        assert cv2.imread(cache.mosaic("s")).shape == (36, 192, 3)
+        assert cache.mosaic("t") is None
+        cache.shutdown()
+
+    def test_invalid_names(self, tmp_path):
+        folder = self.session(tmp_path, ["cam1"])
+        # an image outside of the sessions
+        cv2.imwrite(str(tmp_path.parent / "x.jpg"), self.img)
+        cache = ThumbnailCache(folder, width=64)
+        assert cache.thumbnail("..", "x") is None
+        assert cache.thumbnail("s", "../s/cam1") is None
+        assert cache.thumbnail("s/..", "s/cam1") is None
+        assert cache.mosaic("..") is None
+        assert cache.cameras("..") == []
+        assert not (tmp_path / "x.jpg").exists()
+        assert not (tmp_path / "thumbs").exists()
+        cache.shutdown()
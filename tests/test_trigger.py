@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@author: Florian Timm
+@version: 2024.03.11
+"""
+
+import pytest
+
+from camera.simulated_camera import SimulatedCamera
+from camera.trigger import ScheduledTrigger
+
+FRAME_US = 33333
+
+
+def trigger(cam: SimulatedCamera) -> ScheduledTrigger:
+    return ScheduledTrigger(cam.capture_request, cam.clock_ns, cam.wall_ns)
+
+
+class TestTrigger:
+
+    @pytest.mark.parametrize("phase", [0, 5_000_000, 16_000_000, 17_000_000, 33_000_000])
+    def test_closest_frame(self, phase):
+        cam = SimulatedCamera(FRAME_US, phase)
+        target = cam.wall_ns() + 500_000_000
+        req, metadata, skew = trigger(cam).capture(target)
+
+        frames = [r.get_metadata()['SensorTimestamp']
+                  for r in cam.get_requests()]
+        target_sensor = target - cam.wall_ns() + cam.clock_ns()
+        best = min(frames, key=lambda ts: abs(ts - target_sensor))
+        assert metadata['SensorTimestamp'] == best
+        assert abs(skew) <= FRAME_US * 1000 // 2
+        assert not req.is_released()
+        assert all(r.is_released() for r in cam.get_requests()[:-1])
+
+    def test_target_in_the_past(self):
+        cam = SimulatedCamera(FRAME_US)
+        cam.advance(2_000_000_000)
+        _, _, skew = trigger(cam).capture(cam.wall_ns() - 100_000_000)
+        assert len(cam.get_requests()) == 1
+        assert skew > 100_000_000
+
+    def test_skew_between_cameras(self):
+        # the same wall clock time, different sensor clocks and frame phases
+        cams = [SimulatedCamera(FRAME_US, phase, 1_700_000_000_000_000_000 + offset)
+                for phase, offset in [(0, 0), (11_000_000, 3_000_000), (29_000_000, -7_000_000)]]
+        for cam in cams:
+            cam.advance(1_000_000_000)
+        target = 1_700_000_001_400_000_000
+        exposed = []
+        for cam in cams:
+            _, metadata, skew = trigger(cam).capture(target)
+            # back to the wall clock
+            exposed.append(metadata['SensorTimestamp'] + cam.wall_ns() - cam.clock_ns())
+            assert abs(exposed[-1] - target - skew) < 1000
+        assert max(exposed) - min(exposed) <= FRAME_US * 1000